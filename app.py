@@ -1,7 +1,9 @@
-from flask import Flask, request, jsonify
-from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
+from flask import Flask, request, jsonify, Response, stream_with_context, g
+from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity, verify_jwt_in_request
 from flask_cors import CORS
-from models import User, SmtpSettings, JSONEncoder, EmailList, EmailTemplate
+from models import User, SmtpSettings, EmailList, EmailTemplate, ScheduledCampaign, CampaignStats, CampaignResult, CampaignShard
+from json_provider import FastJSONProvider, fast_dumps
+from compression import init_compression
 import logging
 import os
 import json
@@ -9,16 +11,32 @@ import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from bson import ObjectId
-from email_utils import EmailSender
+from email_utils import EmailSender, BulkSend
+from fair_scheduler import get_scheduler, TenantQuotaExceeded, LANES, DEFAULT_LANE
+from campaign_timer import get_timer, parse_send_at, SendWindow
+from outbox import get_outbox
+from shard_worker import create_sharded_campaign, get_shard_worker
+from transports import TRANSPORTS, get_transport
+from log_rotation import LOG_DIR, maybe_rotate, iter_archived_lines, remove_archives, start_log_maintenance
+from dkim_signer import load_private_key
+from rate_limit import RATE_LIMIT_ENABLED, RateLimited, get_rate_limiter
+from idempotency import idempotent_send
+from preflight import run_preflight
+from tracing import init_tracing, set_span_attributes
+from list_sync import MAX_SYNC_CHUNKS, valid_chunk_count, differing_chunks
 from datetime import datetime
 import base64
+import threading
+import csv
+import io
+import math
+from itertools import chain, islice
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Create logs directory
-LOG_DIR = "logs"
 if not os.path.exists(LOG_DIR):
     os.makedirs(LOG_DIR)
 
@@ -38,6 +56,8 @@ def save_log(user_id, action, message, level='info', details=None):
         log_file = os.path.join(LOG_DIR, f"{user_id}.log")
         with open(log_file, 'a') as f:
             f.write(json.dumps(log_entry) + '\n')
+            size = f.tell()
+        maybe_rotate(user_id, size)
             
         logger.info(f"[{user_id}] {level.upper()}: {message}")
         
@@ -47,26 +67,59 @@ def save_log(user_id, action, message, level='info', details=None):
 def get_user_logs(user_id, limit=100):
     """Retrieve logs for specific user"""
     try:
-        log_file = os.path.join(LOG_DIR, f"{user_id}.log")
-        logs = []
-        
-        if os.path.exists(log_file):
-            with open(log_file, 'r') as f:
-                logs = [json.loads(line) for line in f.readlines()]
-            
-            # Return only the latest logs based on limit
-            logs = sorted(logs, key=lambda x: x['timestamp'], reverse=True)[:limit]
-            
-        return logs
+        # Only the latest entries are read, newest first
+        return list(islice(iter_user_logs(user_id), limit))
         
     except Exception as e:
         logger.error(f"Error reading logs: {e}")
         return []
 
+def iter_user_logs(user_id):
+    """Lazily yield a user's log entries, newest first"""
+    for line in iter_user_log_lines(user_id):
+        yield json.loads(line)
+
+def iter_user_log_lines(user_id):
+    """Yield the live log's lines, then the archived segments', newest first"""
+    log_file = os.path.join(LOG_DIR, f"{user_id}.log")
+    if os.path.exists(log_file):
+        yield from iter_log_lines_reverse(log_file)
+    yield from iter_archived_lines(user_id)
+
+def iter_log_lines_reverse(log_file, block_size=8192):
+    """Yield the lines of a log file newest first without reading it whole"""
+    with open(log_file, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        remainder = b''
+        while position > 0:
+            read_size = min(block_size, position)
+            position -= read_size
+            f.seek(position)
+            lines = (f.read(read_size) + remainder).split(b'\n')
+            remainder = lines.pop(0)
+            for line in reversed(lines):
+                if line.strip():
+                    yield line.decode('utf-8')
+        if remainder.strip():
+            yield remainder.decode('utf-8')
+
+def get_send_progress(user_id, max_lines=1000):
+    """Return the most recent send progress entry from the user's log"""
+    for count, line in enumerate(iter_user_log_lines(user_id)):
+        if count >= max_lines:
+            break
+        entry = json.loads(line)
+        details = entry.get('details') or {}
+        if 'send_rate_per_minute' in details or 'send_rate_per_minute' in details.get('summary', {}):
+            return entry
+    return None
+
 def clear_user_logs(user_id):
     """Clear logs for specific user"""
     try:
         log_file = os.path.join(LOG_DIR, f"{user_id}.log")
+        remove_archives(user_id)
         if os.path.exists(log_file):
             os.remove(log_file)
             return True
@@ -75,24 +128,145 @@ def clear_user_logs(user_id):
         logger.error(f"Error clearing logs: {e}")
         return False
 
+NDJSON_MIMETYPE = 'application/x-ndjson'
+# Rows buffered into each chunk of a streamed CSV export
+CSV_CHUNK_ROWS = 500
+# Leading characters spreadsheets would evaluate as a formula
+CSV_FORMULA_PREFIXES = ('=', '+', '-', '@')
+
+def wants_ndjson():
+    """True when the client opted into streaming with Accept: application/x-ndjson"""
+    best = request.accept_mimetypes.best_match(['application/json', NDJSON_MIMETYPE])
+    return best == NDJSON_MIMETYPE
+
+def ndjson_response(records):
+    """Stream an iterable of records as newline-delimited JSON"""
+    def generate():
+        try:
+            for record in records:
+                yield fast_dumps(record) + b'\n'
+        except Exception as e:
+            # Headers are already sent, so report the failure in-band
+            logger.error(f"Error streaming response: {e}")
+            yield fast_dumps({'status': 'error', 'message': str(e)}) + b'\n'
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
+
+def csv_cell(value):
+    """A CSV cell for value, defused if a spreadsheet would run it as a formula"""
+    if value is None:
+        return ''
+    if isinstance(value, str) and value.startswith(CSV_FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+def csv_response(rows, columns, filename):
+    """Stream an iterable of dicts as CSV, a chunk of rows at a time"""
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        # The header goes out at once, before the first batch is read
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+        try:
+            for count, row in enumerate(rows, 1):
+                writer.writerow([csv_cell(row.get(column)) for column in columns])
+                if count % CSV_CHUNK_ROWS == 0:
+                    yield buffer.getvalue().encode('utf-8')
+                    buffer.seek(0)
+                    buffer.truncate()
+        except Exception as e:
+            # Headers are already sent, so mark the file as cut short in-band
+            logger.error(f"Error streaming CSV: {e}")
+            writer.writerow(['ERROR', f"Export interrupted: {e}"])
+        yield buffer.getvalue().encode('utf-8')
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/csv',
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+    )
+
 # Flask app setup
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
 app.config['JWT_SECRET_KEY'] = os.getenv('JWT_SECRET_KEY')
-app.json_encoder = JSONEncoder
+app.json = FastJSONProvider(app)
+init_compression(app)
+init_tracing(app)
 
 # Setup CORS
 CORS(app, resources={
     r"/*": {
         "origins": "*",
         "methods": ["GET", "POST", "OPTIONS"],
-        "allow_headers": ["Content-Type", "Authorization"],
-        "expose_headers": ["Content-Type"]
+        "allow_headers": ["Content-Type", "Authorization", "Idempotency-Key", "traceparent"],
+        "expose_headers": ["Content-Type", "Content-Disposition", "Retry-After", "Idempotent-Replayed", "traceparent"]
     }
 })
 
 jwt = JWTManager(app)
 
+_background_started = False
+_background_lock = threading.Lock()
+
+def start_background_workers():
+    """Start this serving process's background threads, once.
+
+    Called by the entry points that serve requests (wsgi.py under gunicorn,
+    the __main__ block below) rather than on import, so processes that only
+    import the app (build pool processes, a standalone shard worker) don't
+    start a second set.
+    """
+    global _background_started
+    with _background_lock:
+        if _background_started:
+            return
+        _background_started = True
+    # Release scheduled campaigns from this worker process
+    get_timer().start()
+    # Resume delivery of mail spooled before a restart
+    get_outbox()
+    # Claim shards of distributed campaigns created by any process on any node
+    get_shard_worker().start()
+    # Rotate, compress and expire user logs in the background
+    start_log_maintenance()
+
+def rate_limit_identity():
+    """The JWT identity of the request, or the client address when it has none"""
+    try:
+        verify_jwt_in_request(optional=True)
+        user_id = get_jwt_identity()
+    except Exception:
+        # Invalid or expired tokens are rejected by the view itself
+        user_id = None
+    if user_id:
+        return f"user:{user_id}"
+    return f"ip:{request.remote_addr}"
+
+@app.before_request
+def enforce_rate_limit():
+    if not RATE_LIMIT_ENABLED or request.method == 'OPTIONS' or request.endpoint is None:
+        return None
+    try:
+        get_rate_limiter().check(rate_limit_identity(), request.endpoint)
+    except RateLimited as e:
+        # Drain the unread body, or the keep-alive connection stalls on it
+        request.get_data(cache=False)
+        response = jsonify({
+            'status': 'error',
+            'message': str(e)
+        })
+        response.status_code = 429
+        response.headers['Retry-After'] = str(max(1, math.ceil(e.retry_after)))
+        return response
+    except Exception as e:
+        # Never turn a limiter fault into an outage
+        logger.error(f"Rate limiter error: {e}")
+    return None
+
 @app.route('/smtp-settings', methods=['GET'])
 @jwt_required()
 def get_smtp_settings():
@@ -134,6 +308,39 @@ def save_smtp_settings():
                     'message': f'{field} is required'
                 }), 400
 
+        # Additional relays need the same connection fields as the primary one
+        relays = []
+        for relay in data.get('relays') or []:
+            missing = [field for field in required_fields if not relay.get(field)]
+            if missing:
+                return jsonify({
+                    'status': 'error',
+                    'message': f'relay {relay.get("smtp_server", "")} is missing {", ".join(missing)}'
+                }), 400
+            relays.append({
+                'smtp_server': relay['smtp_server'],
+                'smtp_port': int(relay['smtp_port']),
+                'username': relay['username'],
+                'password': relay['password'],
+                'weight': int(relay.get('weight', 1)),
+                'hourly_cap': int(relay.get('hourly_cap', 0))
+            })
+
+        if data.get('transport') and data['transport'] not in TRANSPORTS:
+            return jsonify({
+                'status': 'error',
+                'message': f'transport must be one of {", ".join(TRANSPORTS)}'
+            }), 400
+
+        if data.get('dkim_private_key'):
+            try:
+                load_private_key(data['dkim_private_key'])
+            except Exception:
+                return jsonify({
+                    'status': 'error',
+                    'message': 'dkim_private_key is not a valid unencrypted PEM private key'
+                }), 400
+
         settings = SmtpSettings.save_settings(
             user_id=user_id,
             smtp_server=data['smtp_server'],
@@ -141,7 +348,16 @@ def save_smtp_settings():
             username=data['username'],
             password=data['password'],
             sender_name=data.get('sender_name', ''),
-            delay=int(data.get('delay', 5))
+            delay=int(data.get('delay', 5)),
+            min_delay=float(data.get('min_delay', 0)),
+            max_delay=float(data.get('max_delay', 30)),
+            dkim_domain=data.get('dkim_domain') or None,
+            dkim_selector=data.get('dkim_selector') or None,
+            dkim_private_key=data.get('dkim_private_key') or None,
+            weight=int(data.get('weight', 1)),
+            hourly_cap=int(data.get('hourly_cap', 0)),
+            relays=relays,
+            transport=data.get('transport') or None
         )
 
         return jsonify({
@@ -201,8 +417,26 @@ def login():
             'message': 'An error occurred during login'
         }), 500
 
+def decode_attachments(raw_attachments):
+    """Decode the data-URL attachments of a campaign request"""
+    attachments = []
+    for attachment in raw_attachments or []:
+        try:
+            # Decode base64 content
+            file_content = base64.b64decode(attachment['content'].split(',')[1])
+            attachments.append({
+                'filename': attachment['name'],
+                'content': file_content,
+                'content_type': attachment['type']
+            })
+        except Exception as e:
+            logger.error(f"Error processing attachment {attachment.get('name')}: {e}")
+            raise ValueError(f'Error processing attachment {attachment.get("name")}')
+    return attachments
+
 @app.route('/send-emails', methods=['POST'])
 @jwt_required()
+@idempotent_send
 def send_emails():
     try:
         user_id = get_jwt_identity()
@@ -217,24 +451,30 @@ def send_emails():
                 'message': 'Emails, subject, and body are required'
             }), 400
 
+        priority = data.get('priority') or (
+            'bulk' if data.get('distributed') else DEFAULT_LANE
+        )
+        if priority not in LANES:
+            return jsonify({
+                'status': 'error',
+                'message': f"Invalid priority; use one of {', '.join(LANES)}"
+            }), 400
+
+        set_span_attributes({
+            'campaign.recipients': len(data['emails']),
+            'campaign.priority': priority,
+            'campaign.mode': next((mode for mode in ('send_at', 'window', 'spool', 'distributed', 'dry_run')
+                                   if data.get(mode)), 'direct')
+        })
+
         # Process attachments if present
-        attachments = []
-        if data.get('attachments'):
-            for attachment in data['attachments']:
-                try:
-                    # Decode base64 content
-                    file_content = base64.b64decode(attachment['content'].split(',')[1])
-                    attachments.append({
-                        'filename': attachment['name'],
-                        'content': file_content,
-                        'content_type': attachment['type']
-                    })
-                except Exception as e:
-                    logger.error(f"Error processing attachment {attachment.get('name')}: {e}")
-                    return jsonify({
-                        'status': 'error',
-                        'message': f'Error processing attachment {attachment.get("name")}'
-                    }), 400
+        try:
+            attachments = decode_attachments(data.get('attachments'))
+        except ValueError as e:
+            return jsonify({
+                'status': 'error',
+                'message': str(e)
+            }), 400
 
         # Get SMTP settings
         smtp_settings = SmtpSettings.get_by_user_id(user_id)
@@ -244,27 +484,124 @@ def send_emails():
                 'message': 'Please configure SMTP settings first'
             }), 400
 
-        # Initialize email sender with user_id
-        email_sender = EmailSender(smtp_settings, user_id)
-        
-        # Send emails with attachments
-        result = email_sender.send_bulk_emails(
+        # Campaigns with a send time or window are persisted and sent later
+        if data.get('send_at') or data.get('window'):
+            try:
+                send_at = parse_send_at(data['send_at']) if data.get('send_at') else datetime.utcnow()
+                SendWindow.from_dict(data.get('window'))
+            except Exception as e:
+                return jsonify({
+                    'status': 'error',
+                    'message': f'Invalid send_at or window: {e}'
+                }), 400
+
+            campaign = ScheduledCampaign(
+                user_id=user_id,
+                emails=data['emails'],
+                subject=data['subject'],
+                body=data['body'],
+                send_at=send_at,
+                attachments=attachments,
+                window=data.get('window'),
+                batch_recipients=bool(data.get('batch_recipients'))
+            ).save()
+            get_timer().schedule(campaign._id, send_at)
+
+            save_log(user_id, 'send_emails', f"Scheduled campaign {campaign._id} for {send_at.isoformat()}")
+            return jsonify({
+                'status': 'success',
+                'message': 'Campaign scheduled',
+                'campaign': campaign.to_dict()
+            }), 202
+
+        # Initialize email sender with user_id; dry runs go through the whole pipeline into a null sink
+        email_sender = EmailSender(
+            smtp_settings,
+            user_id,
+            transport=get_transport('null') if data.get('dry_run') else None
+        )
+
+        # Spooled campaigns are rendered to the durable outbox and delivered in the background
+        if data.get('spool'):
+            result = email_sender.spool_bulk_emails(
+                data['emails'],
+                data['subject'],
+                data['body'],
+                attachments,
+                batch_recipients=bool(data.get('batch_recipients')),
+                campaign_id=g.campaign_id
+            )
+            save_log(user_id, 'send_emails', f"Spooled campaign {result['campaign_id']}")
+            return jsonify({
+                'status': 'success',
+                'message': 'Campaign queued for delivery',
+                'details': result
+            }), 202
+
+        # Distributed campaigns are split into shards that every sender process claims
+        if data.get('distributed'):
+            result = create_sharded_campaign(
+                user_id,
+                data['emails'],
+                data['subject'],
+                data['body'],
+                attachments,
+                batch_recipients=bool(data.get('batch_recipients')),
+                priority=priority
+            )
+            save_log(user_id, 'send_emails', f"Created distributed campaign {result['campaign_id']}")
+            return jsonify({
+                'status': 'success',
+                'message': 'Campaign queued for delivery',
+                'details': result
+            }), 202
+
+        # Queue the send behind other tenants' campaigns and wait for it
+        bulk_send = BulkSend(
+            email_sender,
             email_list=data['emails'],
             subject=data['subject'],
             body_text=data['body'],
-            attachments=attachments
+            attachments=attachments,
+            batch_recipients=bool(data.get('batch_recipients')),
+            campaign_id=g.campaign_id
         )
+        try:
+            # Transactional sends overtake running bulk campaigns at the next message
+            job = get_scheduler().submit(user_id, bulk_send, lane=priority)
+        except TenantQuotaExceeded as e:
+            save_log(user_id, 'send_emails', f"Send rejected: {e}", 'warning')
+            return jsonify({
+                'status': 'error',
+                'message': str(e)
+            }), 429
+        result = job.wait()
 
         summary = f"Sent {result['success_count']} emails successfully, {result['failed_count']} failed"
         save_log(user_id, 'send_emails', summary)
-        
+
+        if wants_ndjson():
+            # One line per recipient, read back from the stored results, then the summary line
+            statuses = CampaignResult.iter_by_campaign(user_id, result['campaign_id'])
+            return ndjson_response(chain(statuses, [{
+                'status': 'success',
+                'message': summary,
+                'campaign_id': result['campaign_id'],
+                'successful': result['success_count'],
+                'failed': result['failed_count'],
+                'total': len(data['emails'])
+            }]))
+
         return jsonify({
             'status': 'success',
             'message': summary,
             'details': {
+                'campaign_id': result['campaign_id'],
                 'successful': result['success_count'],
                 'failed': result['failed_count'],
                 'total': len(data['emails']),
+                'send_rate_per_minute': result['summary'].get('send_rate_per_minute'),
+                'error_classes': result['summary'].get('error_classes'),
                 'errors': result.get('errors', [])
             }
         }), 200
@@ -277,26 +614,196 @@ def send_emails():
             'message': f'Failed to send emails: {error_message}'
         }), 500
 
+@app.route('/campaigns/<campaign_id>/results.csv', methods=['GET'])
+@jwt_required()
+def export_campaign_results(campaign_id):
+    try:
+        user_id = get_jwt_identity()
+        # Read lazily from a cursor, so memory stays flat however many recipients there are
+        results = CampaignResult.iter_by_campaign(user_id, campaign_id, batch_size=CSV_CHUNK_ROWS * 2)
+        if not CampaignStats.get(user_id, campaign_id):
+            # Stats may not be flushed yet; any stored result also proves the campaign exists
+            first = next(results, None)
+            if first is None:
+                return jsonify({
+                    'status': 'error',
+                    'message': 'Campaign not found'
+                }), 404
+            results = chain([first], results)
+
+        return csv_response(
+            results,
+            ['email', 'status', 'smtp_code', 'error', 'timestamp', 'time_taken'],
+            f"campaign-{campaign_id}-results.csv"
+        )
+
+    except Exception as e:
+        logger.error(f"Error exporting campaign results: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 500
+
+@app.route('/campaigns/preflight', methods=['POST'])
+@jwt_required()
+def campaign_preflight():
+    try:
+        user_id = get_jwt_identity()
+        data = request.json
+
+        if not data.get('emails') or not data.get('subject') or not data.get('body'):
+            return jsonify({
+                'status': 'error',
+                'message': 'Emails, subject, and body are required'
+            }), 400
+
+        try:
+            attachments = decode_attachments(data.get('attachments'))
+        except ValueError as e:
+            return jsonify({
+                'status': 'error',
+                'message': str(e)
+            }), 400
+
+        smtp_settings = SmtpSettings.get_by_user_id(user_id)
+        if not smtp_settings:
+            return jsonify({
+                'status': 'error',
+                'message': 'Please configure SMTP settings first'
+            }), 400
+
+        # Checks the relays and warms this worker's MX and message caches for the send
+        report = run_preflight(
+            EmailSender(smtp_settings, user_id),
+            data['emails'],
+            data['subject'],
+            data['body'],
+            attachments,
+            batch_recipients=bool(data.get('batch_recipients'))
+        )
+        save_log(user_id, 'preflight',
+                 f"Preflight for {len(data['emails'])} recipients: estimated {report['estimate']['seconds']}s",
+                 'info' if report['ok'] else 'warning',
+                 details={'relays': report['relays'], 'mx': report['mx']['counts']})
+
+        return jsonify({
+            'status': 'success',
+            'preflight': report
+        })
+
+    except Exception as e:
+        logger.error(f"Error running campaign preflight: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 500
+
+@app.route('/campaigns/scheduled', methods=['GET'])
+@jwt_required()
+def get_scheduled_campaigns():
+    try:
+        user_id = get_jwt_identity()
+        limit = request.args.get('limit', 100, type=int)
+
+        return jsonify({
+            'status': 'success',
+            'campaigns': ScheduledCampaign.get_by_user_id(user_id, limit)
+        })
+
+    except Exception as e:
+        logger.error(f"Error fetching scheduled campaigns: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 500
+
+@app.route('/campaigns/scheduled/<campaign_id>/cancel', methods=['POST'])
+@jwt_required()
+def cancel_scheduled_campaign(campaign_id):
+    try:
+        user_id = get_jwt_identity()
+
+        if not ScheduledCampaign.cancel(user_id, campaign_id):
+            return jsonify({
+                'status': 'error',
+                'message': 'Campaign not found or already started'
+            }), 404
+
+        save_log(user_id, 'send_emails', f"Cancelled scheduled campaign {campaign_id}")
+        return jsonify({
+            'status': 'success',
+            'message': 'Campaign cancelled'
+        })
+
+    except Exception as e:
+        logger.error(f"Error cancelling scheduled campaign: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 500
+
+@app.route('/campaigns/<campaign_id>/stats', methods=['GET'])
+@jwt_required()
+def get_campaign_stats(campaign_id):
+    try:
+        user_id = get_jwt_identity()
+        stats = CampaignStats.get(user_id, campaign_id)
+        if not stats:
+            return jsonify({
+                'status': 'error',
+                'message': 'Campaign not found'
+            }), 404
+
+        shards = CampaignShard.progress(campaign_id)
+        if any(shards['shards'].values()):
+            stats['shards'] = shards['shards']
+
+        return jsonify({
+            'status': 'success',
+            'stats': stats
+        })
+
+    except Exception as e:
+        logger.error(f"Error fetching campaign stats: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 500
+
+@app.route('/send-emails/progress', methods=['GET'])
+@jwt_required()
+def get_send_emails_progress():
+    try:
+        user_id = get_jwt_identity()
+        progress = get_send_progress(user_id)
+
+        return jsonify({
+            'status': 'success',
+            'progress': progress
+        })
+
+    except Exception as e:
+        logger.error(f"Error fetching send progress: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 500
+
 @app.route('/logs', methods=['GET'])
 @jwt_required()
 def get_logs():
     try:
         user_id = get_jwt_identity()
         limit = request.args.get('limit', 100, type=int)
-        
-        log_file = os.path.join(LOG_DIR, f"{user_id}.log")
-        logs = []
-        
-        if os.path.exists(log_file):
-            with open(log_file, 'r') as f:
-                logs = [json.loads(line) for line in f.readlines()]
-            
-            # Return only the latest logs based on limit
-            logs = sorted(logs, key=lambda x: x['timestamp'], reverse=True)[:limit]
-        
+
+        if wants_ndjson():
+            # limit=0 streams the whole log
+            logs = iter_user_logs(user_id)
+            return ndjson_response(islice(logs, limit) if limit > 0 else logs)
+
         return jsonify({
             'status': 'success',
-            'logs': logs
+            'logs': get_user_logs(user_id, limit)
         })
 
     except Exception as e:
@@ -313,6 +820,8 @@ def clear_logs():
         user_id = get_jwt_identity()
         log_file = os.path.join(LOG_DIR, f"{user_id}.log")
         
+        # Rotated segments too, or GET /logs would read them back
+        remove_archives(user_id)
         if os.path.exists(log_file):
             os.remove(log_file)
         
@@ -365,11 +874,18 @@ def register():
 def get_email_list():
     try:
         user_id = get_jwt_identity()
+
+        if wants_ndjson():
+            return ndjson_response(
+                {'email': email} for email in EmailList.iter_emails(user_id)
+            )
+
         email_list = EmailList.get_by_user_id(user_id)
         
         return jsonify({
             'status': 'success',
-            'emails': email_list.emails if email_list else []
+            'emails': email_list.emails if email_list else [],
+            'version': email_list.version if email_list else 0
         })
 
     except Exception as e:
@@ -397,7 +913,8 @@ def save_email_list():
         
         return jsonify({
             'status': 'success',
-            'message': 'Email list saved successfully'
+            'message': 'Email list saved successfully',
+            'version': email_list.version
         })
 
     except Exception as e:
@@ -407,6 +924,82 @@ def save_email_list():
             'message': str(e)
         }), 500
 
+@app.route('/email-list/sync', methods=['POST'])
+@jwt_required()
+def sync_email_list():
+    try:
+        user_id = get_jwt_identity()
+        data = request.json or {}
+        chunks = data.get('chunks')
+        hashes = data.get('hashes')
+
+        if not valid_chunk_count(chunks) or not isinstance(hashes, list) or len(hashes) != chunks:
+            return jsonify({
+                'status': 'error',
+                'message': f'Send one hash per chunk for a power-of-two chunk count up to {MAX_SYNC_CHUNKS}'
+            }), 400
+
+        # Only the chunks whose membership differs go back to the client
+        email_list = EmailList.get_by_user_id(user_id)
+        differing = differing_chunks(email_list.emails if email_list else [], chunks, hashes)
+
+        return jsonify({
+            'status': 'success',
+            'version': email_list.version if email_list else 0,
+            'chunks': chunks,
+            'differing': {str(index): emails for index, emails in differing.items()}
+        })
+
+    except Exception as e:
+        logger.error(f"Error syncing email list: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 500
+
+@app.route('/email-list/delta', methods=['POST'])
+@jwt_required()
+def apply_email_list_delta():
+    try:
+        user_id = get_jwt_identity()
+        data = request.json or {}
+        base_version = data.get('base_version')
+        add = [email.strip() for email in data.get('add') or [] if isinstance(email, str) and email.strip()]
+        remove = [email.strip() for email in data.get('remove') or [] if isinstance(email, str) and email.strip()]
+
+        if not isinstance(base_version, int) or base_version < 0:
+            return jsonify({
+                'status': 'error',
+                'message': 'base_version is required'
+            }), 400
+
+        if add or remove:
+            version = EmailList.apply_delta(user_id, base_version, add=add, remove=remove)
+        else:
+            version = EmailList.get_version(user_id)
+            version = version if version == base_version else None
+
+        if version is None:
+            # Someone else saved first: the client syncs against the new version and retries
+            return jsonify({
+                'status': 'error',
+                'message': 'Email list changed since base_version; sync and retry',
+                'version': EmailList.get_version(user_id)
+            }), 409
+
+        save_log(user_id, 'email_list', f"Applied email list delta: {len(add)} added, {len(remove)} removed")
+        return jsonify({
+            'status': 'success',
+            'version': version
+        })
+
+    except Exception as e:
+        logger.error(f"Error applying email list delta: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 500
+
 @app.route('/email-template', methods=['GET'])
 @jwt_required()
 def get_email_template():
@@ -488,6 +1081,9 @@ def after_request(response):
     return response
 
 if __name__ == '__main__':
+    # With debug on, the reloader's parent only watches files; the child it runs serves
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_workers()
     logger.info("Starting server on port 5000")
     app.run(
         host='0.0.0.0',
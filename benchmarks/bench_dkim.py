@@ -0,0 +1,91 @@
+"""Benchmark per-message DKIM signing overhead for a bulk send.
+
+Compares signing every message from scratch (build the MIME message, hash
+the whole body, sign) with the campaign path in email_utils.MessageTemplate,
+where the body is flattened and hashed once and each recipient only costs a
+header block and an RSA signature.
+
+    python benchmarks/bench_dkim.py [--messages 200] [--attachment-kb 1024]
+"""
+import argparse
+import os
+import sys
+import time
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from dkim_signer import DKIMSigner, body_hash  # noqa: E402
+from email_utils import EmailSender, MessageTemplate  # noqa: E402
+from message_builder import SMTP_POLICY  # noqa: E402
+
+
+class BenchSettings:
+    smtp_server = 'smtp.example.com'
+    smtp_port = 587
+    username = 'sender@example.com'
+    password = ''
+    sender_name = 'Bench'
+
+
+class QuietSender(EmailSender):
+    def log_message(self, message, level='info', details=None):
+        pass
+
+
+def generate_key_pem():
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption()
+    ).decode('ascii')
+
+
+def per_message(sender, signer, recipients, attachments):
+    """Build, hash and sign every message independently"""
+    for recipient in recipients:
+        msg = sender.build_bulk_message(recipient, 'Benchmark', '<p>Hello</p>' * 200, attachments)
+        header_bytes, _, body = msg.as_bytes(policy=SMTP_POLICY).partition(b'\r\n\r\n')
+        signer.sign(header_bytes, body_hash(body)) + header_bytes + b'\r\n' + body
+
+
+def templated(sender, signer, recipients, attachments):
+    """Build and hash the body once, then sign only headers per recipient"""
+    msg = sender.build_bulk_message('placeholder', 'Benchmark', '<p>Hello</p>' * 200, attachments)
+    template = MessageTemplate(msg, signer)
+    for recipient in recipients:
+        template.render(recipient)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--attachment-kb', type=int, default=1024)
+    args = parser.parse_args()
+
+    sender = QuietSender(BenchSettings(), 'bench')
+    signer = DKIMSigner('example.com', 'bench', generate_key_pem())
+    recipients = [f"user{i}@example.com" for i in range(args.messages)]
+    attachments = [{
+        'filename': 'report.pdf',
+        'content': os.urandom(args.attachment_kb * 1024),
+        'content_type': 'application/pdf'
+    }] if args.attachment_kb else None
+
+    print(f"{args.messages} messages, {args.attachment_kb} KiB attachment")
+    print(f"{'path':<14}{'total s':>10}{'ms/msg':>10}")
+    results = {}
+    for name, func in (('per-message', per_message), ('templated', templated)):
+        start = time.perf_counter()
+        func(sender, signer, recipients, attachments)
+        elapsed = time.perf_counter() - start
+        results[name] = elapsed
+        print(f"{name:<14}{elapsed:>10.2f}{elapsed / args.messages * 1000:>10.2f}")
+    print(f"speedup: {results['per-message'] / results['templated']:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
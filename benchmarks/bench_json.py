@@ -0,0 +1,95 @@
+"""Benchmark JSON encoding and response compression on a 50k-entry payload.
+
+Compares the stdlib encoder the app used before (json.dumps with a custom
+JSONEncoder) against json_provider.fast_dumps, then the size and CPU cost of
+gzip and brotli on the encoded body.
+
+    python benchmarks/bench_json.py [--entries 50000] [--repeat 5]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from compression import brotli, compress  # noqa: E402
+from json_provider import fast_dumps, orjson  # noqa: E402
+
+
+class StdlibJSONEncoder(json.JSONEncoder):
+    """Same behaviour as models.JSONEncoder, without importing the Mongo models"""
+
+    def default(self, obj):
+        if isinstance(obj, ObjectId):
+            return str(obj)
+        if isinstance(obj, datetime):
+            return obj.isoformat()
+        return super().default(obj)
+
+
+def build_payload(entries):
+    """A /logs-shaped response with ObjectIds and datetimes in every entry"""
+    start = datetime(2024, 1, 1)
+    return {
+        'status': 'success',
+        'logs': [
+            {
+                '_id': ObjectId(),
+                'timestamp': start + timedelta(seconds=i),
+                'action': 'email_sender',
+                'message': f"Successfully sent email to user{i}@example{i % 50}.com",
+                'level': 'info',
+                'details': {'email': f"user{i}@example{i % 50}.com", 'time_taken': f"{(i % 300) / 100:.2f}s"}
+            }
+            for i in range(entries)
+        ]
+    }
+
+
+def timed(func, repeat):
+    """Return (best seconds, result) over repeat runs"""
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--entries', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    payload = build_payload(args.entries)
+    print(f"Payload: {args.entries} entries, orjson={'yes' if orjson else 'no'}, brotli={'yes' if brotli else 'no'}")
+
+    stdlib_time, stdlib_body = timed(
+        lambda: json.dumps(payload, cls=StdlibJSONEncoder).encode('utf-8'), args.repeat)
+    fast_time, fast_body = timed(lambda: fast_dumps(payload), args.repeat)
+
+    print(f"{'encoder':<12}{'ms':>10}{'bytes':>14}")
+    print(f"{'stdlib':<12}{stdlib_time * 1000:>10.1f}{len(stdlib_body):>14,}")
+    print(f"{'fast':<12}{fast_time * 1000:>10.1f}{len(fast_body):>14,}")
+    print(f"encode speedup: {stdlib_time / fast_time:.1f}x")
+
+    print(f"\n{'encoding':<12}{'ms':>10}{'bytes':>14}{'ratio':>10}")
+    print(f"{'identity':<12}{0:>10.1f}{len(fast_body):>14,}{1:>10.2f}")
+    for encoding in ('gzip', 'br'):
+        if encoding == 'br' and brotli is None:
+            continue
+        compress_time, compressed = timed(lambda: compress(fast_body, encoding), args.repeat)
+        print(f"{encoding:<12}{compress_time * 1000:>10.1f}{len(compressed):>14,}"
+              f"{len(fast_body) / len(compressed):>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,418 @@
+"""HTTP load test of the API under the real gunicorn settings.
+
+Starts gunicorn with gunicorn_config.py (worker class, worker count and
+threads can be overridden from the command line), a Mongo stand-in and a
+local LMTP sink that every virtual user's SMTP settings point at. Each
+virtual user registers, logs in and then loops over a weighted mix of
+endpoints until the run ends; throughput, latency percentiles and error
+rates are reported per endpoint.
+
+    pip install gunicorn mongomock
+    python benchmarks/load_test.py --users 20 --duration 60
+    python benchmarks/load_test.py --mongo mongod --workers 4 --worker-class gthread --threads 8
+
+mongomock keeps its data in each worker's memory, so it only works with
+--workers 1 and without max_requests worker recycling; use --mongo mongod (a throwaway local mongod) or --mongo-uri to
+load-test several workers. --url skips starting anything and targets a
+server that is already running.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import shutil
+import socket
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# (name, default weight) of every operation a virtual user performs
+OPERATIONS = [
+    ('POST /login', 1),
+    ('GET /smtp-settings', 2),
+    ('POST /smtp-settings', 1),
+    ('GET /email-list', 2),
+    ('POST /email-list', 1),
+    ('GET /email-template', 2),
+    ('POST /email-template', 1),
+    ('GET /logs', 3),
+    ('POST /send-emails', 1),
+]
+
+
+class LMTPSink(socketserver.ThreadingTCPServer):
+    """Accepts every message over LMTP and only counts them"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), LMTPHandler)
+        self.messages = 0
+        self.recipients = 0
+        self.lock = threading.Lock()
+
+    def count(self, recipients):
+        with self.lock:
+            self.messages += 1
+            self.recipients += recipients
+
+
+class LMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        self.reply('220 load-test sink LMTP')
+        recipients = 0
+        for raw in self.rfile:
+            command = raw.decode('utf-8', 'replace').strip().upper()
+            if command.startswith('LHLO') or command.startswith('EHLO'):
+                self.reply('250-load-test sink')
+                self.reply('250 PIPELINING')
+            elif command.startswith('MAIL'):
+                recipients = 0
+                self.reply('250 OK')
+            elif command.startswith('RCPT'):
+                recipients += 1
+                self.reply('250 OK')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                for line in self.rfile:
+                    if line == b'.\r\n':
+                        break
+                self.server.count(recipients)
+                for _ in range(recipients):
+                    self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('250 OK')
+
+
+class Recorder:
+    """Latencies and failures per endpoint, shared by every virtual user"""
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.statuses = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, latency, status):
+        with self.lock:
+            self.latencies.setdefault(name, []).append(latency)
+            if status is None or status >= 400:
+                self.errors[name] = self.errors.get(name, 0) + 1
+            key = (name, status or 'conn')
+            self.statuses[key] = self.statuses.get(key, 0) + 1
+
+
+class VirtualUser(threading.Thread):
+    def __init__(self, index, base_url, recorder, args, sink_port, deadline):
+        super().__init__(name=f"vu-{index}", daemon=True)
+        self.index = index
+        self.recorder = recorder
+        self.args = args
+        self.sink_port = sink_port
+        self.deadline = deadline
+        self.random = random.Random(index)
+        url = urlsplit(base_url)
+        self.conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=args.timeout)
+        self.email = f"vu{index}-{uuid.uuid4().hex[:8]}@loadtest.example"
+        self.password = 'load-test-password'
+        self.token = None
+
+    def request(self, name, method, path, body=None, record=True):
+        headers = {'Content-Type': 'application/json'}
+        if self.token:
+            headers['Authorization'] = f"Bearer {self.token}"
+        start = time.perf_counter()
+        try:
+            self.conn.request(method, path, body=json.dumps(body) if body is not None else None, headers=headers)
+            response = self.conn.getresponse()
+            data = response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            self.conn.close()
+            data, status = b'', None
+        if record:
+            self.recorder.record(name, time.perf_counter() - start, status)
+        return status, data
+
+    def login(self, record=True):
+        status, data = self.request('POST /login', 'POST', '/login',
+                                    {'email': self.email, 'password': self.password}, record)
+        if status == 200:
+            self.token = json.loads(data)['token']
+
+    def setup(self):
+        self.request('POST /register', 'POST', '/register', {'email': self.email, 'password': self.password}, False)
+        self.login(record=False)
+        self.save_settings(record=False)
+
+    def save_settings(self, record=True):
+        self.request('POST /smtp-settings', 'POST', '/smtp-settings', {
+            'smtp_server': '127.0.0.1',
+            'smtp_port': self.sink_port,
+            'username': self.email,
+            'password': 'unused',
+            'sender_name': f"Load test {self.index}",
+            'delay': 0,
+            'min_delay': 0,
+            'transport': self.args.transport
+        }, record)
+
+    def recipients(self, count):
+        return [f"user{self.random.randrange(10 ** 6)}@example{n % 20}.test" for n in range(count)]
+
+    def run_operation(self, name):
+        if name == 'POST /login':
+            self.login()
+        elif name == 'POST /smtp-settings':
+            self.save_settings()
+        elif name == 'POST /email-list':
+            self.request(name, 'POST', '/email-list', {'emails': self.recipients(self.args.list_size)})
+        elif name == 'POST /email-template':
+            self.request(name, 'POST', '/email-template', {
+                'name': 'Load test',
+                'subject': 'Load test',
+                'body': '<p>Hello from the load test</p>' * 20
+            })
+        elif name == 'POST /send-emails':
+            self.request(name, 'POST', '/send-emails', {
+                'emails': self.recipients(self.args.recipients),
+                'subject': 'Load test',
+                'body': '<p>Hello from the load test</p>' * 20,
+                'batch_recipients': self.args.batch_recipients
+            })
+        else:
+            method, path = name.split(' ', 1)
+            self.request(name, method, path)
+
+    def run(self):
+        self.setup()
+        names = [name for name, _ in self.args.mix]
+        weights = [weight for _, weight in self.args.mix]
+        while time.monotonic() < self.deadline:
+            self.run_operation(self.random.choices(names, weights)[0])
+            if self.args.think_time:
+                time.sleep(self.random.expovariate(1.0 / self.args.think_time))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout, process=None):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"{process.args[0]} exited with status {process.returncode}")
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Nothing is listening on port {port} after {timeout}s")
+
+
+def start_mongod(workdir):
+    port = free_port()
+    dbpath = os.path.join(workdir, 'mongod')
+    os.makedirs(dbpath)
+    process = subprocess.Popen(
+        ['mongod', '--dbpath', dbpath, '--port', str(port), '--bind_ip', '127.0.0.1', '--quiet'],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    wait_for_port(port, 30, process)
+    return process, f"mongodb://127.0.0.1:{port}/"
+
+
+def start_server(args, workdir, mongo_uri):
+    port = free_port()
+    env = dict(os.environ)
+    env.update({
+        'MONGODB_URI': mongo_uri or 'mongodb://mongomock.invalid/',
+        'JWT_SECRET_KEY': env.get('JWT_SECRET_KEY', uuid.uuid4().hex * 2),
+        'SECRET_KEY': env.get('SECRET_KEY', uuid.uuid4().hex),
+        'DATA_DIR': workdir,
+    })
+    # Measure the API rather than the default per-domain pacing
+    env.setdefault('DOMAIN_RATE_LIMIT', '0')
+    if args.mongo == 'mongomock':
+        env['LOADTEST_MONGOMOCK'] = '1'
+
+    command = [
+        sys.executable, '-m', 'gunicorn',
+        '-c', os.path.join(ROOT, 'gunicorn_config.py'),
+        '--pythonpath', f"{os.path.join(ROOT, 'benchmarks')},{ROOT}",
+        '--bind', f"127.0.0.1:{port}",
+    ]
+    if args.workers:
+        command += ['--workers', str(args.workers)]
+    if args.worker_class:
+        command += ['--worker-class', args.worker_class]
+    if args.threads:
+        command += ['--threads', str(args.threads)]
+    if args.mongo == 'mongomock':
+        # A recycled worker would come back with an empty database
+        command += ['--max-requests', '0']
+    command.append('loadtest_app:app')
+
+    log = open(os.path.join(workdir, 'server.log'), 'wb')
+    # The app writes logs/ and outbox/ relative to its working directory
+    process = subprocess.Popen(command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    wait_for_port(port, 60, process)
+    return process, f"http://127.0.0.1:{port}"
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def summarize(recorder, elapsed):
+    rows = []
+    all_latencies = []
+    total_errors = 0
+    for name in sorted(recorder.latencies):
+        latencies = sorted(recorder.latencies[name])
+        errors = recorder.errors.get(name, 0)
+        all_latencies.extend(latencies)
+        total_errors += errors
+        rows.append(summary_row(name, latencies, errors, elapsed))
+    rows.append(summary_row('total', sorted(all_latencies), total_errors, elapsed))
+    return rows
+
+
+def summary_row(name, latencies, errors, elapsed):
+    count = len(latencies)
+    return {
+        'endpoint': name,
+        'requests': count,
+        'rps': round(count / elapsed, 2) if elapsed else 0.0,
+        'error_rate': round(errors / count, 4) if count else 0.0,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 1),
+        'p90_ms': round(percentile(latencies, 0.90) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+        'max_ms': round((latencies[-1] if latencies else 0.0) * 1000, 1),
+    }
+
+
+def print_report(rows, recorder, elapsed, sink):
+    print(f"\n{elapsed:.1f}s elapsed")
+    print(f"{'endpoint':<22}{'reqs':>8}{'req/s':>9}{'err%':>7}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    for row in rows:
+        print(
+            f"{row['endpoint']:<22}{row['requests']:>8}{row['rps']:>9.1f}{row['error_rate'] * 100:>7.1f}"
+            f"{row['p50_ms']:>9.1f}{row['p90_ms']:>9.1f}{row['p99_ms']:>9.1f}{row['max_ms']:>9.1f}"
+        )
+    failures = {f"{name} -> {status}": count for (name, status), count in sorted(recorder.statuses.items(), key=str)
+                if status == 'conn' or status >= 400}
+    if failures:
+        print("\nfailed responses:")
+        for key, count in failures.items():
+            print(f"  {key}: {count}")
+    if sink is not None:
+        print(f"\nsink received {sink.messages} messages for {sink.recipients} recipients")
+
+
+def parse_mix(value):
+    weights = dict(OPERATIONS)
+    for item in filter(None, value.split(',')):
+        name, _, weight = item.rpartition('=')
+        if name not in weights:
+            raise argparse.ArgumentTypeError(f"unknown operation {name!r}")
+        weights[name] = float(weight)
+    return [(name, weight) for name, weight in weights.items() if weight > 0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=10, help='concurrent virtual users')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to run after set-up')
+    parser.add_argument('--think-time', type=float, default=0, help='mean pause between requests per user')
+    parser.add_argument('--timeout', type=float, default=300, help='per-request timeout')
+    parser.add_argument('--workers', type=int, help='override gunicorn_config.py workers')
+    parser.add_argument('--worker-class', help='override gunicorn_config.py worker_class')
+    parser.add_argument('--threads', type=int, help='override gunicorn_config.py threads')
+    parser.add_argument('--mongo', choices=['mongomock', 'mongod', 'uri'], default='mongomock')
+    parser.add_argument('--mongo-uri', help='database to use with --mongo uri')
+    parser.add_argument('--transport', default='lmtp', help='mail transport of the virtual users: lmtp (to the sink) or null')
+    parser.add_argument('--recipients', type=int, default=10, help='recipients per /send-emails request')
+    parser.add_argument('--batch-recipients', action='store_true', help='send multi-recipient transactions')
+    parser.add_argument('--list-size', type=int, default=500, help='addresses per /email-list upload')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(''),
+                        help="weights, e.g. 'GET /logs=5,POST /send-emails=0'")
+    parser.add_argument('--url', help='target an already running server instead of starting one')
+    parser.add_argument('--json', help='also write the per-endpoint results to this file')
+    args = parser.parse_args()
+
+    if args.mongo == 'mongomock' and not args.url and (args.workers or 0) != 1:
+        # Every worker would get its own empty in-memory database
+        args.workers = 1
+        print("mongomock is per process: running a single gunicorn worker (use --mongo mongod for more)")
+    if args.mongo == 'uri' and not args.mongo_uri:
+        parser.error('--mongo uri needs --mongo-uri')
+
+    workdir = tempfile.mkdtemp(prefix='load-test-')
+    processes = []
+    sink = LMTPSink()
+    threading.Thread(target=sink.serve_forever, daemon=True).start()
+    try:
+        base_url = args.url
+        if not base_url:
+            mongo_uri = args.mongo_uri
+            if args.mongo == 'mongod':
+                mongod, mongo_uri = start_mongod(workdir)
+                processes.append(mongod)
+            server, base_url = start_server(args, workdir, mongo_uri)
+            processes.append(server)
+            print(f"server at {base_url}, output in {os.path.join(workdir, 'server.log')}")
+
+        recorder = Recorder()
+        deadline = time.monotonic() + args.duration
+        users = [
+            VirtualUser(index, base_url, recorder, args, sink.server_address[1], deadline)
+            for index in range(args.users)
+        ]
+        start = time.monotonic()
+        for user in users:
+            user.start()
+        for user in users:
+            user.join()
+        elapsed = time.monotonic() - start
+
+        rows = summarize(recorder, elapsed)
+        print_report(rows, recorder, elapsed, sink if args.transport == 'lmtp' else None)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'args': {k: v for k, v in vars(args).items() if k != 'mix'}, 'results': rows}, f, indent=2)
+    finally:
+        sink.shutdown()
+        for process in reversed(processes):
+            process.terminate()
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if processes:
+            shutil.copy(os.path.join(workdir, 'server.log'), os.path.join(tempfile.gettempdir(), 'load-test-server.log'))
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,28 @@
+"""WSGI entry point used by benchmarks/load_test.py.
+
+Loads the real app. With LOADTEST_MONGOMOCK=1 the Mongo client is swapped
+for an in-memory mongomock client before models.py connects; mongomock has
+no collMod, so the server-side schema validators are skipped.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+if os.getenv('LOADTEST_MONGOMOCK'):
+    import mongomock
+    import pymongo
+
+    pymongo.MongoClient = mongomock.MongoClient
+    _command = mongomock.database.Database.command
+
+    def _command_without_collmod(self, command, *args, **kwargs):
+        if isinstance(command, dict) and 'collMod' in command:
+            return {'ok': 1.0}
+        return _command(self, command, *args, **kwargs)
+
+    mongomock.database.Database.command = _command_without_collmod
+
+from app import app, start_background_workers  # noqa: E402,F401
+
+start_background_workers()
@@ -0,0 +1,176 @@
+import logging
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import resource_tracker, shared_memory
+
+import message_builder
+
+logger = logging.getLogger(__name__)
+
+# Processes per gunicorn worker that build messages, started on first use; 0 builds in the calling thread.
+# Every one of gunicorn's 2 x cores + 1 workers gets its own pool, so the total is that many times this:
+# one each already spreads builds over all cores, and more would oversubscribe them
+BUILD_POOL_WORKERS = int(os.getenv('BUILD_POOL_WORKERS', 1))
+# Messages whose body and attachments are smaller than this are built in-process,
+# where they cost less than the round trip to a pool process
+BUILD_POOL_MIN_BYTES = int(os.getenv('BUILD_POOL_MIN_BYTES', 256 * 1024))
+# Payloads at least this large cross between processes in shared memory instead of a pipe
+BUILD_SHM_MIN_BYTES = int(os.getenv('BUILD_SHM_MIN_BYTES', 1024 * 1024))
+# Recipients whose DKIM-signed headers one pool task renders
+BUILD_RENDER_BATCH = int(os.getenv('BUILD_RENDER_BATCH', 256))
+
+
+class SharedBytes:
+    """Bytes parked in shared memory by one process for another to take.
+
+    Only the small handle is pickled. The segment belongs to whoever takes
+    it: take() copies the bytes out and unlinks it, so the creator's
+    resource tracker is told to leave it alone.
+    """
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+
+    @classmethod
+    def put(cls, data):
+        shm = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+        shm.buf[:len(data)] = data
+        shm.close()
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return cls(shm.name, len(data))
+
+    def take(self):
+        shm = shared_memory.SharedMemory(name=self.name)
+        try:
+            return bytes(shm.buf[:self.size])
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def discard(self):
+        """Unlink a segment nobody took, e.g. after the task using it failed"""
+        try:
+            self.take()
+        except FileNotFoundError:
+            pass
+
+
+def share(data):
+    """data itself when small, else a SharedBytes handle to it"""
+    return SharedBytes.put(data) if len(data) >= BUILD_SHM_MIN_BYTES else data
+
+
+def unshare(value):
+    return value.take() if isinstance(value, SharedBytes) else value
+
+
+def _encode_task(sender_name, username, subject, body_text, attachments, signed):
+    # Runs in a pool process
+    attachments = [dict(attachment, content=unshare(attachment['content'])) for attachment in attachments]
+    header_bytes, body, bh, failed = message_builder.encode_bulk_message(
+        sender_name, username, subject, body_text, attachments, signed
+    )
+    return header_bytes, share(body), bh, failed
+
+
+class BuildPool:
+    """Builds messages in worker processes, off the GIL of the threads doing SMTP I/O.
+
+    Flattening MIME, base64-encoding attachments and DKIM-signing headers are
+    CPU-bound; here they run in separate processes that return finished
+    bytes, large ones through shared memory, and scale across cores. Small
+    messages, or BUILD_POOL_WORKERS=0, are built inline, and a pool that
+    breaks is replaced on next use while the failed call builds inline.
+    """
+
+    def __init__(self, workers=BUILD_POOL_WORKERS):
+        self.workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                # forkserver children start from a clean process rather than a copy of this threaded one
+                method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+                context = multiprocessing.get_context(method)
+                if method == 'forkserver':
+                    # The server preloads just the builder, not the app's __main__
+                    context.set_forkserver_preload(['message_builder'])
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=context)
+            return self._executor
+
+    def _reset(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def encode_bulk_message(self, sender_name, username, subject, body_text, attachments=None, signed=False):
+        """A campaign's header block, body, DKIM body hash and failed attachments"""
+        attachments = attachments or []
+        size = len(body_text) + sum(len(attachment['content']) for attachment in attachments)
+        if not self.workers or size < BUILD_POOL_MIN_BYTES:
+            return message_builder.encode_bulk_message(sender_name, username, subject, body_text, attachments, signed)
+
+        shared = [dict(attachment, content=share(attachment['content'])) for attachment in attachments]
+        executor = self._pool()
+        try:
+            header_bytes, body, bh, failed = executor.submit(
+                _encode_task, sender_name, username, subject, body_text, shared, signed
+            ).result()
+            return header_bytes, unshare(body), bh, failed
+        except BrokenProcessPool as e:
+            logger.error(f"Message build pool broke, building in-process: {e}")
+            self._reset(executor)
+            for attachment in shared:
+                if isinstance(attachment['content'], SharedBytes):
+                    attachment['content'].discard()
+            return message_builder.encode_bulk_message(sender_name, username, subject, body_text, attachments, signed)
+
+    def sign_headers(self, header_bytes, recipients, dkim, bh):
+        """Yield each recipient's signed header block, in order, batches signed in parallel"""
+        batches = [recipients[start:start + BUILD_RENDER_BATCH]
+                   for start in range(0, len(recipients), BUILD_RENDER_BATCH)]
+        if not self.workers or len(batches) < 2:
+            for batch in batches:
+                yield from message_builder.sign_headers_batch(header_bytes, batch, dkim, bh)
+            return
+
+        executor = self._pool()
+        # A bounded window of batches in flight keeps memory flat for any list size
+        window = deque()
+        submitted = 0
+        try:
+            while submitted < len(batches) or window:
+                while submitted < len(batches) and len(window) < self.workers * 2:
+                    window.append(executor.submit(
+                        message_builder.sign_headers_batch, header_bytes, batches[submitted], dkim, bh
+                    ))
+                    submitted += 1
+                yield from window[0].result()
+                window.popleft()
+        except BrokenProcessPool as e:
+            logger.error(f"Message build pool broke, signing in-process: {e}")
+            self._reset(executor)
+            # Everything not yet yielded: the batches still in the window and those never submitted
+            for batch in batches[submitted - len(window):]:
+                yield from message_builder.sign_headers_batch(header_bytes, batch, dkim, bh)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_build_pool():
+    """Return this process's build pool; its processes start after the gunicorn fork, on first use"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = BuildPool()
+        return _pool
@@ -0,0 +1,118 @@
+import logging
+import os
+import threading
+import time
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+# Seconds between flushes of buffered counters to Mongo
+STATS_FLUSH_INTERVAL = float(os.getenv('STATS_FLUSH_INTERVAL', 5))
+
+
+def stat_key(name):
+    """Escape a domain for use as a field name, as '.' and '$' are special in updates"""
+    return str(name).replace('%', '%25').replace('.', '%2E').replace('$', '%24')
+
+
+def unstat_key(key):
+    return key.replace('%2E', '.').replace('%24', '$').replace('%25', '%')
+
+
+class StatsBuffer:
+    """Campaign counters buffered in memory and flushed as batched $inc updates.
+
+    The send engine bumps counters per recipient; a background thread folds
+    everything recorded since the last flush into one $inc per campaign, so
+    Mongo sees a handful of writes per interval no matter the send rate.
+    """
+
+    def __init__(self, flush_interval=STATS_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    def record(self, campaign_id, domain, status, smtp_code=None, count=1):
+        """Count count recipients of a campaign as success, failed or deferred"""
+        code = str(smtp_code) if smtp_code is not None else 'other'
+        with self._lock:
+            fields = self._pending.setdefault(campaign_id, Counter())
+            fields[f"counts.{status}"] += count
+            fields[f"domains.{stat_key(domain)}.{status}"] += count
+            fields[f"codes.{code}"] += count
+            self._start()
+
+    def start_campaign(self, campaign_id, user_id, total, subject=None):
+        from models import CampaignStats  # Imported lazily so sending works without Mongo
+
+        try:
+            CampaignStats.start(campaign_id, user_id, total, subject)
+        except Exception as e:
+            logger.error(f"Error starting campaign stats: {e}")
+
+    def record_delivered(self, campaign_id, success, failed):
+        """Count finished recipients straight to Mongo, so progress outlives this process.
+
+        Returns the campaign's total and delivered counts, or None when Mongo
+        couldn't be updated.
+        """
+        from models import CampaignStats  # Imported lazily so sending works without Mongo
+
+        try:
+            return CampaignStats.record_delivered(campaign_id, success, failed)
+        except Exception as e:
+            logger.error(f"Error counting delivered recipients: {e}")
+            return None
+
+    def finish_campaign(self, campaign_id, status):
+        """Flush the campaign's last counters and mark it finished"""
+        from models import CampaignStats  # Imported lazily so sending works without Mongo
+
+        self.flush()
+        try:
+            CampaignStats.finish(campaign_id, status)
+        except Exception as e:
+            logger.error(f"Error finishing campaign stats: {e}")
+
+    def flush(self):
+        from models import CampaignStats  # Imported lazily so sending works without Mongo
+
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            try:
+                CampaignStats.increment_many({campaign_id: dict(fields) for campaign_id, fields in pending.items()})
+            except Exception as e:
+                logger.error(f"Error flushing campaign stats: {e}")
+                # Keep the counts for the next flush rather than losing them
+                with self._lock:
+                    for campaign_id, fields in pending.items():
+                        self._pending.setdefault(campaign_id, Counter()).update(fields)
+
+    def _start(self):
+        # Started lazily so the thread is created in each forked gunicorn worker
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='campaign-stats', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+
+_stats = None
+_stats_lock = threading.Lock()
+
+
+def get_stats():
+    """Return this process's StatsBuffer"""
+    global _stats
+    with _stats_lock:
+        if _stats is None:
+            _stats = StatsBuffer()
+        return _stats
@@ -0,0 +1,214 @@
+import heapq
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+from dateutil import parser as date_parser
+
+from email_utils import EmailSender, BulkSend
+from fair_scheduler import get_scheduler, TenantQuotaExceeded
+from models import ScheduledCampaign, SmtpSettings
+
+logger = logging.getLogger(__name__)
+
+# How often to pick up campaigns scheduled by other worker processes
+RESYNC_INTERVAL = int(os.getenv('SCHEDULE_RESYNC_INTERVAL', 300))
+# Retry delay when a tenant is over its quota at release time
+QUOTA_RETRY_DELAY = 60
+
+
+def parse_send_at(value):
+    """Parse an ISO 8601 send time into a naive UTC datetime"""
+    send_at = date_parser.isoparse(value)
+    if send_at.tzinfo is not None:
+        send_at = send_at.astimezone(timezone.utc).replace(tzinfo=None)
+    return send_at
+
+
+def to_epoch(utc_datetime):
+    return utc_datetime.replace(tzinfo=timezone.utc).timestamp()
+
+
+class SendWindow:
+    """Daily local-time window, e.g. 08:00-18:00 Europe/Berlin, that sends may run in"""
+
+    def __init__(self, start='08:00', end='18:00', tz='UTC'):
+        self.start = datetime.strptime(start, '%H:%M').time()
+        self.end = datetime.strptime(end, '%H:%M').time()
+        self.tz = ZoneInfo(tz)
+
+    @classmethod
+    def from_dict(cls, window):
+        if not window:
+            return None
+        return cls(window.get('start', '08:00'), window.get('end', '18:00'), window.get('timezone', 'UTC'))
+
+    def is_open(self, local_time):
+        if self.start <= self.end:
+            return self.start <= local_time < self.end
+        # Overnight window such as 22:00-06:00
+        return local_time >= self.start or local_time < self.end
+
+    def seconds_until_open(self, now=None):
+        """0 while the window is open, otherwise seconds until it next opens"""
+        now = now or datetime.now(timezone.utc)
+        local_now = now.astimezone(self.tz)
+        if self.is_open(local_now.time()):
+            return 0.0
+
+        opens = datetime.combine(local_now.date(), self.start, tzinfo=self.tz)
+        if opens <= local_now:
+            opens = datetime.combine(local_now.date() + timedelta(days=1), self.start, tzinfo=self.tz)
+        return (opens - local_now).total_seconds()
+
+
+class CampaignTimer:
+    """Release scheduled campaigns to the fair scheduler when they fall due.
+
+    Pending campaigns sit in an in-memory heap of (due time, id) loaded from
+    Mongo once at start-up, so an idle process only sleeps until the earliest
+    due time instead of polling. Campaigns scheduled in this process are
+    pushed straight onto the heap and an infrequent resync picks up those
+    created by other workers. Claiming is atomic in Mongo, so a campaign
+    known to several processes still runs once.
+    """
+
+    def __init__(self, resync_interval=RESYNC_INTERVAL):
+        self.resync_interval = resync_interval
+        self._heap = []
+        self._known = set()
+        self._lock = threading.Condition()
+        self._thread = None
+        self._next_resync = 0.0
+
+    def start(self):
+        """Load pending campaigns and start the timer thread, once per process"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='campaign-timer', daemon=True)
+            self._thread.start()
+
+    def schedule(self, campaign_id, send_at):
+        """Add a campaign due at a naive UTC datetime"""
+        self._push(campaign_id, to_epoch(send_at))
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._heap)
+
+    def _push(self, campaign_id, due):
+        with self._lock:
+            if campaign_id in self._known:
+                return
+            self._known.add(campaign_id)
+            heapq.heappush(self._heap, (due, campaign_id))
+            self._lock.notify()
+
+    def _resync(self, due_before=None):
+        try:
+            for campaign_id, send_at in ScheduledCampaign.iter_pending(due_before):
+                self._push(campaign_id, to_epoch(send_at))
+        except Exception as e:
+            logger.error(f"Error loading scheduled campaigns: {e}")
+        self._next_resync = time.time() + self.resync_interval
+
+    def _run(self):
+        self._resync()
+        while True:
+            with self._lock:
+                now = time.time()
+                due = []
+                while self._heap and self._heap[0][0] <= now:
+                    _, campaign_id = heapq.heappop(self._heap)
+                    self._known.discard(campaign_id)
+                    due.append(campaign_id)
+                if not due and now < self._next_resync:
+                    wait = self._next_resync - now
+                    if self._heap:
+                        wait = min(wait, self._heap[0][0] - now)
+                    self._lock.wait(wait)
+                    continue
+
+            for campaign_id in due:
+                self._release(campaign_id)
+            if time.time() >= self._next_resync:
+                # Only campaigns due before the next resync need to be known now
+                self._resync(datetime.utcnow() + timedelta(seconds=self.resync_interval))
+
+    def _release(self, campaign_id):
+        try:
+            campaign = ScheduledCampaign.claim(campaign_id)
+            if campaign is None:
+                return
+
+            window = SendWindow.from_dict(campaign.window)
+            wait = window.seconds_until_open() if window else 0
+            if wait > 0:
+                # Outside the sending window: put it back until the window opens
+                self._reschedule(campaign, wait)
+                return
+
+            user_id = str(campaign.user_id)
+            settings = SmtpSettings.get_by_user_id(user_id)
+            if not settings:
+                self._finish(campaign, 'failed', {'error': 'SMTP settings not configured'})
+                return
+
+            bulk_send = BulkSend(
+                EmailSender(settings, user_id),
+                email_list=campaign.emails,
+                subject=campaign.subject,
+                body_text=campaign.body,
+                attachments=campaign.attachments,
+                batch_recipients=campaign.batch_recipients,
+                window=window,
+                campaign_id=str(campaign._id)
+            )
+            try:
+                job = get_scheduler().submit(user_id, bulk_send)
+            except TenantQuotaExceeded:
+                self._reschedule(campaign, QUOTA_RETRY_DELAY)
+                return
+            job.add_done_callback(lambda job: self._on_done(campaign, job))
+
+        except Exception as e:
+            logger.error(f"Error releasing scheduled campaign {campaign_id}: {e}")
+
+    def _reschedule(self, campaign, delay):
+        send_at = datetime.utcnow() + timedelta(seconds=delay)
+        ScheduledCampaign.reschedule(campaign._id, send_at)
+        self.schedule(campaign._id, send_at)
+
+    def _on_done(self, campaign, job):
+        if job.error is not None:
+            self._finish(campaign, 'failed', {'error': str(job.error)})
+        else:
+            self._finish(campaign, 'sent', {
+                'successful': job.result['success_count'],
+                'failed': job.result['failed_count'],
+                'total': len(campaign.emails)
+            })
+
+    def _finish(self, campaign, status, result):
+        from app import save_log  # Import here to avoid circular imports
+        ScheduledCampaign.mark_finished(campaign._id, status, result)
+        save_log(str(campaign.user_id), 'scheduled_campaign',
+                 f"Scheduled campaign {campaign._id} {status}", 'info' if status == 'sent' else 'error',
+                 details=result)
+
+
+_timer = None
+_timer_lock = threading.Lock()
+
+
+def get_timer():
+    """Return this process's CampaignTimer"""
+    global _timer
+    with _timer_lock:
+        if _timer is None:
+            _timer = CampaignTimer()
+        return _timer
@@ -0,0 +1,60 @@
+import gzip
+import os
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - gzip only
+    brotli = None
+
+# Responses smaller than this are sent as-is; compressing them costs more than it saves
+COMPRESSION_MIN_SIZE = int(os.getenv('COMPRESSION_MIN_SIZE', 1024))
+COMPRESSION_LEVEL = int(os.getenv('COMPRESSION_LEVEL', 6))
+BROTLI_QUALITY = int(os.getenv('BROTLI_QUALITY', 5))
+COMPRESSIBLE_TYPES = ('application/json', 'text/')
+
+
+def compress(data, encoding, level=COMPRESSION_LEVEL):
+    """Compress bytes with the given content-coding ('br' or 'gzip')"""
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=level)
+
+
+def choose_encoding(accept_encodings):
+    """Pick the best content-coding the client accepts, or None"""
+    if brotli is not None and accept_encodings['br']:
+        return 'br'
+    if accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+
+def init_compression(app, min_size=COMPRESSION_MIN_SIZE, level=COMPRESSION_LEVEL):
+    """Compress large JSON/text responses according to Accept-Encoding"""
+
+    @app.after_request
+    def compress_response(response):
+        if (response.status_code < 200 or response.status_code >= 300
+                or response.direct_passthrough or response.is_streamed
+                or 'Content-Encoding' in response.headers
+                or not (response.mimetype or '').startswith(COMPRESSIBLE_TYPES)):
+            return response
+
+        response.vary.add('Accept-Encoding')
+        if response.content_length is not None and response.content_length < min_size:
+            return response
+
+        encoding = choose_encoding(request.accept_encodings)
+        if encoding is None:
+            return response
+
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+
+        response.set_data(compress(data, encoding, level))
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+    return app
@@ -0,0 +1,16 @@
+import os
+
+# Runtime state the app writes: outbox spool, rate-limit counters, traces, maildir
+# and lock files. Kept out of the source tree and listed in .gitignore
+DATA_DIR = os.getenv('DATA_DIR', 'data')
+
+
+def data_path(*parts):
+    """A path below DATA_DIR"""
+    return os.path.join(DATA_DIR, *parts)
+
+
+def ensure_parent(path):
+    """Create the directory a file is about to be written in"""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    return path
@@ -0,0 +1,245 @@
+import heapq
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Global per-domain defaults; 0 disables the rate cap
+DOMAIN_RATE_LIMIT = float(os.getenv('DOMAIN_RATE_LIMIT', 60))  # messages per minute
+DOMAIN_CONCURRENCY = int(os.getenv('DOMAIN_CONCURRENCY', 2))
+DOMAIN_MAX_DEFERRALS = int(os.getenv('DOMAIN_MAX_DEFERRALS', 3))
+# Per-domain overrides, e.g. '{"gmail.com": {"rate": 20, "concurrency": 1}}'
+DOMAIN_LIMITS = json.loads(os.getenv('DOMAIN_LIMITS', '{}'))
+
+# Reply codes meaning "slow down", as opposed to a permanent rejection
+THROTTLE_CODES = {421, 450, 451, 452}
+MIN_LEARNED_RATE = 1.0
+RECOVERY_STEP = 1.0
+
+# Rates learned from throttling replies, shared by every campaign in the process
+_learned_rates = {}
+_learned_lock = threading.Lock()
+
+
+def get_domain(email):
+    """Return the lower-cased destination domain of an address"""
+    return email.rsplit('@', 1)[-1].lower()
+
+
+def get_domain_limits(domain):
+    """Return the configured (rate, concurrency) for a domain"""
+    overrides = DOMAIN_LIMITS.get(domain, {})
+    return (
+        float(overrides.get('rate', DOMAIN_RATE_LIMIT)),
+        int(overrides.get('concurrency', DOMAIN_CONCURRENCY))
+    )
+
+
+def get_learned_rate(domain):
+    """Return the current send rate for a domain, learned or configured"""
+    with _learned_lock:
+        if domain in _learned_rates:
+            return _learned_rates[domain]
+    return get_domain_limits(domain)[0]
+
+
+def record_throttle(domain):
+    """Halve a domain's rate after the provider asked us to slow down"""
+    configured = get_domain_limits(domain)[0]
+    with _learned_lock:
+        current = _learned_rates.get(domain, configured) or configured or 60.0
+        _learned_rates[domain] = max(MIN_LEARNED_RATE, current / 2)
+        return _learned_rates[domain]
+
+
+def record_success(domain):
+    """Creep a throttled domain's rate back up towards its configured cap"""
+    configured = get_domain_limits(domain)[0]
+    with _learned_lock:
+        if domain not in _learned_rates:
+            return
+        rate = _learned_rates[domain] + RECOVERY_STEP
+        if configured and rate >= configured:
+            del _learned_rates[domain]
+        else:
+            _learned_rates[domain] = rate
+
+
+class DomainScheduler:
+    """Interleave recipients across destination domains.
+
+    Domains wait in a heap keyed by the time they may next be sent to, so the
+    next recipient always comes from the domain that has waited longest and a
+    list sorted by domain no longer hammers one provider. Each domain is held
+    to its rate cap and to a maximum number of in-flight messages.
+    """
+
+    def __init__(self, email_list, max_deferrals=DOMAIN_MAX_DEFERRALS, rate_limited=True):
+        self.max_deferrals = max_deferrals
+        self.rate_limited = rate_limited
+        self._queues = {}
+        self._in_flight = {}
+        self._deferrals = {}
+        self._ready = []
+        self._scheduled = set()
+        self._seq = 0
+        self._pending = 0
+        self._lock = threading.Condition()
+
+        for email in email_list:
+            self._queues.setdefault(get_domain(email), deque()).append(email)
+            self._pending += 1
+
+        now = time.monotonic()
+        for domain in self._queues:
+            self._in_flight[domain] = 0
+            self._push(domain, now)
+
+    def _push(self, domain, ready_at):
+        self._scheduled.add(domain)
+        self._seq += 1
+        heapq.heappush(self._ready, (ready_at, self._seq, domain))
+
+    def _interval(self, domain):
+        if not self.rate_limited:
+            return 0.0
+        rate = get_learned_rate(domain)
+        return 60.0 / rate if rate > 0 else 0.0
+
+    @property
+    def pending(self):
+        """Recipients not yet finally sent or failed"""
+        return self._pending
+
+    def time_until_ready(self):
+        """Seconds until the next domain may be sent to"""
+        with self._lock:
+            if not self._ready:
+                return 0.0
+            return max(0.0, self._ready[0][0] - time.monotonic())
+
+    def acquire(self, timeout=None):
+        """Return the next recipient to send to, or None when all are done.
+
+        Blocks while every remaining domain is rate limited or at its
+        concurrency cap.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while True:
+                if self._pending == 0:
+                    return None
+
+                now = time.monotonic()
+                if self._ready and self._ready[0][0] <= now:
+                    _, _, domain = heapq.heappop(self._ready)
+                    self._scheduled.discard(domain)
+                    email = self._queues[domain].popleft()
+                    self._in_flight[domain] += 1
+                    # Keep the domain schedulable while it has spare concurrency
+                    if self._queues[domain] and self._in_flight[domain] < get_domain_limits(domain)[1]:
+                        self._push(domain, now + self._interval(domain))
+                    return email
+
+                wait = self._ready[0][0] - now if self._ready else None
+                if deadline is not None:
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        return None
+                    wait = remaining if wait is None else min(wait, remaining)
+                self._lock.wait(wait)
+
+    def requeue(self, email):
+        """Put a recipient back at the front of its queue without counting a deferral"""
+        domain = get_domain(email)
+        with self._lock:
+            self._in_flight[domain] -= 1
+            self._queues[domain].appendleft(email)
+            if domain not in self._scheduled:
+                self._push(domain, time.monotonic())
+            self._lock.notify_all()
+
+    def release(self, email, smtp_code=None):
+        """Mark a send as finished with the reply code of the attempt.
+
+        Returns True when the recipient was deferred and re-queued because the
+        provider answered with a throttling code; the caller should not count
+        it as failed yet.
+        """
+        domain = get_domain(email)
+        with self._lock:
+            self._in_flight[domain] -= 1
+            queue = self._queues[domain]
+
+            deferred = False
+            if smtp_code in THROTTLE_CODES and self._deferrals.get(email, 0) < self.max_deferrals:
+                self._deferrals[email] = self._deferrals.get(email, 0) + 1
+                queue.append(email)
+                deferred = True
+                rate = record_throttle(domain)
+                logger.warning(f"{domain} throttled with {smtp_code}, rate lowered to {rate:.1f}/min")
+            else:
+                self._pending -= 1
+                if smtp_code is not None and smtp_code < 400:
+                    record_success(domain)
+
+            # A domain that had dropped out of the heap becomes schedulable again
+            if queue and domain not in self._scheduled:
+                self._push(domain, time.monotonic() + self._interval(domain))
+            self._lock.notify_all()
+            return deferred
+
+
+class DomainBudget:
+    """Per-domain token buckets that batched transactions are charged against.
+
+    A transaction reaches many recipients at one domain at once, so each of
+    them is charged: a domain earns its learned rate in recipients per minute
+    and saves up at most one minute's worth.
+    """
+
+    def __init__(self, rate_limited=True):
+        self.rate_limited = rate_limited
+        self._tokens = {}
+        self._updated = {}
+        self._lock = threading.Lock()
+
+    def _refill(self, domain, now):
+        """Current tokens of a domain, or None when it isn't rate capped"""
+        rate = get_learned_rate(domain)
+        if not self.rate_limited or rate <= 0:
+            return None
+        capacity = max(1.0, rate)
+        elapsed = now - self._updated.get(domain, now)
+        tokens = min(capacity, self._tokens.get(domain, capacity) + elapsed * rate / 60.0)
+        self._tokens[domain] = tokens
+        self._updated[domain] = now
+        return tokens
+
+    def take(self, domain, count):
+        """Charge up to count recipients to a domain; returns how many may be sent now"""
+        with self._lock:
+            tokens = self._refill(domain, time.monotonic())
+            if tokens is None:
+                return count
+            granted = min(count, int(tokens))
+            self._tokens[domain] = tokens - granted
+            return granted
+
+    def refund(self, domain, count):
+        """Give back recipients that were charged but not sent"""
+        with self._lock:
+            if self._refill(domain, time.monotonic()) is not None:
+                self._tokens[domain] = min(max(1.0, get_learned_rate(domain)), self._tokens[domain] + count)
+
+    def time_until_ready(self, domain):
+        """Seconds until a domain may be charged another recipient"""
+        with self._lock:
+            tokens = self._refill(domain, time.monotonic())
+            if tokens is None or tokens >= 1:
+                return 0.0
+            return (1 - tokens) * 60.0 / get_learned_rate(domain)
@@ -1,4 +1,8 @@
 import base64
+import hashlib
+import os
+import threading
+import uuid
 import re
 import random
 import time
@@ -10,21 +14,160 @@ from dns import resolver
 import logging
 from datetime import datetime
 import smtplib
-from email.mime.base import MIMEBase
-from email import encoders
+from collections import deque, OrderedDict
+from domain_scheduler import DomainBudget, DomainScheduler, get_domain, record_throttle, THROTTLE_CODES
+from throttle import AdaptiveThrottle
+from dkim_signer import DKIMSigner, parse_headers
+from relay_pool import Relay, RelayPool, RelayUnavailable, is_relay_failure, RELAY_OUTAGE_TIMEOUT
+from campaign_stats import get_stats
+from result_sink import ResultSink, RESULT_SPILL_BATCH
+from transports import get_transport
+from mx_cache import get_mx_cache, is_null_mx
+from tracing import trace_span, start_span, end_span, attached_trace, current_trace_context
+from message_builder import UNDISCLOSED_RECIPIENTS, address_headers, encode_message
+import message_builder
+from build_pool import get_build_pool
 
 logger = logging.getLogger(__name__)
 
+# RFC 5321 requires servers to accept at least 100 RCPT TO per transaction
+MAX_RECIPIENTS_PER_TRANSACTION = 100
+# Encoded campaign bodies kept per process, so a preflight leaves the send a warm one
+TEMPLATE_CACHE_SIZE = int(os.getenv('TEMPLATE_CACHE_SIZE', 8))
+TEMPLATE_CACHE_TTL = int(os.getenv('TEMPLATE_CACHE_TTL', 900))
+
+_templates = OrderedDict()
+_templates_lock = threading.Lock()
+
+
+def group_by_domain(email_list, max_recipients=MAX_RECIPIENTS_PER_TRANSACTION):
+    """Group recipients by destination domain into transaction-sized chunks.
+
+    Chunks are interleaved round-robin across domains so consecutive
+    transactions go to different providers.
+    """
+    groups = {}
+    for email in email_list:
+        groups.setdefault(get_domain(email), []).append(email)
+
+    chunked = [
+        [(domain, recipients[start:start + max_recipients])
+         for start in range(0, len(recipients), max_recipients)]
+        for domain, recipients in groups.items()
+    ]
+    batches = []
+    for round_num in range(max((len(chunks) for chunks in chunked), default=0)):
+        batches.extend(chunks[round_num] for chunks in chunked if round_num < len(chunks))
+    return batches
+
+
+class MessageTemplate:
+    """A bulk message flattened once and re-addressed per recipient.
+
+    The MIME body, attachments included, is serialized a single time; each
+    recipient only gets a fresh header block. With a DKIM signer the body
+    hash is also computed once, leaving just the header signature per message.
+    """
+
+    def __init__(self, msg=None, signer=None, encoded=None):
+        # encoded is (header block, body, body hash) as returned by the build pool
+        header_bytes, self.body, self.bh = encoded or encode_message(msg, signer is not None)
+        self.header_bytes = header_bytes
+        self.headers = parse_headers(header_bytes)
+        self.signer = signer
+
+    def render(self, recipient):
+        """Return the full message bytes addressed to recipient"""
+        return address_headers(self.headers, recipient, self.signer, self.bh) + b'\r\n' + self.body
+
+    def render_many(self, recipients):
+        """Yield the message bytes for each recipient in order, signing in the build pool"""
+        if self.signer is None:
+            for recipient in recipients:
+                yield self.render(recipient)
+            return
+        for header_bytes in get_build_pool().sign_headers(self.header_bytes, recipients, self.signer.spec, self.bh):
+            yield header_bytes + b'\r\n' + self.body
+
+
+def smtp_error_code(exc, recipient=None):
+    """Return the SMTP reply code carried by a send exception, if any"""
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        replies = exc.recipients
+        code, _ = replies.get(recipient) or next(iter(replies.values()), (None, None))
+        return code
+    return getattr(exc, 'smtp_code', None)
+
+
+def send_transaction(server, sender, recipients, msg_data):
+    """Run one MAIL FROM / RCPT TO... / DATA transaction for many recipients.
+
+    Returns a dict mapping each refused recipient to its (code, response);
+    every other recipient was accepted. When the server advertises ESMTP
+    PIPELINING the whole envelope is written in a single round-trip.
+    """
+    if not isinstance(server, smtplib.SMTP):
+        # Local transports take the whole transaction in one call
+        try:
+            return server.sendmail(sender, recipients, msg_data)
+        except smtplib.SMTPRecipientsRefused as e:
+            return e.recipients
+
+    server.ehlo_or_helo_if_needed()
+    refused = {}
+
+    if server.has_extn('pipelining'):
+        commands = [f"MAIL FROM:{smtplib.quoteaddr(sender)}"]
+        commands.extend(f"RCPT TO:{smtplib.quoteaddr(rcpt)}" for rcpt in recipients)
+        server.send(''.join(command + smtplib.CRLF for command in commands))
+        mail_code, mail_resp = server.getreply()
+        rcpt_replies = [server.getreply() for _ in recipients]
+    else:
+        mail_code, mail_resp = server.mail(sender)
+        rcpt_replies = [server.rcpt(rcpt) for rcpt in recipients] if mail_code == 250 else []
+
+    if mail_code != 250:
+        server.rset()
+        raise smtplib.SMTPSenderRefused(mail_code, mail_resp, sender)
+
+    for rcpt, (code, resp) in zip(recipients, rcpt_replies):
+        if code not in (250, 251):
+            refused[rcpt] = (code, resp)
+
+    if len(refused) == len(recipients):
+        server.rset()
+        return refused
+
+    code, resp = server.data(msg_data)
+    accepted = [rcpt for rcpt in recipients if rcpt not in refused]
+    if isinstance(server, smtplib.LMTP):
+        # LMTP answers DATA once per accepted recipient; smtplib only reads the first
+        replies = [(code, resp)] + [server.getreply() for _ in accepted[1:]]
+        for rcpt, (code, resp) in zip(accepted, replies):
+            if code != 250:
+                refused[rcpt] = (code, resp)
+        return refused
+    if code != 250:
+        server.rset()
+        raise smtplib.SMTPDataError(code, resp)
+    return refused
+
+
 class EmailSender:
-    def __init__(self, smtp_settings, user_id):
+    def __init__(self, smtp_settings, user_id, transport=None):
         self.settings = smtp_settings
         self.user_id = user_id
+        self.transport = transport or get_transport(getattr(smtp_settings, 'transport', None))
         self.domain = smtp_settings.smtp_server.split('.')[-2:]
         self.domain = '.'.join(self.domain)
         self.logger = logging.getLogger(__name__)
 
     def create_email(self, subject, recipient_email, html_content, attachments=None):
         """Create a multipart email with optional attachments"""
+        with trace_span('mime.build', {'mime.attachments': len(attachments or [])}):
+            return self._create_email(subject, recipient_email, html_content, attachments)
+
+    def _create_email(self, subject, recipient_email, html_content, attachments=None):
         msg = MIMEMultipart('mixed')
         msg['From'] = formataddr((self.settings.sender_name or '', self.settings.username))
         msg['To'] = recipient_email
@@ -60,6 +203,12 @@ class EmailSender:
 
     def verify_email(self, email):
         """Verify email using format check and MX record"""
+        with trace_span('verify_email', {'email.domain': get_domain(email)}) as span:
+            valid = self._verify_email(email)
+            span.set_attribute('email.valid', valid)
+            return valid
+
+    def _verify_email(self, email):
         try:
             # Basic format check
             if not re.match(r"^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$", email):
@@ -76,203 +225,160 @@ class EmailSender:
                 self.log_message(f"Disposable email domain detected: {domain}", 'warning')
                 return False
 
-            # Verify MX records
+            # Verify MX records, through the cache direct-to-MX delivery also uses
             try:
-                mx_records = resolver.resolve(domain, 'MX')
-                self.log_message(f"MX records found for domain {domain}", 'info')
-                return True
-            except (resolver.NXDOMAIN, resolver.NoAnswer):
+                mx_records = get_mx_cache().lookup(domain)
+            except resolver.NXDOMAIN:
+                mx_records = []
+            if not mx_records:
                 self.log_message(f"No MX records found for domain {domain}", 'error')
                 return False
+            if is_null_mx(mx_records):
+                self.log_message(f"Domain {domain} accepts no mail (null MX)", 'error')
+                return False
+            self.log_message(f"MX records found for domain {domain}", 'info')
+            return True
 
         except Exception as e:
             self.log_message(f"Error verifying email {email}: {str(e)}", 'error')
             return False
 
-    def connect_smtp(self):
-        """Create and return SMTP connection"""
-        server = smtplib.SMTP(self.settings.smtp_server, self.settings.smtp_port)
-        server.starttls()
-        server.login(self.settings.username, self.settings.password)
-        return server
+    def get_relays(self):
+        """The user's primary relay followed by any additional ones"""
+        relays = [Relay.from_settings(self.settings)]
+        relays.extend(Relay.from_dict(relay) for relay in getattr(self.settings, 'relays', None) or [])
+        for relay in relays:
+            # Keep dry-run sends from counting against the real relays' health and caps
+            relay.transport = self.transport.name
+        return relays
+
+    def connect_smtp(self, relay=None):
+        """Create and return a connection through the configured transport"""
+        relay = relay or Relay.from_settings(self.settings)
+        with trace_span('smtp.connect', {'smtp.relay': relay.name, 'smtp.transport': self.transport.name}):
+            return self.transport.connect(relay)
 
     def log_message(self, message, level='info', details=None):
         """Log message to file"""
         from app import save_log  # Import here to avoid circular imports
         save_log(self.user_id, 'email_sender', message, level, details)
 
-    def send_bulk_emails(self, email_list, subject, body_text, attachments=None):
-        success_count = 0
-        failed_count = 0
-        errors = []
-        email_statuses = []
-
-        # Log start of bulk email operation
-        self.log_message(
-            f"Starting bulk email operation for {len(email_list)} recipients",
-            'info',
-            details={
-                'total_emails': len(email_list),
-                'subject': subject,
-                'has_attachments': bool(attachments),
-                'attachment_count': len(attachments) if attachments else 0
-            }
+    def build_bulk_message(self, recipient, subject, body_text, attachments=None):
+        """Build the message sent by the bulk loop"""
+        if attachments:
+            self.log_message(
+                f"Processing {len(attachments)} attachments for {recipient}",
+                'info'
+            )
+        msg, failed = message_builder.build_bulk_message(
+            self.settings.sender_name, self.settings.username, recipient, subject, body_text, attachments
         )
+        self.log_attachments(attachments, failed)
+        return msg
 
-        try:
-            with smtplib.SMTP(self.settings.smtp_server, self.settings.smtp_port) as server:
-                server.starttls()
-                server.login(self.settings.username, self.settings.password)
-                self.log_message("SMTP connection established successfully", 'info')
-
-                total_emails = len(email_list)
-                for index, email in enumerate(email_list, 1):
-                    start_time = time.time()
-                    try:
-                        # Log attempt to send email
-                        self.log_message(
-                            f"Attempting to send email to {email} ({index}/{total_emails})",
-                            'info'
-                        )
-
-                        msg = MIMEMultipart()
-                        msg['From'] = f"{self.settings.sender_name} <{self.settings.username}>"
-                        msg['To'] = email
-                        msg['Subject'] = subject
-
-                        # Add HTML body
-                        msg.attach(MIMEText(body_text, 'html'))
-
-                        # Log attachment processing
-                        if attachments:
-                            self.log_message(
-                                f"Processing {len(attachments)} attachments for {email}",
-                                'info'
-                            )
-                            for attachment in attachments:
-                                try:
-                                    part = MIMEBase('application', 'octet-stream')
-                                    part.set_payload(attachment['content'])
-                                    encoders.encode_base64(part)
-                                    part.add_header(
-                                        'Content-Disposition',
-                                        f'attachment; filename="{attachment["filename"]}"'
-                                    )
-                                    msg.attach(part)
-                                    self.log_message(
-                                        f"Successfully attached {attachment['filename']}",
-                                        'info'
-                                    )
-                                except Exception as attach_err:
-                                    self.log_message(
-                                        f"Failed to attach {attachment['filename']}: {str(attach_err)}",
-                                        'error'
-                                    )
-
-                        # Send the email
-                        server.send_message(msg)
-                        success_count += 1
-                        status = 'success'
-                        error_msg = None
-
-                        # Log successful send
-                        self.log_message(
-                            f"Successfully sent email to {email}",
-                            'info',
-                            details={
-                                'email': email,
-                                'time_taken': f"{time.time() - start_time:.2f}s"
-                            }
-                        )
-
-                    except Exception as e:
-                        failed_count += 1
-                        status = 'failed'
-                        error_msg = str(e)
-                        
-                        # Log failed send
-                        self.log_message(
-                            f"Failed to send email to {email}",
-                            'error',
-                            details={
-                                'error': str(e),
-                                'email': email,
-                                'time_taken': f"{time.time() - start_time:.2f}s"
-                            }
-                        )
-                        errors.append(f"Failed to send to {email}: {str(e)}")
-
-                    email_statuses.append({
-                        'email': email,
-                        'status': status,
-                        'error': error_msg,
-                        'timestamp': datetime.utcnow().isoformat(),
-                        'time_taken': f"{time.time() - start_time:.2f}s"
-                    })
-
-                    # Progress logging
-                    if index % 10 == 0 or index in [1, total_emails] or (index / total_emails) in [0.25, 0.5, 0.75]:
-                        progress_msg = (
-                            f"Progress: {index}/{total_emails} emails processed. "
-                            f"Success: {success_count}, Failed: {failed_count}"
-                        )
-                        self.log_message(
-                            progress_msg,
-                            'info',
-                            details={
-                                'progress_percentage': f"{(index/total_emails)*100:.1f}%",
-                                'success_rate': f"{(success_count/index)*100:.1f}%",
-                                'current_success_count': success_count,
-                                'current_failed_count': failed_count
-                            }
-                        )
-
-                    # Apply sending delay
-                    time.sleep(self.settings.delay)
-
-                # Generate final summary
-                summary = {
-                    'total_sent': total_emails,
-                    'success_count': success_count,
-                    'failed_count': failed_count,
-                    'success_rate': f"{(success_count/total_emails)*100:.1f}%",
-                    'failed_emails': [status['email'] for status in email_statuses if status['status'] == 'failed'],
-                    'successful_emails': [status['email'] for status in email_statuses if status['status'] == 'success']
-                }
-
-                # Log final summary
+    def log_attachments(self, attachments, failed):
+        """Log how each attachment fared; failed is [(filename, error)] from message_builder"""
+        errors = dict(failed)
+        for attachment in attachments or []:
+            if attachment['filename'] in errors:
                 self.log_message(
-                    "Bulk email operation completed",
-                    'info',
-                    details={
-                        'summary': summary,
-                        'failed_details': [
-                            {'email': status['email'], 'error': status['error']}
-                            for status in email_statuses
-                            if status['status'] == 'failed'
-                        ]
-                    }
+                    f"Failed to attach {attachment['filename']}: {errors[attachment['filename']]}",
+                    'error'
+                )
+            else:
+                self.log_message(
+                    f"Successfully attached {attachment['filename']}",
+                    'info'
                 )
 
-        except Exception as e:
-            self.log_message(
-                "SMTP connection error",
-                'error',
-                details={
-                    'error': str(e),
-                    'smtp_server': self.settings.smtp_server,
-                    'smtp_port': self.settings.smtp_port
-                }
+    def template_key(self, subject, body_text, attachments=None):
+        """Digest of everything that goes into a campaign's encoded body and signature"""
+        digest = hashlib.sha256()
+        parts = [
+            self.settings.sender_name, self.settings.username, subject, body_text,
+            getattr(self.settings, 'dkim_domain', None), getattr(self.settings, 'dkim_selector', None),
+            getattr(self.settings, 'dkim_private_key', None)
+        ]
+        for attachment in attachments or []:
+            parts.extend((attachment['filename'], attachment['content']))
+        for part in parts:
+            part = part if isinstance(part, bytes) else str(part).encode('utf-8')
+            digest.update(len(part).to_bytes(8, 'little'))
+            digest.update(part)
+        return digest.hexdigest()
+
+    def get_template(self, subject, body_text, attachments=None):
+        """The campaign's MessageTemplate, reusing one encoded recently in this process"""
+        key = self.template_key(subject, body_text, attachments)
+        now = time.monotonic()
+        with _templates_lock:
+            entry = _templates.get(key)
+            if entry is not None and entry[0] > now:
+                _templates.move_to_end(key)
+                return entry[1]
+
+        with trace_span('mime.build', {'mime.attachments': len(attachments or [])}) as span:
+            signer = DKIMSigner.from_settings(self.settings)
+            if attachments:
+                self.log_message(
+                    f"Processing {len(attachments)} attachments for {UNDISCLOSED_RECIPIENTS}",
+                    'info'
+                )
+            # Large campaigns are flattened and base64-encoded in a pool process, off this worker's GIL
+            header_bytes, body, bh, failed = get_build_pool().encode_bulk_message(
+                self.settings.sender_name, self.settings.username, subject, body_text, attachments,
+                signed=signer is not None
             )
-            raise
+            self.log_attachments(attachments, failed)
+            template = MessageTemplate(signer=signer, encoded=(header_bytes, body, bh))
+            span.set_attribute('mime.body_bytes', len(template.body))
+        with _templates_lock:
+            _templates[key] = (now + TEMPLATE_CACHE_TTL, template)
+            _templates.move_to_end(key)
+            while len(_templates) > TEMPLATE_CACHE_SIZE:
+                _templates.popitem(last=False)
+        return template
 
-        return {
-            'success_count': success_count,
-            'failed_count': failed_count,
-            'errors': errors,
-            'summary': summary,
-            'email_statuses': email_statuses
+    def send_bulk_emails(self, email_list, subject, body_text, attachments=None, batch_recipients=False):
+        """Send the same message to every address, one at a time or batched by domain"""
+        bulk_send = BulkSend(self, email_list, subject, body_text, attachments, batch_recipients)
+        return bulk_send.run()
+
+    def spool_bulk_emails(self, email_list, subject, body_text, attachments=None, batch_recipients=False,
+                          campaign_id=None):
+        """Render every message into the durable outbox for the delivery workers to send"""
+        from outbox import get_outbox  # Import here to avoid circular imports
+
+        template = self.get_template(subject, body_text, attachments)
+        campaign_id = campaign_id or uuid.uuid4().hex
+        meta = {
+            'campaign_id': campaign_id,
+            'user_id': str(self.user_id),
+            'sender': self.settings.username,
+            'transport': self.transport.name,
+            'total': len(email_list)
         }
+        get_stats().start_campaign(campaign_id, self.user_id, len(email_list), subject)
+
+        if batch_recipients:
+            msg_data = template.render(UNDISCLOSED_RECIPIENTS)
+            entries = (
+                (dict(meta, recipients=recipients), msg_data)
+                for _, recipients in group_by_domain(email_list)
+            )
+        else:
+            entries = (
+                (dict(meta, recipients=[email]), msg_data)
+                for email, msg_data in zip(email_list, template.render_many(email_list))
+            )
+
+        queued = get_outbox().append(entries)
+        self.log_message(
+            f"Spooled {queued} messages for {len(email_list)} recipients",
+            'info',
+            details={'campaign_id': campaign_id, 'subject': subject}
+        )
+        return {'campaign_id': campaign_id, 'queued_messages': queued, 'total': len(email_list)}
 
     def _process_batch(self, batch, batch_num, total_batches, subject, body_text, attachments, max_retries):
         """Process a single batch of emails"""
@@ -313,13 +419,6 @@ class EmailSender:
         
         return batch_results
 
-    def _smart_delay(self, success_count):
-        """Implement smart delay based on success rate"""
-        base_delay = self.settings.delay or 5
-        if success_count < 10:
-            return time.sleep(base_delay * 2)  # Longer delay if having issues
-        return time.sleep(base_delay)
-
     def _send_single_email(self, email, subject, body_text, attachments, max_retries):
         """Send single email with retry logic"""
         for attempt in range(max_retries):
@@ -327,7 +426,8 @@ class EmailSender:
                 if self.verify_email(email):
                     with self.connect_smtp() as smtp:
                         msg = self.create_email(subject, email, body_text, attachments)
-                        smtp.send_message(msg)
+                        with trace_span('smtp.send', {'email.domain': get_domain(email)}):
+                            smtp.send_message(msg)
                         return {
                             'email': email,
                             'status': 'success',
@@ -347,4 +447,519 @@ class EmailSender:
                         'message': str(e),
                         'attempts': attempt + 1
                     }
-                time.sleep(2 ** attempt)  # Exponential backoff
\ No newline at end of file
+                time.sleep(2 ** attempt)  # Exponential backoff
+
+
+class BulkSend:
+    """One bulk send in progress.
+
+    Holds the relay connections, counters and per-recipient statuses so the
+    send can be advanced one message (or one batched transaction) at a time:
+    run() drives it to completion, while the fair scheduler interleaves steps
+    of many tenants' sends on shared worker threads.
+    """
+
+    def __init__(self, sender, email_list, subject, body_text, attachments=None,
+                 batch_recipients=False, max_recipients=MAX_RECIPIENTS_PER_TRANSACTION, window=None,
+                 campaign_id=None, owns_campaign=True, result_batch=RESULT_SPILL_BATCH):
+        self.sender = sender
+        self.campaign_id = campaign_id or uuid.uuid4().hex
+        # False when this send is one shard of a campaign whose stats are started and finished elsewhere
+        self.owns_campaign = owns_campaign
+        self.stopped = False
+        self.settings = sender.settings
+        self.email_list = email_list
+        self.subject = subject
+        self.body_text = body_text
+        self.attachments = attachments
+        self.batch_recipients = batch_recipients
+        self.window = window
+        self.total_emails = len(email_list)
+
+        self.success_count = 0
+        self.failed_count = 0
+        self.index = 0
+        self.relays = RelayPool(sender.get_relays())
+        self.connections = {}
+        self.last_delivery_at = None
+        self.last_relay_error = None
+        self.template = None
+        self.msg_data = None
+        self.next_send_at = 0.0
+        self.throttle = AdaptiveThrottle.from_settings(self.settings)
+        # Dry runs through a null or maildir transport skip every pause
+        self.paced = sender.transport.paced
+        self.stats = get_stats()
+        self.results = ResultSink(self.campaign_id, self.user_id, spill_batch=result_batch)
+        # Steps run on scheduler threads, so the trace is carried rather than taken from context
+        self.trace_context = current_trace_context()
+        self.trace = None
+
+        if batch_recipients:
+            self.batches = deque(group_by_domain(email_list, max_recipients))
+            self.total_batches = len(self.batches)
+            self.budget = DomainBudget(rate_limited=self.paced)
+            self.scheduler = None
+        else:
+            self.batches = None
+            self.budget = None
+            self.scheduler = DomainScheduler(email_list, rate_limited=self.paced)
+
+    @property
+    def user_id(self):
+        return self.sender.user_id
+
+    @property
+    def done(self):
+        """True once every recipient has been sent or failed, or the send was stopped"""
+        if self.stopped:
+            return True
+        if self.batch_recipients:
+            return not self.batches
+        return self.scheduler.pending == 0
+
+    def log_message(self, message, level='info', details=None):
+        self.sender.log_message(message, level, details)
+
+    def open(self):
+        """Log the start of the operation and connect to the relay"""
+        if self.batch_recipients:
+            self.log_message(
+                f"Starting batched email operation for {self.total_emails} recipients",
+                'info',
+                details={
+                    'total_emails': self.total_emails,
+                    'total_batches': self.total_batches,
+                    'subject': self.subject,
+                    'has_attachments': bool(self.attachments),
+                    'attachment_count': len(self.attachments) if self.attachments else 0
+                }
+            )
+        else:
+            # Log start of bulk email operation
+            self.log_message(
+                f"Starting bulk email operation for {self.total_emails} recipients",
+                'info',
+                details={
+                    'total_emails': self.total_emails,
+                    'subject': self.subject,
+                    'has_attachments': bool(self.attachments),
+                    'attachment_count': len(self.attachments) if self.attachments else 0
+                }
+            )
+
+        if self.owns_campaign:
+            self.stats.start_campaign(self.campaign_id, self.user_id, self.total_emails, self.subject)
+
+        self.trace = start_span('campaign.send', {
+            'campaign.id': self.campaign_id,
+            'campaign.recipients': self.total_emails,
+            'campaign.batched': bool(self.batch_recipients),
+            'smtp.transport': self.sender.transport.name
+        }, parent=self.trace_context)
+        if self.trace is not None:
+            self.trace_context = self.trace.context
+
+        # The body is identical for every recipient, so build and sign it once
+        with attached_trace(self.trace_context):
+            self.template = self.sender.get_template(self.subject, self.body_text, self.attachments)
+        if self.batch_recipients:
+            self.msg_data = self.template.render(UNDISCLOSED_RECIPIENTS)
+
+    def _connection(self, relay):
+        """Return the open connection to a relay, connecting on first use"""
+        server = self.connections.get(relay.key)
+        if server is None:
+            server = self.sender.connect_smtp(relay)
+            self.connections[relay.key] = server
+            self.log_message(
+                "SMTP connection established successfully",
+                'info',
+                details={'relay': relay.name, 'pipelining': server.has_extn('pipelining')}
+            )
+        return server
+
+    def _drop_connection(self, relay):
+        server = self.connections.pop(relay.key, None)
+        if server is not None:
+            try:
+                server.quit()
+            except Exception:
+                server.close()
+
+    def _relay_failed(self, relay, error):
+        """Trip the relay's breaker and drop its connection so work fails over"""
+        self.last_relay_error = error
+        self.relays.record_failure(relay, error)
+        self._drop_connection(relay)
+        self.log_message(
+            f"Relay {relay.name} failed, failing over",
+            'warning',
+            details={'relay': relay.name, 'error': str(error), 'relays': self.relays.states()}
+        )
+
+    def _wait_for_relay(self):
+        """No relay can take mail now: wait for one, or give up after an outage"""
+        outage = self.last_delivery_at is None or time.monotonic() - self.last_delivery_at > RELAY_OUTAGE_TIMEOUT
+        if outage and self.relays.all_tripped():
+            raise RelayUnavailable(
+                f"No healthy SMTP relay available: {self.last_relay_error or 'all relays are cooling down'}"
+            )
+        self.next_send_at = time.monotonic() + max(1.0, self.relays.retry_in())
+
+    def stop(self):
+        """Stop after the current step, leaving the remaining recipients unsent"""
+        self.stopped = True
+
+    def close(self):
+        """Close every relay connection"""
+        for relay in self.relays.relays:
+            self._drop_connection(relay)
+
+    def fail(self, error):
+        """Log an error that aborted the whole operation"""
+        end_span(self.trace, error)
+        self.trace = None
+        self.results.flush()
+        if self.owns_campaign:
+            self.stats.finish_campaign(self.campaign_id, 'failed')
+        else:
+            self.stats.flush()
+        self.log_message(
+            "SMTP connection error",
+            'error',
+            details={
+                'error': str(error),
+                'smtp_server': self.settings.smtp_server,
+                'smtp_port': self.settings.smtp_port,
+                'relays': self.relays.states()
+            }
+        )
+
+    def run(self):
+        """Send to every recipient, pausing as the throttle says, and return the result"""
+        try:
+            self.open()
+            while not self.done:
+                time.sleep(max(0.0, self.next_send_at - time.monotonic()))
+                self.step()
+        except Exception as e:
+            self.fail(e)
+            raise
+        finally:
+            self.close()
+        return self.finish()
+
+    def step(self):
+        """Send the next message or transaction if one is due.
+
+        Afterwards next_send_at holds the monotonic time the following step
+        may run at.
+        """
+        with attached_trace(self.trace_context):
+            self._step()
+
+    def _step(self):
+        if self.window is not None:
+            wait = self.window.seconds_until_open()
+            if wait > 0:
+                # Don't hold an idle connection open until the window reopens
+                self.close()
+                self.next_send_at = time.monotonic() + wait
+                return
+
+        relay = self.relays.choose()
+        if relay is None:
+            self._wait_for_relay()
+            return
+
+        if self.batch_recipients:
+            self._send_next_batch(relay)
+        else:
+            self._send_next_email(relay)
+
+    def _send_next_email(self, relay):
+        # Interleave recipients across domains within per-domain caps
+        email = self.scheduler.acquire(timeout=0)
+        if email is None:
+            self.relays.release(relay)
+            self.next_send_at = time.monotonic() + self.scheduler.time_until_ready()
+            return
+
+        start_time = time.time()
+        # Log attempt to send email
+        self.log_message(
+            f"Attempting to send email to {email} ({self.index + 1}/{self.total_emails})",
+            'info'
+        )
+
+        tried = set()
+        while True:
+            send_start = None
+            error = None
+            try:
+                msg_data = self.template.render(email)
+
+                # Send the email
+                send_start = time.time()
+                with trace_span('smtp.send', {'email.domain': get_domain(email), 'smtp.relay': relay.name}):
+                    self._connection(relay).sendmail(self.settings.username, [email], msg_data)
+                smtp_code = 250
+            except Exception as e:
+                error = e
+                smtp_code = smtp_error_code(e, email)
+
+            if error is None or not is_relay_failure(error):
+                self.relays.record_success(relay, 1 if error is None else 0)
+                break
+
+            # The relay itself failed: retry the recipient on another healthy relay
+            self._relay_failed(relay, error)
+            tried.add(relay.key)
+            relay = self.relays.choose(exclude=tried)
+            if relay is None:
+                self.scheduler.requeue(email)
+                self.throttle.record(smtp_code, None, error)
+                self._wait_for_relay()
+                return
+
+        if error is None:
+            self.last_delivery_at = time.monotonic()
+
+        # Feed the relay's answer back into the send-rate controller
+        self.throttle.record(smtp_code, time.time() - send_start if send_start else None, error)
+        self.next_send_at = time.monotonic() + (self.throttle.delay if self.paced else 0.0)
+
+        if self.scheduler.release(email, smtp_code):
+            self.stats.record(self.campaign_id, get_domain(email), 'deferred', smtp_code)
+            self.log_message(
+                f"Deferred email to {email} after throttling reply {smtp_code}",
+                'warning',
+                details={'email': email, 'error': str(error)}
+            )
+            return
+
+        self.index += 1
+        if error is None:
+            self.success_count += 1
+            status = 'success'
+            error_msg = None
+            self.stats.record(self.campaign_id, get_domain(email), 'success', smtp_code)
+
+            # Log successful send
+            self.log_message(
+                f"Successfully sent email to {email}",
+                'info',
+                details={
+                    'email': email,
+                    'relay': relay.name,
+                    'time_taken': f"{time.time() - start_time:.2f}s"
+                }
+            )
+        else:
+            self.failed_count += 1
+            status = 'failed'
+            error_msg = str(error)
+            self.stats.record(self.campaign_id, get_domain(email), 'failed', smtp_code)
+
+            # Log failed send
+            self.log_message(
+                f"Failed to send email to {email}",
+                'error',
+                details={
+                    'error': error_msg,
+                    'email': email,
+                    'time_taken': f"{time.time() - start_time:.2f}s"
+                }
+            )
+
+        self.results.record(
+            email,
+            status,
+            # The exception itself, so failures without a code are grouped by its type
+            error=error,
+            smtp_code=smtp_code if error is not None else None,
+            timestamp=datetime.utcnow().isoformat(),
+            time_taken=f"{time.time() - start_time:.2f}s"
+        )
+
+        # Progress logging
+        index, total_emails = self.index, self.total_emails
+        if index % 10 == 0 or index in [1, total_emails] or (index / total_emails) in [0.25, 0.5, 0.75]:
+            self.log_progress()
+
+    def _take_batch(self):
+        """Pop the next batch whose domain has budget left, charging every recipient.
+
+        A batch larger than what its domain may take now is split and the rest
+        goes to the back of the queue. None when every domain is at its cap.
+        """
+        for _ in range(len(self.batches)):
+            domain, recipients = self.batches[0]
+            granted = self.budget.take(domain, len(recipients))
+            if granted:
+                self.batches.popleft()
+                if granted < len(recipients):
+                    self.batches.append((domain, recipients[granted:]))
+                    self.total_batches += 1
+                    recipients = recipients[:granted]
+                return domain, recipients
+            self.batches.rotate(-1)
+        return None
+
+    def _send_next_batch(self, relay):
+        batch = self._take_batch()
+        if batch is None:
+            self.relays.release(relay)
+            self.next_send_at = time.monotonic() + min(
+                self.budget.time_until_ready(domain) for domain, _ in self.batches)
+            return
+        domain, recipients = batch
+        batch_num = self.total_batches - len(self.batches)
+        start_time = time.time()
+        tried = set()
+        while True:
+            smtp_code = 250
+            try:
+                with trace_span('smtp.transaction', {
+                    'email.domain': domain,
+                    'smtp.relay': relay.name,
+                    'smtp.recipients': len(recipients)
+                }) as span:
+                    refused = send_transaction(self._connection(relay), self.settings.username, recipients,
+                                               self.msg_data)
+                    span.set_attribute('smtp.refused', len(refused))
+                failures = {
+                    email: f"{code} {resp.decode(errors='replace')}"
+                    for email, (code, resp) in refused.items()
+                }
+                failure_codes = {email: code for email, (code, _) in refused.items()}
+                batch_error = None
+                throttled = [code for code, _ in refused.values() if code in THROTTLE_CODES]
+                if throttled:
+                    record_throttle(domain)
+                    smtp_code = throttled[0]
+                self.relays.record_success(relay, len(recipients) - len(refused))
+                if len(refused) < len(recipients):
+                    self.last_delivery_at = time.monotonic()
+                break
+            except Exception as e:
+                if is_relay_failure(e):
+                    # The relay itself failed: retry the batch on another healthy relay
+                    self._relay_failed(relay, e)
+                    tried.add(relay.key)
+                    relay = self.relays.choose(exclude=tried)
+                    if relay is None:
+                        self.budget.refund(domain, len(recipients))
+                        self.batches.appendleft((domain, recipients))
+                        self.throttle.record(smtp_error_code(e), None, e)
+                        self._wait_for_relay()
+                        return
+                    continue
+                batch_error = str(e)
+                failures = {email: e for email in recipients}
+                smtp_code = smtp_error_code(e)
+                failure_codes = {email: smtp_code for email in recipients}
+                self.relays.record_success(relay, 0)
+                break
+
+        self.throttle.record(smtp_code, time.time() - start_time)
+        self.next_send_at = time.monotonic() + (self.throttle.delay if self.paced else 0.0)
+
+        if len(recipients) > len(failures):
+            self.stats.record(self.campaign_id, domain, 'success', 250, len(recipients) - len(failures))
+        for code in failure_codes.values():
+            self.stats.record(self.campaign_id, domain, 'failed', code)
+
+        time_taken = f"{time.time() - start_time:.2f}s"
+        timestamp = datetime.utcnow().isoformat()
+        for email in recipients:
+            error = failures.get(email)
+            self.index += 1
+            if error is None:
+                self.success_count += 1
+            else:
+                self.failed_count += 1
+
+            self.results.record(
+                email,
+                'failed' if error is not None else 'success',
+                error=error,
+                smtp_code=failure_codes.get(email),
+                timestamp=timestamp,
+                time_taken=time_taken
+            )
+
+        self.log_message(
+            f"Batch {batch_num}/{self.total_batches} to {domain}: "
+            f"{len(recipients) - len(failures)} accepted, {len(failures)} failed",
+            'error' if batch_error else 'info',
+            details={
+                'domain': domain,
+                'relay': relay.name,
+                'recipients': len(recipients),
+                'error': batch_error,
+                'time_taken': time_taken,
+                'send_rate_per_minute': self.throttle.rate_per_minute
+            }
+        )
+
+    def log_progress(self):
+        index, total_emails = self.index, self.total_emails
+        progress_msg = (
+            f"Progress: {index}/{total_emails} emails processed. "
+            f"Success: {self.success_count}, Failed: {self.failed_count}"
+        )
+        self.log_message(
+            progress_msg,
+            'info',
+            details={
+                'progress_percentage': f"{(index/total_emails)*100:.1f}%",
+                'success_rate': f"{(self.success_count/index)*100:.1f}%",
+                'current_success_count': self.success_count,
+                'current_failed_count': self.failed_count,
+                'send_rate_per_minute': self.throttle.rate_per_minute
+            }
+        )
+
+    def finish(self):
+        """Log the final summary and return the operation's result"""
+        total_emails = self.total_emails
+        # Per-recipient detail lives in campaign_results; the summary stays constant-size
+        self.results.flush()
+        summary = {
+            'campaign_id': self.campaign_id,
+            'total_sent': total_emails,
+            'success_count': self.success_count,
+            'failed_count': self.failed_count,
+            'success_rate': f"{(self.success_count/total_emails)*100:.1f}%" if total_emails else "0.0%",
+            'error_classes': self.results.error_samples(),
+            'unsaved_results': self.results.spill_errors,
+            'transport': self.sender.transport.name,
+            'send_rate_per_minute': self.throttle.rate_per_minute
+        }
+
+        # Log final summary
+        self.log_message(
+            "Batched email operation completed" if self.batch_recipients else "Bulk email operation completed",
+            'info',
+            details={'summary': summary}
+        )
+
+        if self.owns_campaign:
+            self.stats.finish_campaign(self.campaign_id, 'completed')
+        else:
+            self.stats.flush()
+        end_span(self.trace, attributes={
+            'campaign.success': self.success_count,
+            'campaign.failed': self.failed_count
+        })
+        self.trace = None
+
+        return {
+            'campaign_id': self.campaign_id,
+            'success_count': self.success_count,
+            'failed_count': self.failed_count,
+            'errors': self.results.sample_messages(),
+            'summary': summary
+        }
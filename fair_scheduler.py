@@ -0,0 +1,295 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from tracing import record_span
+
+logger = logging.getLogger(__name__)
+
+# Sends that may run at once in this process, i.e. concurrent relay connections
+SEND_WORKERS = int(os.getenv('SEND_WORKERS', 4))
+# Messages a weight-1 tenant may send per round before the next tenant's turn
+DRR_QUANTUM = int(os.getenv('DRR_QUANTUM', 10))
+# Per-tenant quotas
+TENANT_MAX_ACTIVE = int(os.getenv('TENANT_MAX_ACTIVE', 3))
+TENANT_MAX_QUEUED = int(os.getenv('TENANT_MAX_QUEUED', 200000))
+# Per-tenant weights, e.g. '{"<user_id>": 3}'; everyone else gets 1
+TENANT_WEIGHTS = json.loads(os.getenv('TENANT_WEIGHTS', '{}'))
+
+# Priority lanes, most urgent first
+LANES = ('transactional', 'normal', 'bulk')
+DEFAULT_LANE = 'normal'
+# Workers only a lane, or a more urgent one, may use, e.g. '{"transactional": 1, "normal": 1}'
+LANE_RESERVED_WORKERS = json.loads(os.getenv('LANE_RESERVED_WORKERS', '{"transactional": 1}'))
+
+
+class TenantQuotaExceeded(Exception):
+    """Raised when a tenant submits more work than its quota allows"""
+
+
+class Job:
+    """A BulkSend queued on the scheduler; wait() returns its result"""
+
+    def __init__(self, tenant_id, bulk_send, lane=DEFAULT_LANE):
+        self.tenant_id = tenant_id
+        self.bulk_send = bulk_send
+        self.lane = lane
+        self.submitted_at = time.time()
+        self.started = False
+        self.running = False
+        self.result = None
+        self.error = None
+        self._callbacks = []
+        self._callback_lock = threading.Lock()
+        self._finished = threading.Event()
+
+    @property
+    def remaining(self):
+        return self.bulk_send.total_emails - self.bulk_send.index
+
+    def is_ready(self, now):
+        return not self.running and self.bulk_send.next_send_at <= now
+
+    def wait(self, timeout=None):
+        """Block until the send finishes; re-raise the error that aborted it"""
+        self._finished.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def add_done_callback(self, callback):
+        """Call callback(job) once the send finishes, right away if it already has"""
+        with self._callback_lock:
+            if not self._finished.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _complete(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        with self._callback_lock:
+            self._finished.set()
+            callbacks = list(self._callbacks)
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                logger.error(f"Error in job callback: {e}")
+
+
+class Tenant:
+    def __init__(self, tenant_id, weight=1):
+        self.tenant_id = tenant_id
+        self.weight = weight
+        self.deficit = 0
+        self.jobs = deque()
+
+    def next_ready_job(self, now):
+        """Round-robin over this tenant's own campaigns"""
+        for _ in range(len(self.jobs)):
+            job = self.jobs[0]
+            self.jobs.rotate(-1)
+            if job.is_ready(now):
+                return job
+        return None
+
+
+class FairScheduler:
+    """Share send workers across tenants with deficit round-robin.
+
+    Every step of a BulkSend (one message, or one batched transaction) costs
+    one unit. A tenant at the head of the ring is topped up with
+    quantum * weight units and keeps the next worker until it has spent them
+    or has nothing due, so a small campaign gets its turn within one round no
+    matter how large the campaigns already running are. Workers never sleep
+    on one campaign's throttle delay while another campaign has a message due.
+
+    Sends are queued in priority lanes, each with its own ring; a tenant's
+    quotas count its campaigns in every lane together, so lanes only decide
+    order, never how much a tenant may run. A free worker always serves the most urgent lane with a message
+    due, so bulk work is preempted at the next message boundary, and
+    LANE_RESERVED_WORKERS keeps workers that less urgent lanes may never
+    occupy, so a transactional message never waits behind a slow bulk step.
+    """
+
+    def __init__(self, workers=SEND_WORKERS, quantum=DRR_QUANTUM,
+                 max_active=TENANT_MAX_ACTIVE, max_queued=TENANT_MAX_QUEUED, reserved=None):
+        self.workers = workers
+        self.quantum = quantum
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self.lane_caps = self._lane_caps(workers, LANE_RESERVED_WORKERS if reserved is None else reserved)
+        self._tenants = {}
+        self._rings = {lane: deque() for lane in LANES}
+        self._running = {lane: 0 for lane in LANES}
+        self._lock = threading.Condition()
+        self._threads = []
+
+    @staticmethod
+    def _lane_caps(workers, reserved):
+        """Workers each lane may occupy: all but those reserved for more urgent lanes"""
+        caps = {}
+        held_back = 0
+        for lane in LANES:
+            caps[lane] = max(1, workers - held_back)
+            held_back += int(reserved.get(lane, 0))
+        return caps
+
+    def submit(self, tenant_id, bulk_send, weight=None, lane=DEFAULT_LANE):
+        """Queue a BulkSend for a tenant in a priority lane and return its Job"""
+        tenant_id = str(tenant_id)
+        if lane not in LANES:
+            raise ValueError(f"Unknown priority {lane!r}; use one of {', '.join(LANES)}")
+        with self._lock:
+            tenant = self._tenants.get((lane, tenant_id))
+            if tenant is None:
+                tenant = Tenant(tenant_id, weight or TENANT_WEIGHTS.get(tenant_id, 1))
+            jobs = self._tenant_jobs(tenant_id)
+            if len(jobs) >= self.max_active:
+                raise TenantQuotaExceeded(
+                    f"At most {self.max_active} campaigns may run at once"
+                )
+            queued = sum(job.remaining for job in jobs)
+            if queued + bulk_send.total_emails > self.max_queued:
+                raise TenantQuotaExceeded(
+                    f"At most {self.max_queued} recipients may be queued at once"
+                )
+
+            job = Job(tenant_id, bulk_send, lane)
+            tenant.jobs.append(job)
+            if (lane, tenant_id) not in self._tenants:
+                self._tenants[(lane, tenant_id)] = tenant
+                self._rings[lane].append(tenant)
+            self._start_workers()
+            self._lock.notify_all()
+            return job
+
+    def _tenant_jobs(self, tenant_id):
+        """A tenant's campaigns across all lanes; call with the lock held"""
+        return [job for lane in LANES for job in getattr(self._tenants.get((lane, tenant_id)), 'jobs', ())]
+
+    def stats(self):
+        """Snapshot of queued campaigns per lane and tenant"""
+        with self._lock:
+            return {
+                lane: {
+                    tenant.tenant_id: {
+                        'weight': tenant.weight,
+                        'campaigns': len(tenant.jobs),
+                        'queued_recipients': sum(job.remaining for job in tenant.jobs)
+                    }
+                    for tenant in self._rings[lane]
+                }
+                for lane in LANES
+            }
+
+    def _start_workers(self):
+        # Started lazily so threads are created in each forked gunicorn worker
+        self._threads = [thread for thread in self._threads if thread.is_alive()]
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work, name=f"send-worker-{len(self._threads)}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _pick(self, now):
+        """Choose the next due job of the most urgent lane with room; call with the lock held"""
+        for lane in LANES:
+            if self._running[lane] < self.lane_caps[lane]:
+                job = self._pick_in_lane(self._rings[lane], now)
+                if job is not None:
+                    return job
+        return None
+
+    def _pick_in_lane(self, ring, now):
+        """Deficit round-robin across the tenants of one lane"""
+        for _ in range(len(ring)):
+            tenant = ring[0]
+            job = tenant.next_ready_job(now)
+            if job is None:
+                ring.rotate(-1)
+                continue
+            if tenant.deficit < 1:
+                tenant.deficit += self.quantum * tenant.weight
+            tenant.deficit -= 1
+            if tenant.deficit < 1:
+                ring.rotate(-1)
+            return job
+        return None
+
+    def _next_wakeup(self, now):
+        # Lanes at their cap are woken by the step that frees a worker instead
+        due = [
+            job.bulk_send.next_send_at
+            for lane in LANES if self._running[lane] < self.lane_caps[lane]
+            for tenant in self._rings[lane] for job in tenant.jobs
+            if not job.running
+        ]
+        return max(0.0, min(due) - now) if due else None
+
+    def _work(self):
+        while True:
+            with self._lock:
+                while True:
+                    now = time.monotonic()
+                    job = self._pick(now)
+                    if job is not None:
+                        break
+                    self._lock.wait(self._next_wakeup(now))
+                job.running = True
+                self._running[job.lane] += 1
+
+            self._run_step(job)
+
+            with self._lock:
+                job.running = False
+                self._running[job.lane] -= 1
+                self._lock.notify_all()
+
+    def _run_step(self, job):
+        bulk_send = job.bulk_send
+        try:
+            if not job.started:
+                job.started = True
+                record_span('scheduler.queue', int(job.submitted_at * 1e9), time.time_ns(), bulk_send.trace_context, {
+                    'scheduler.lane': job.lane,
+                    'scheduler.tenant': str(job.tenant_id)
+                })
+                bulk_send.open()
+            elif not bulk_send.done:
+                bulk_send.step()
+
+            if bulk_send.done:
+                bulk_send.close()
+                self._remove(job)
+                job._complete(result=bulk_send.finish())
+        except Exception as e:
+            logger.error(f"Send for tenant {job.tenant_id} aborted: {e}")
+            bulk_send.fail(e)
+            bulk_send.close()
+            self._remove(job)
+            job._complete(error=e)
+
+    def _remove(self, job):
+        with self._lock:
+            tenant = self._tenants[(job.lane, job.tenant_id)]
+            tenant.jobs.remove(job)
+            if not tenant.jobs:
+                del self._tenants[(job.lane, job.tenant_id)]
+                self._rings[job.lane].remove(tenant)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """Return this process's shared FairScheduler"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = FairScheduler()
+        return _scheduler
@@ -626,6 +626,11 @@ async function loadEmailList() {
         if (data.status === 'success') {
             const emailList = document.getElementById('email-list');
             emailList.value = data.emails.join('\n');
+            // The server's copy is the baseline later saves send deltas against
+            await chrome.storage.local.set({
+                emailList: data.emails,
+                emailListVersion: data.version
+            });
         }
 
         // Also load from local storage as backup
@@ -645,30 +650,129 @@ async function loadEmailList() {
     }
 }
 
+// Addresses per chunk the list is split into when syncing with the server
+const SYNC_CHUNK_TARGET = 256;
+const MAX_SYNC_CHUNKS = 4096;
+const SYNC_RETRIES = 3;
+
+const CRC32_TABLE = (() => {
+    const table = new Uint32Array(256);
+    for (let n = 0; n < 256; n++) {
+        let c = n;
+        for (let k = 0; k < 8; k++) {
+            c = c & 1 ? 0xEDB88320 ^ (c >>> 1) : c >>> 1;
+        }
+        table[n] = c >>> 0;
+    }
+    return table;
+})();
+
+function crc32(bytes) {
+    let crc = 0xFFFFFFFF;
+    for (const byte of bytes) {
+        crc = CRC32_TABLE[(crc ^ byte) & 0xFF] ^ (crc >>> 8);
+    }
+    return (crc ^ 0xFFFFFFFF) >>> 0;
+}
+
+// Must match the server's list_sync.py: CRC-32 picks the chunk, SHA-256 of the sorted chunk is its hash
+function splitChunks(emails, chunks) {
+    const encoder = new TextEncoder();
+    const buckets = Array.from({ length: chunks }, () => new Set());
+    for (const email of emails) {
+        buckets[crc32(encoder.encode(email)) % chunks].add(email);
+    }
+    return buckets.map(bucket => [...bucket].sort());
+}
+
+async function chunkHash(bucket) {
+    const digest = await crypto.subtle.digest('SHA-256', new TextEncoder().encode(bucket.join('\n')));
+    return [...new Uint8Array(digest)].map(byte => byte.toString(16).padStart(2, '0')).join('').slice(0, 16);
+}
+
+function syncChunkCount(size) {
+    let chunks = 1;
+    while (chunks < MAX_SYNC_CHUNKS && chunks * SYNC_CHUNK_TARGET < size) {
+        chunks *= 2;
+    }
+    return chunks;
+}
+
+function diffEmailLists(before, after) {
+    const beforeSet = new Set(before);
+    const afterSet = new Set(after);
+    return {
+        add: [...afterSet].filter(email => !beforeSet.has(email)),
+        remove: [...beforeSet].filter(email => !afterSet.has(email))
+    };
+}
+
+async function postEmailList(path, body) {
+    const response = await fetch(`${API_BASE_URL}${path}`, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+            'Authorization': `Bearer ${localStorage.getItem('token')}`
+        },
+        body: JSON.stringify(body)
+    });
+    if (!response.ok && response.status !== 409) {
+        throw new Error(`HTTP error! status: ${response.status}`);
+    }
+    return { conflict: response.status === 409, data: await response.json() };
+}
+
+// Send the adds and removes made since baseVersion; null when the server list has moved on
+async function postEmailListDelta(baseVersion, delta) {
+    const { conflict, data } = await postEmailList('/email-list/delta', {
+        base_version: baseVersion,
+        add: delta.add,
+        remove: delta.remove
+    });
+    return conflict ? null : data.version;
+}
+
+// Compare chunk hashes with the server and send only what differs in the chunks that don't match
+async function syncEmailList(emails) {
+    const chunks = syncChunkCount(new Set(emails).size);
+    const buckets = splitChunks(emails, chunks);
+    const hashes = await Promise.all(buckets.map(chunkHash));
+
+    for (let attempt = 0; attempt < SYNC_RETRIES; attempt++) {
+        const { data } = await postEmailList('/email-list/sync', { chunks, hashes });
+        const delta = { add: [], remove: [] };
+        for (const [index, serverBucket] of Object.entries(data.differing)) {
+            const chunkDelta = diffEmailLists(serverBucket, buckets[Number(index)]);
+            delta.add.push(...chunkDelta.add);
+            delta.remove.push(...chunkDelta.remove);
+        }
+        const version = await postEmailListDelta(data.version, delta);
+        if (version !== null) {
+            return version;
+        }
+    }
+    throw new Error('Email list keeps changing on the server, try saving again');
+}
+
 async function saveEmailList() {
     try {
         const emailListText = document.getElementById('email-list').value;
-        const emails = emailListText.split('\n').filter(email => email.trim());
+        const emails = emailListText.split('\n').map(email => email.trim()).filter(email => email);
 
-        // Save to backend
-        const response = await fetch(`${API_BASE_URL}/email-list`, {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json',
-                'Authorization': `Bearer ${localStorage.getItem('token')}`
-            },
-            body: JSON.stringify({
-                emails: emails
-            })
-        });
-
-        if (!response.ok) {
-            throw new Error(`HTTP error! status: ${response.status}`);
+        // Only changes go to the backend: a delta against the last synced version when we have one
+        const { emailList: synced, emailListVersion } = await chrome.storage.local.get(['emailList', 'emailListVersion']);
+        let version = null;
+        if (Array.isArray(synced) && Number.isInteger(emailListVersion)) {
+            version = await postEmailListDelta(emailListVersion, diffEmailLists(synced, emails));
+        }
+        if (version === null) {
+            version = await syncEmailList(emails);
         }
 
         // Save to local storage
         await chrome.storage.local.set({ 
             emailList: emails,
+            emailListVersion: version,
             lastUpdated: new Date().toISOString()
         });
     } catch (error) {
@@ -0,0 +1,185 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import uuid
+from functools import wraps
+
+from flask import g, jsonify, make_response, request
+from flask_jwt_extended import get_jwt_identity
+from pymongo.errors import DuplicateKeyError
+
+from models import SendRequest, CampaignStats
+
+logger = logging.getLogger(__name__)
+
+# How long a request sent with an Idempotency-Key header is remembered
+IDEMPOTENCY_TTL = int(os.getenv('IDEMPOTENCY_TTL', 86400))
+# Identical campaigns submitted this many seconds apart without a key are
+# treated as a retry of the first; 0 turns content deduplication off
+DUPLICATE_WINDOW = int(os.getenv('DUPLICATE_WINDOW', 3600))
+# How often a running request renews its reservation while the view sends
+IDEMPOTENCY_HEARTBEAT = float(os.getenv('IDEMPOTENCY_HEARTBEAT', 30))
+# A running request whose reservation wasn't renewed for this long was lost with
+# its worker and may be taken over by a retry; a few heartbeats, so one slow
+# renewal doesn't hand a live send to a retry
+IDEMPOTENCY_LEASE = float(os.getenv('IDEMPOTENCY_LEASE', IDEMPOTENCY_HEARTBEAT * 4))
+MAX_KEY_LENGTH = 255
+
+# Request fields that make up a campaign; anything else doesn't change what is sent
+FINGERPRINT_FIELDS = ('emails', 'subject', 'body', 'batch_recipients', 'send_at', 'window',
+                      'spool', 'distributed', 'dry_run', 'priority')
+
+
+def request_fingerprint(data):
+    """Hash of everything in a /send-emails body that determines what gets sent"""
+    digest = hashlib.sha256()
+    fields = {field: data.get(field) for field in FINGERPRINT_FIELDS}
+    digest.update(json.dumps(fields, sort_keys=True, default=str).encode('utf-8'))
+    for attachment in data.get('attachments') or []:
+        # Hashed one by one so large attachments aren't copied into one JSON string
+        digest.update(str(attachment.get('name')).encode('utf-8'))
+        digest.update(str(attachment.get('content')).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def replay_response(record, user_id):
+    """The response a retry of an already submitted request gets"""
+    if record.get('status') == 'completed' and record.get('response') is not None:
+        response = jsonify(record['response'])
+        response.status_code = record['status_code']
+    else:
+        # Still sending, or its first response was a stream: report where the campaign is
+        campaign_id = record.get('campaign_id')
+        response = jsonify({
+            'status': 'success',
+            'message': 'Campaign already submitted',
+            'details': {
+                'campaign_id': campaign_id,
+                'state': record.get('status'),
+                'stats': CampaignStats.get(user_id, campaign_id) if campaign_id else None
+            }
+        })
+        response.status_code = 200 if record.get('status') == 'completed' else 202
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+class _Heartbeat:
+    """Renews a running request's reservation in the background while its view sends"""
+
+    def __init__(self, request_id, campaign_id, ttl_seconds, interval):
+        self.request_id = request_id
+        self.campaign_id = campaign_id
+        self.ttl_seconds = ttl_seconds
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"send-request-heartbeat-{campaign_id}",
+                                        daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                if not SendRequest.heartbeat(self.request_id, self.campaign_id, self.ttl_seconds):
+                    logger.warning(f"Send request {self.request_id} was taken over while running")
+                    return
+            except Exception as e:
+                # Keep trying until the lease would have run out anyway
+                logger.error(f"Error renewing send request {self.request_id}: {e}")
+
+
+def _response_campaign_id(body):
+    """The campaign id a successful /send-emails response reports, if any"""
+    if not isinstance(body, dict):
+        return None
+    details = body.get('details') or body.get('campaign') or {}
+    return details.get('campaign_id') or details.get('id')
+
+
+def idempotent_send(view):
+    """Make a campaign-submitting view safe to retry.
+
+    A request is identified by its Idempotency-Key header or, without one,
+    by a hash of its content. The first request reserves a record before
+    anything is sent; a retry of it gets the stored response once it has
+    finished and the campaign's live status while it is still sending, so
+    a client retrying after a timeout never sends the campaign twice. The
+    reservation is renewed every IDEMPOTENCY_HEARTBEAT while the view runs;
+    one not renewed for IDEMPOTENCY_LEASE was lost with its worker, and the
+    next retry takes it over. The view finds the campaign id to use in
+    g.campaign_id. Failed requests are
+    forgotten so they can be retried, and "allow_duplicate": true sends an
+    identical campaign again on purpose.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        user_id = get_jwt_identity()
+        data = request.get_json(silent=True) or {}
+        key = request.headers.get('Idempotency-Key')
+        g.campaign_id = uuid.uuid4().hex
+
+        if key:
+            if len(key) > MAX_KEY_LENGTH:
+                return jsonify({
+                    'status': 'error',
+                    'message': f'Idempotency-Key must be at most {MAX_KEY_LENGTH} characters'
+                }), 400
+            request_id, ttl = f"key:{user_id}:{key}", IDEMPOTENCY_TTL
+        elif DUPLICATE_WINDOW and not data.get('allow_duplicate'):
+            request_id, ttl = None, DUPLICATE_WINDOW
+        else:
+            return view(*args, **kwargs)
+
+        fingerprint = request_fingerprint(data)
+        request_id = request_id or f"hash:{user_id}:{fingerprint}"
+        # A second try covers the record being released between our insert and read
+        for _ in range(2):
+            try:
+                SendRequest.reserve(request_id, user_id, fingerprint, g.campaign_id, ttl)
+                break
+            except DuplicateKeyError:
+                record = SendRequest.get(request_id)
+                if record is None:
+                    continue
+                if record['fingerprint'] != fingerprint:
+                    return jsonify({
+                        'status': 'error',
+                        'message': 'Idempotency-Key was already used for a different request'
+                    }), 422
+                if record.get('status') == 'running' and SendRequest.take_over(
+                        request_id, fingerprint, g.campaign_id, IDEMPOTENCY_LEASE):
+                    logger.warning(f"Taking over send request {request_id}, abandoned while running")
+                    break
+                return replay_response(record, user_id)
+
+        try:
+            with _Heartbeat(request_id, g.campaign_id, ttl, IDEMPOTENCY_HEARTBEAT):
+                response = make_response(view(*args, **kwargs))
+        except Exception:
+            SendRequest.release(request_id)
+            raise
+
+        try:
+            if response.status_code >= 400:
+                SendRequest.release(request_id)
+            elif response.is_streamed:
+                SendRequest.complete(request_id, g.campaign_id, None, response.status_code)
+            else:
+                body = response.get_json(silent=True)
+                SendRequest.complete(request_id, _response_campaign_id(body) or g.campaign_id,
+                                     body, response.status_code)
+        except Exception as e:
+            # The campaign was submitted; failing to remember it only costs retry safety
+            logger.error(f"Error storing send request {request_id}: {e}")
+        return response
+
+    return wrapper
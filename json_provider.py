@@ -0,0 +1,47 @@
+import json
+from datetime import datetime
+from bson import ObjectId
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - falls back to the stdlib encoder
+    orjson = None
+
+
+def json_default(obj):
+    """Serialize the Mongo and datetime types our documents carry"""
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    return DefaultJSONProvider.default(obj)
+
+
+def fast_dumps(obj):
+    """Serialize obj to UTF-8 JSON bytes, using orjson when installed"""
+    if orjson is not None:
+        return orjson.dumps(obj, default=json_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, default=json_default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson with native ObjectId/datetime support"""
+
+    default = staticmethod(json_default)
+    sort_keys = False
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            kwargs.setdefault('default', json_default)
+            return json.dumps(obj, **kwargs)
+        return fast_dumps(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return json.loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(fast_dumps(obj) + b'\n', mimetype=self.mimetype)
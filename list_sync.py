@@ -0,0 +1,43 @@
+import hashlib
+import zlib
+
+# Chunk counts a client may split its list into; always a power of two
+MAX_SYNC_CHUNKS = 4096
+# Hex digits of each chunk's digest that are compared
+CHUNK_HASH_LENGTH = 16
+
+
+def chunk_of(email, chunks):
+    """The chunk an address belongs to: CRC-32 of its UTF-8 bytes, modulo the chunk count"""
+    return zlib.crc32(email.encode('utf-8')) % chunks
+
+
+def split_chunks(emails, chunks):
+    """Distinct addresses grouped by chunk, each chunk sorted"""
+    buckets = [set() for _ in range(chunks)]
+    for email in emails:
+        buckets[chunk_of(email, chunks)].add(email)
+    return [sorted(bucket) for bucket in buckets]
+
+
+def chunk_hash(bucket):
+    """Digest of one sorted chunk; an empty chunk hashes the empty string"""
+    return hashlib.sha256('\n'.join(bucket).encode('utf-8')).hexdigest()[:CHUNK_HASH_LENGTH]
+
+
+def valid_chunk_count(chunks):
+    return isinstance(chunks, int) and 0 < chunks <= MAX_SYNC_CHUNKS and chunks & (chunks - 1) == 0
+
+
+def differing_chunks(emails, chunks, client_hashes):
+    """The server's contents of every chunk whose hash differs from the client's.
+
+    Membership, not order, is compared: both sides place each address in a
+    chunk by CRC-32 and hash the chunk's sorted distinct addresses, so one
+    edited address changes one or two chunks of a 200k list.
+    """
+    differing = {}
+    for index, bucket in enumerate(split_chunks(emails, chunks)):
+        if chunk_hash(bucket) != client_hashes[index]:
+            differing[index] = bucket
+    return differing
@@ -0,0 +1,280 @@
+import fcntl
+import gzip
+import json
+import logging
+import os
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from data_dir import data_path, ensure_parent
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - gzip only
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+LOG_DIR = "logs"
+# Rotate a user's live log once it is this large, or this old (seconds)
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', 10 * 1024 * 1024))
+LOG_MAX_AGE = int(os.getenv('LOG_MAX_AGE', 24 * 3600))
+# Default retention of archived segments
+LOG_RETENTION_DAYS = int(os.getenv('LOG_RETENTION_DAYS', 30))
+LOG_RETENTION_SEGMENTS = int(os.getenv('LOG_RETENTION_SEGMENTS', 50))
+# Per-tenant overrides, e.g. '{"<user_id>": {"days": 90, "segments": 200}}'
+LOG_RETENTION = json.loads(os.getenv('LOG_RETENTION', '{}'))
+# 'zstd' when the zstandard package is installed, otherwise 'gzip'
+LOG_COMPRESSION = os.getenv('LOG_COMPRESSION', 'zstd' if zstandard is not None else 'gzip')
+# How often idle logs are rotated by age and retention is enforced
+LOG_SWEEP_INTERVAL = int(os.getenv('LOG_SWEEP_INTERVAL', 3600))
+
+STAMP_FORMAT = '%Y%m%dT%H%M%S%f'
+ARCHIVE_NAME = re.compile(r'^(?P<user_id>[^.]+)\.(?P<stamp>\d{8}T\d{12})\.log(?P<ext>\.gz|\.zst)?$')
+
+
+def live_log_path(user_id):
+    return os.path.join(LOG_DIR, f"{user_id}.log")
+
+
+def list_archives(user_id=None):
+    """Archived segments as (user_id, stamp, path), oldest first.
+
+    A segment that is still being compressed shows up once, as its plain
+    .log file, until the compressed copy replaces it.
+    """
+    segments = {}
+    for name in os.listdir(LOG_DIR):
+        match = ARCHIVE_NAME.match(name)
+        if not match or (user_id is not None and match['user_id'] != str(user_id)):
+            continue
+        key = (match['user_id'], match['stamp'])
+        # Prefer the compressed copy when both exist mid-compression
+        if key not in segments or match['ext']:
+            segments[key] = os.path.join(LOG_DIR, name)
+    return [(user, stamp, path) for (user, stamp), path in sorted(segments.items())]
+
+
+def read_segment(path):
+    """Return the decompressed contents of an archived segment"""
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise RuntimeError(f"zstandard is required to read {path}")
+        with open(path, 'rb') as f:
+            return zstandard.ZstdDecompressor().stream_reader(f).read()
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rb') as f:
+            return f.read()
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def iter_archived_lines(user_id):
+    """Yield the lines of a user's archived segments, newest first.
+
+    Segments are bounded by LOG_MAX_BYTES, so each is decompressed whole,
+    and only once a reader has gone past everything newer.
+    """
+    for _, stamp, path in reversed(list_archives(user_id)):
+        try:
+            data = read_segment(path)
+        except FileNotFoundError:
+            # Compressed (or expired) between listing and reading
+            compressed = [p for _, s, p in list_archives(user_id) if s == stamp]
+            if not compressed:
+                continue
+            data = read_segment(compressed[0])
+        for line in reversed(data.split(b'\n')):
+            if line.strip():
+                yield line.decode('utf-8')
+
+
+def compress_segment(path):
+    """Compress a rotated plain segment next to itself and remove the original"""
+    if LOG_COMPRESSION == 'zstd' and zstandard is not None:
+        target = path + '.zst'
+        # The temp name is per process, as a sweep in another worker may race us
+        tmp = f"{target}.{os.getpid()}.tmp"
+        with open(path, 'rb') as src, open(tmp, 'wb') as dst:
+            zstandard.ZstdCompressor(level=3).copy_stream(src, dst)
+    else:
+        target = path + '.gz'
+        tmp = f"{target}.{os.getpid()}.tmp"
+        with open(path, 'rb') as src, gzip.open(tmp, 'wb', compresslevel=6) as dst:
+            while True:
+                chunk = src.read(1024 * 1024)
+                if not chunk:
+                    break
+                dst.write(chunk)
+    os.replace(tmp, target)
+    os.remove(path)
+
+
+def retention_for(user_id):
+    overrides = LOG_RETENTION.get(str(user_id), {})
+    return overrides.get('days', LOG_RETENTION_DAYS), overrides.get('segments', LOG_RETENTION_SEGMENTS)
+
+
+def apply_retention(user_id, archives=None):
+    """Delete a user's archived segments past their age or count limit"""
+    days, max_segments = retention_for(user_id)
+    archives = list_archives(user_id) if archives is None else archives
+    cutoff = (datetime.utcnow() - timedelta(days=days)).strftime(STAMP_FORMAT)
+    excess = len(archives) - max_segments
+    for index, (_, stamp, path) in enumerate(archives):
+        if index < excess or stamp < cutoff:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def remove_archives(user_id):
+    for _, _, path in list_archives(user_id):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class _RotationLock:
+    """Per-user flock so only one worker process rotates a log at a time"""
+
+    def __init__(self, user_id):
+        self.path = ensure_parent(data_path('locks', f"log-{user_id}.lock"))
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.path, 'w')
+        try:
+            fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self.file.close()
+            self.file = None
+        return self.file is not None
+
+    def __exit__(self, *exc):
+        if self.file is not None:
+            self.file.close()
+
+
+def rotate(user_id, max_bytes=None, max_age=None):
+    """Move the live log aside if it exceeds max_bytes or max_age, then compress it"""
+    log_file = live_log_path(user_id)
+    with _RotationLock(user_id) as locked:
+        if not locked:
+            return False
+        try:
+            stat = os.stat(log_file)
+        except FileNotFoundError:
+            return False
+        too_big = max_bytes is not None and stat.st_size >= max_bytes
+        too_old = max_age is not None and stat.st_size and time.time() - log_started_at(log_file) >= max_age
+        if not (too_big or too_old):
+            return False
+
+        archived = os.path.join(LOG_DIR, f"{user_id}.{datetime.utcnow().strftime(STAMP_FORMAT)}.log")
+        # Writers open the live path per entry, so the next one starts a fresh file
+        os.rename(log_file, archived)
+
+    _compressor.submit(user_id, archived)
+    return True
+
+
+def log_started_at(log_file):
+    """Time of the first entry in a live log"""
+    with open(log_file, 'r') as f:
+        first = f.readline()
+    try:
+        started = datetime.fromisoformat(json.loads(first)['timestamp'])
+        return started.replace(tzinfo=timezone.utc).timestamp()
+    except Exception:
+        return os.stat(log_file).st_mtime
+
+
+def maybe_rotate(user_id, size):
+    """Called after each append with the live log's size; rotates when it is full"""
+    if size >= LOG_MAX_BYTES:
+        try:
+            rotate(user_id, max_bytes=LOG_MAX_BYTES)
+        except Exception as e:
+            logger.error(f"Error rotating log for {user_id}: {e}")
+
+
+class _Compressor:
+    """Background thread that compresses rotated segments and enforces retention.
+
+    Keeps compression off the request that triggered a rotation, and every
+    LOG_SWEEP_INTERVAL rotates idle logs by age, compresses any segment left
+    plain by a crash and applies retention to all users.
+    """
+
+    def __init__(self):
+        self._queue = []
+        self._lock = threading.Condition()
+        self._thread = None
+        self._next_sweep = 0.0
+
+    def submit(self, user_id, path):
+        with self._lock:
+            self._queue.append((user_id, path))
+            self._start()
+            self._lock.notify()
+
+    def start(self):
+        with self._lock:
+            self._start()
+
+    def _start(self):
+        # Started lazily so the thread is created in each forked gunicorn worker
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='log-compressor', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._queue and time.time() < self._next_sweep:
+                    self._lock.wait(self._next_sweep - time.time())
+                queue, self._queue = self._queue, []
+
+            for user_id, path in queue:
+                self._compress(user_id, path)
+            if time.time() >= self._next_sweep:
+                self._next_sweep = time.time() + LOG_SWEEP_INTERVAL
+                self.sweep()
+
+    def _compress(self, user_id, path):
+        try:
+            compress_segment(path)
+            apply_retention(user_id)
+        except FileNotFoundError:
+            pass  # Another worker process compressed it first
+        except Exception as e:
+            logger.error(f"Error compressing log segment {path}: {e}")
+
+    def sweep(self):
+        try:
+            users = set()
+            for name in os.listdir(LOG_DIR):
+                if name.endswith('.log') and '.' not in name[:-4]:
+                    users.add(name[:-4])
+            for user_id, _, path in list_archives():
+                users.add(user_id)
+                if path.endswith('.log'):
+                    self._compress(user_id, path)
+            for user_id in users:
+                rotate(user_id, max_age=LOG_MAX_AGE)
+                apply_retention(user_id)
+        except Exception as e:
+            logger.error(f"Error sweeping logs: {e}")
+
+
+_compressor = _Compressor()
+
+
+def start_log_maintenance():
+    """Start this process's compression and retention thread"""
+    _compressor.start()
@@ -0,0 +1,74 @@
+from email import encoders
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.policy import compat32
+
+# Free of Mongo and Flask imports, so build pool processes load this module cheaply
+from dkim_signer import DKIMSigner, body_hash, parse_headers
+
+UNDISCLOSED_RECIPIENTS = 'undisclosed-recipients:;'
+SMTP_POLICY = compat32.clone(linesep='\r\n')
+
+# DKIM signers of pool processes, by (domain, selector, private key)
+_signers = {}
+
+
+def build_bulk_message(sender_name, username, recipient, subject, body_text, attachments=None):
+    """Build the message sent by the bulk loop; returns it and the attachments that failed"""
+    msg = MIMEMultipart()
+    msg['From'] = f"{sender_name} <{username}>"
+    msg['To'] = recipient
+    msg['Subject'] = subject
+
+    # Add HTML body
+    msg.attach(MIMEText(body_text, 'html'))
+
+    failed = []
+    for attachment in attachments or []:
+        try:
+            part = MIMEBase('application', 'octet-stream')
+            part.set_payload(attachment['content'])
+            encoders.encode_base64(part)
+            part.add_header(
+                'Content-Disposition',
+                f'attachment; filename="{attachment["filename"]}"'
+            )
+            msg.attach(part)
+        except Exception as attach_err:
+            failed.append((attachment['filename'], str(attach_err)))
+
+    return msg, failed
+
+
+def encode_message(msg, signed=False):
+    """Flatten a message once into its header block and body, plus the DKIM body hash if signed"""
+    header_bytes, _, body = msg.as_bytes(policy=SMTP_POLICY).partition(b'\r\n\r\n')
+    return header_bytes, body, body_hash(body) if signed else None
+
+
+def encode_bulk_message(sender_name, username, subject, body_text, attachments=None, signed=False):
+    """build_bulk_message and encode_message in one call, as a build pool task"""
+    msg, failed = build_bulk_message(sender_name, username, UNDISCLOSED_RECIPIENTS, subject, body_text, attachments)
+    header_bytes, body, bh = encode_message(msg, signed)
+    return header_bytes, body, bh, failed
+
+
+def address_headers(headers, recipient, signer=None, bh=None):
+    """A header block addressed to recipient, DKIM-signed when there is a signer"""
+    header_bytes = b''.join(
+        name + b':' + (b' ' + recipient.encode('utf-8') if name.lower() == b'to' else value) + b'\r\n'
+        for name, value in headers
+    )
+    if signer is not None:
+        header_bytes = signer.sign(header_bytes, bh) + header_bytes
+    return header_bytes
+
+
+def sign_headers_batch(header_bytes, recipients, dkim, bh):
+    """Signed header blocks for many recipients, as a build pool task; dkim is (domain, selector, key)"""
+    signer = _signers.get(dkim)
+    if signer is None:
+        signer = _signers[dkim] = DKIMSigner(*dkim)
+    headers = parse_headers(header_bytes)
+    return [address_headers(headers, recipient, signer, bh) for recipient in recipients]
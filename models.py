@@ -1,7 +1,7 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 from bson import ObjectId
-from pymongo import MongoClient
-from pymongo.errors import ServerSelectionTimeoutError, PyMongoError
+from pymongo import MongoClient, ReturnDocument, UpdateOne
+from pymongo.errors import ServerSelectionTimeoutError, PyMongoError, DuplicateKeyError
 from werkzeug.security import generate_password_hash, check_password_hash
 import logging
 from dotenv import load_dotenv
@@ -9,6 +9,8 @@ import os
 import json
 from bson.binary import Binary
 import base64
+from campaign_stats import unstat_key
+from tracing import mongo_event_listeners
 
 # Load environment variables
 load_dotenv()
@@ -23,7 +25,8 @@ try:
     if not MONGODB_URI:
         raise ValueError("MongoDB URI not found in environment variables")
 
-    client = MongoClient(MONGODB_URI, serverSelectionTimeoutMS=5000)
+    # Commands run inside a sampled trace are recorded as spans
+    client = MongoClient(MONGODB_URI, serverSelectionTimeoutMS=5000, event_listeners=mongo_event_listeners())
     # Test the connection
     client.server_info()
     db = client['email_sender']  # Use the database name from your URI
@@ -38,6 +41,9 @@ except Exception as e:
     logger.error(f"Unexpected error: {e}")
     raise
 
+# Per-recipient campaign results are kept this long
+RESULTS_TTL_DAYS = int(os.getenv('RESULTS_TTL_DAYS', 30))
+
 def setup_collections():
     try:
         # Create smtp_settings collection with schema validation
@@ -56,6 +62,15 @@ def setup_collections():
                         'password': {'bsonType': 'string'},
                         'sender_name': {'bsonType': 'string'},
                         'delay': {'bsonType': 'int'},
+                        'min_delay': {'bsonType': ['double', 'int']},
+                        'max_delay': {'bsonType': ['double', 'int']},
+                        'dkim_domain': {'bsonType': ['string', 'null']},
+                        'dkim_selector': {'bsonType': ['string', 'null']},
+                        'dkim_private_key': {'bsonType': ['string', 'null']},
+                        'weight': {'bsonType': 'int'},
+                        'hourly_cap': {'bsonType': 'int'},
+                        'relays': {'bsonType': 'array'},
+                        'transport': {'bsonType': ['string', 'null']},
                         'updated_at': {'bsonType': 'date'}
                     }
                 }
@@ -90,13 +105,39 @@ def setup_collections():
             logger.error(f"Error setting up collections: {e}")
             raise
 
+    try:
+        # Due scheduled campaigns are looked up by status and send time
+        db['scheduled_campaigns'].create_index([('status', 1), ('send_at', 1)])
+        db['scheduled_campaigns'].create_index([('user_id', 1), ('send_at', -1)])
+        db['campaign_stats'].create_index([('user_id', 1), ('created_at', -1)])
+        db['campaign_results'].create_index([('campaign_id', 1), ('_id', 1)])
+        db['campaign_results'].create_index('created_at', expireAfterSeconds=RESULTS_TTL_DAYS * 86400)
+        db['campaign_results'].create_index([('campaign_id', 1), ('email', 1)])
+        # Claimable shards are looked up by status and lease expiry, oldest first
+        db['campaign_shards'].create_index([('status', 1), ('lease_expires', 1), ('created_at', 1)])
+        db['campaign_shards'].create_index([('campaign_id', 1), ('status', 1)])
+        # Remembered send requests expire at their own expires_at
+        db['send_requests'].create_index('expires_at', expireAfterSeconds=0)
+    except Exception as e:
+        logger.error(f"Error creating indexes: {e}")
+        raise
+
+    try:
+        # Delta sync's first write upserts, so a user must never end up with two lists
+        db['email_lists'].create_index('user_id', unique=True)
+    except Exception as e:
+        # Existing duplicate lists only lose the guarantee, not the service
+        logger.error(f"Error creating unique email list index: {e}")
+
 # Call setup_collections after establishing connection
 setup_collections()
 
 class SmtpSettings:
     collection = db['smtp_settings']
 
-    def __init__(self, user_id, smtp_server, smtp_port, username, password, sender_name=None, delay=5):
+    def __init__(self, user_id, smtp_server, smtp_port, username, password, sender_name=None, delay=5,
+                 min_delay=0, max_delay=30, dkim_domain=None, dkim_selector=None, dkim_private_key=None,
+                 weight=1, hourly_cap=0, relays=None, transport=None):
         self.user_id = ObjectId(user_id) if isinstance(user_id, str) else user_id
         self.smtp_server = smtp_server
         self.smtp_port = smtp_port
@@ -104,6 +145,15 @@ class SmtpSettings:
         self.password = password
         self.sender_name = sender_name
         self.delay = delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.dkim_domain = dkim_domain
+        self.dkim_selector = dkim_selector
+        self.dkim_private_key = dkim_private_key
+        self.weight = weight
+        self.hourly_cap = hourly_cap
+        self.relays = relays or []
+        self.transport = transport
 
     @classmethod
     def get_by_user_id(cls, user_id):
@@ -119,7 +169,16 @@ class SmtpSettings:
                     username=settings['username'],
                     password=settings['password'],
                     sender_name=settings.get('sender_name'),
-                    delay=settings.get('delay', 5)
+                    delay=settings.get('delay', 5),
+                    min_delay=settings.get('min_delay', 0),
+                    max_delay=settings.get('max_delay', 30),
+                    dkim_domain=settings.get('dkim_domain'),
+                    dkim_selector=settings.get('dkim_selector'),
+                    dkim_private_key=settings.get('dkim_private_key'),
+                    weight=settings.get('weight', 1),
+                    hourly_cap=settings.get('hourly_cap', 0),
+                    relays=settings.get('relays', []),
+                    transport=settings.get('transport')
                 )
             return None
         except Exception as e:
@@ -136,6 +195,15 @@ class SmtpSettings:
                 'password': self.password,
                 'sender_name': self.sender_name,
                 'delay': self.delay,
+                'min_delay': self.min_delay,
+                'max_delay': self.max_delay,
+                'dkim_domain': self.dkim_domain,
+                'dkim_selector': self.dkim_selector,
+                'dkim_private_key': self.dkim_private_key,
+                'weight': self.weight,
+                'hourly_cap': self.hourly_cap,
+                'relays': self.relays,
+                'transport': self.transport,
                 'updated_at': datetime.utcnow()
             }
             
@@ -160,11 +228,22 @@ class SmtpSettings:
             'username': self.username,
             'password': self.password,
             'sender_name': self.sender_name,
-            'delay': self.delay
+            'delay': self.delay,
+            'min_delay': self.min_delay,
+            'max_delay': self.max_delay,
+            'dkim_domain': self.dkim_domain,
+            'dkim_selector': self.dkim_selector,
+            'dkim_private_key': self.dkim_private_key,
+            'weight': self.weight,
+            'hourly_cap': self.hourly_cap,
+            'relays': self.relays,
+            'transport': self.transport
         }
 
     @classmethod
-    def save_settings(cls, user_id, smtp_server, smtp_port, username, password, sender_name=None, delay=5):
+    def save_settings(cls, user_id, smtp_server, smtp_port, username, password, sender_name=None, delay=5,
+                      min_delay=0, max_delay=30, dkim_domain=None, dkim_selector=None, dkim_private_key=None,
+                      weight=1, hourly_cap=0, relays=None, transport=None):
         # Convert string ID to ObjectId if necessary
         user_id_obj = ObjectId(user_id) if isinstance(user_id, str) else user_id
         settings = cls(
@@ -174,7 +253,16 @@ class SmtpSettings:
             username=username,
             password=password,
             sender_name=sender_name,
-            delay=delay
+            delay=delay,
+            min_delay=min_delay,
+            max_delay=max_delay,
+            dkim_domain=dkim_domain,
+            dkim_selector=dkim_selector,
+            dkim_private_key=dkim_private_key,
+            weight=weight,
+            hourly_cap=hourly_cap,
+            relays=relays,
+            transport=transport
         )
         return settings.save()
 
@@ -293,11 +381,13 @@ class EmailTemplate:
         }
 
 class EmailList:
+    """A user's saved recipients; version counts every change, for delta sync"""
     collection = db['email_lists']
 
-    def __init__(self, user_id, emails):
+    def __init__(self, user_id, emails, version=0):
         self.user_id = ObjectId(user_id) if isinstance(user_id, str) else user_id
         self.emails = emails
+        self.version = version
 
     @classmethod
     def get_by_user_id(cls, user_id):
@@ -305,12 +395,24 @@ class EmailList:
             user_id_obj = ObjectId(user_id) if isinstance(user_id, str) else user_id
             result = cls.collection.find_one({'user_id': user_id_obj})
             if result:
-                return cls(user_id=result['user_id'], emails=result['emails'])
+                return cls(user_id=result['user_id'], emails=result.get('emails', []), version=result.get('version', 0))
             return None
         except Exception as e:
             logger.error(f"Error retrieving email list: {e}")
             raise
 
+    @classmethod
+    def iter_emails(cls, user_id, batch_size=1000):
+        """Yield a user's saved addresses from a cursor, batch_size at a time"""
+        user_id_obj = ObjectId(user_id) if isinstance(user_id, str) else user_id
+        cursor = cls.collection.aggregate([
+            {'$match': {'user_id': user_id_obj}},
+            {'$unwind': '$emails'},
+            {'$project': {'_id': 0, 'email': '$emails'}}
+        ], batchSize=batch_size)
+        for doc in cursor:
+            yield doc['email']
+
     def save(self):
         try:
             data = {
@@ -319,17 +421,593 @@ class EmailList:
                 'updated_at': datetime.utcnow()
             }
             
-            result = self.collection.update_one(
+            result = self.collection.find_one_and_update(
                 {'user_id': self.user_id},
-                {'$set': data},
-                upsert=True
+                {'$set': data, '$inc': {'version': 1}},
+                projection={'version': 1},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
             )
+            self.version = result['version']
             return self
         except Exception as e:
             logger.error(f"Error saving email list: {e}")
             raise
 
+    @classmethod
+    def apply_delta(cls, user_id, base_version, add=None, remove=None):
+        """Apply adds and removes made against base_version.
+
+        Returns the new version, or None when the list has changed since
+        base_version. Mongo edits the array in place with one pipeline
+        update guarded on base_version, so a delta neither reads nor
+        rewrites the whole list and lands whole or not at all.
+        """
+        user_id_obj = ObjectId(user_id) if isinstance(user_id, str) else user_id
+        add = list(dict.fromkeys(add or []))
+        # An address both added and removed ends up in the list, as if removed first
+        remove = list(set(remove or []) - set(add))
+        current = {'$ifNull': ['$emails', []]}
+        pipeline = [{'$set': {
+            'emails': {'$let': {
+                # $literal keeps addresses starting with '$' from reading as field paths
+                'vars': {'add': {'$literal': add}, 'remove': {'$literal': remove}},
+                'in': {'$concatArrays': [
+                    {'$filter': {'input': current, 'as': 'email',
+                                 'cond': {'$not': {'$in': ['$$email', '$$remove']}}}},
+                    {'$filter': {'input': '$$add', 'as': 'email',
+                                 'cond': {'$not': {'$in': ['$$email', current]}}}}
+                ]}
+            }},
+            'version': {'$add': [{'$ifNull': ['$version', 0]}, 1]},
+            'updated_at': datetime.utcnow()
+        }}]
+
+        # Lists saved before versioning have no version field and count as 0
+        query = {'user_id': user_id_obj, 'version': {'$in': [0, None]} if base_version == 0 else base_version}
+        try:
+            result = cls.collection.update_one(query, pipeline, upsert=base_version == 0)
+        except DuplicateKeyError:
+            # The upsert found the list already past version 0
+            return None
+        if not result.matched_count and result.upserted_id is None:
+            return None
+        return base_version + 1
+
+    @classmethod
+    def get_version(cls, user_id):
+        user_id_obj = ObjectId(user_id) if isinstance(user_id, str) else user_id
+        doc = cls.collection.find_one({'user_id': user_id_obj}, {'version': 1})
+        return doc.get('version', 0) if doc else 0
+
     def to_dict(self):
         return {
-            'emails': self.emails
-        }
\ No newline at end of file
+            'emails': self.emails,
+            'version': self.version
+        }
+
+class ScheduledCampaign:
+    collection = db['scheduled_campaigns']
+
+    def __init__(self, user_id, emails, subject, body, send_at, attachments=None, window=None,
+                 batch_recipients=False, status='scheduled', _id=None, result=None):
+        self._id = _id
+        self.user_id = ObjectId(user_id) if isinstance(user_id, str) else user_id
+        self.emails = emails
+        self.subject = subject
+        self.body = body
+        self.send_at = send_at
+        self.attachments = attachments or []
+        self.window = window
+        self.batch_recipients = batch_recipients
+        self.status = status
+        self.result = result
+
+    @classmethod
+    def from_document(cls, doc):
+        return cls(
+            _id=doc['_id'],
+            user_id=doc['user_id'],
+            emails=doc['emails'],
+            subject=doc['subject'],
+            body=doc['body'],
+            send_at=doc['send_at'],
+            attachments=[
+                {
+                    'filename': attachment['filename'],
+                    'content': bytes(attachment['content']),
+                    'content_type': attachment['content_type']
+                }
+                for attachment in doc.get('attachments', [])
+            ],
+            window=doc.get('window'),
+            batch_recipients=doc.get('batch_recipients', False),
+            status=doc.get('status', 'scheduled'),
+            result=doc.get('result')
+        )
+
+    def save(self):
+        try:
+            data = {
+                'user_id': self.user_id,
+                'emails': self.emails,
+                'subject': self.subject,
+                'body': self.body,
+                'send_at': self.send_at,
+                'attachments': [
+                    {
+                        'filename': attachment['filename'],
+                        'content': Binary(attachment['content']),
+                        'content_type': attachment['content_type']
+                    }
+                    for attachment in self.attachments
+                ],
+                'window': self.window,
+                'batch_recipients': self.batch_recipients,
+                'status': self.status,
+                'created_at': datetime.utcnow()
+            }
+            self._id = self.collection.insert_one(data).inserted_id
+            return self
+        except Exception as e:
+            logger.error(f"Error saving scheduled campaign: {e}")
+            raise
+
+    @classmethod
+    def iter_pending(cls, due_before=None):
+        """Yield (id, send_at) of campaigns still waiting to be sent"""
+        query = {'status': 'scheduled'}
+        if due_before is not None:
+            query['send_at'] = {'$lte': due_before}
+        for doc in cls.collection.find(query, {'send_at': 1}).batch_size(5000):
+            yield doc['_id'], doc['send_at']
+
+    @classmethod
+    def claim(cls, campaign_id):
+        """Atomically move a due campaign to running; None if another process got it"""
+        doc = cls.collection.find_one_and_update(
+            {'_id': campaign_id, 'status': 'scheduled', 'send_at': {'$lte': datetime.utcnow()}},
+            {'$set': {'status': 'running', 'started_at': datetime.utcnow()}},
+            return_document=ReturnDocument.AFTER
+        )
+        return cls.from_document(doc) if doc else None
+
+    @classmethod
+    def reschedule(cls, campaign_id, send_at):
+        cls.collection.update_one(
+            {'_id': campaign_id},
+            {'$set': {'status': 'scheduled', 'send_at': send_at}}
+        )
+
+    @classmethod
+    def mark_finished(cls, campaign_id, status, result=None):
+        cls.collection.update_one(
+            {'_id': campaign_id},
+            {'$set': {'status': status, 'result': result, 'finished_at': datetime.utcnow()}}
+        )
+
+    @classmethod
+    def cancel(cls, user_id, campaign_id):
+        user_id_obj = ObjectId(user_id) if isinstance(user_id, str) else user_id
+        result = cls.collection.update_one(
+            {'_id': ObjectId(campaign_id), 'user_id': user_id_obj, 'status': 'scheduled'},
+            {'$set': {'status': 'cancelled', 'finished_at': datetime.utcnow()}}
+        )
+        return result.modified_count == 1
+
+    @classmethod
+    def get_by_user_id(cls, user_id, limit=100):
+        user_id_obj = ObjectId(user_id) if isinstance(user_id, str) else user_id
+        docs = cls.collection.find(
+            {'user_id': user_id_obj},
+            {'emails': 0, 'attachments': 0, 'body': 0}
+        ).sort('send_at', -1).limit(limit)
+        return [
+            {
+                'id': str(doc['_id']),
+                'subject': doc['subject'],
+                'send_at': doc['send_at'],
+                'window': doc.get('window'),
+                'status': doc['status'],
+                'result': doc.get('result')
+            }
+            for doc in docs
+        ]
+
+    def to_dict(self):
+        return {
+            'id': str(self._id),
+            'subject': self.subject,
+            'send_at': self.send_at,
+            'window': self.window,
+            'status': self.status,
+            'total': len(self.emails)
+        }
+
+
+class CampaignStats:
+    """Running counters of one campaign, keyed by campaign id"""
+    collection = db['campaign_stats']
+
+    @classmethod
+    def start(cls, campaign_id, user_id, total, subject=None):
+        user_id_obj = ObjectId(user_id) if isinstance(user_id, str) else user_id
+        cls.collection.update_one(
+            {'_id': campaign_id},
+            {
+                '$set': {'status': 'running', 'total': total, 'started_at': datetime.utcnow()},
+                '$setOnInsert': {'user_id': user_id_obj, 'subject': subject, 'created_at': datetime.utcnow()}
+            },
+            upsert=True
+        )
+
+    @classmethod
+    def increment_many(cls, increments):
+        """Apply {campaign_id: {field: amount}} as one unordered bulk of $inc updates"""
+        operations = [
+            UpdateOne(
+                {'_id': campaign_id},
+                {'$inc': fields, '$set': {'updated_at': datetime.utcnow()}},
+                upsert=True
+            )
+            for campaign_id, fields in increments.items() if fields
+        ]
+        if operations:
+            cls.collection.bulk_write(operations, ordered=False)
+
+    @classmethod
+    def record_delivered(cls, campaign_id, success, failed):
+        """Count recipients whose spooled message was finished; returns the campaign's total and running counts"""
+        return cls.collection.find_one_and_update(
+            {'_id': campaign_id},
+            {'$inc': {'delivered.success': success, 'delivered.failed': failed}},
+            projection={'total': 1, 'delivered': 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+
+    @classmethod
+    def finish(cls, campaign_id, status):
+        cls.collection.update_one(
+            {'_id': campaign_id},
+            {'$set': {'status': status, 'finished_at': datetime.utcnow()}}
+        )
+
+    @classmethod
+    def get(cls, user_id, campaign_id):
+        user_id_obj = ObjectId(user_id) if isinstance(user_id, str) else user_id
+        doc = cls.collection.find_one({'_id': campaign_id, 'user_id': user_id_obj})
+        return cls.to_dict(doc) if doc else None
+
+    @staticmethod
+    def to_dict(doc):
+        counts = doc.get('counts', {})
+        return {
+            'id': doc['_id'],
+            'subject': doc.get('subject'),
+            'status': doc.get('status'),
+            'total': doc.get('total'),
+            'success': counts.get('success', 0),
+            'failed': counts.get('failed', 0),
+            'deferred': counts.get('deferred', 0),
+            'domains': {unstat_key(domain): values for domain, values in doc.get('domains', {}).items()},
+            'smtp_codes': doc.get('codes', {}),
+            'started_at': doc.get('started_at'),
+            'updated_at': doc.get('updated_at'),
+            'finished_at': doc.get('finished_at')
+        }
+
+
+class CampaignResult:
+    """Per-recipient outcome of a campaign, one document per recipient"""
+    collection = db['campaign_results']
+
+    @classmethod
+    def insert_many(cls, campaign_id, user_id, results):
+        user_id_obj = ObjectId(user_id) if isinstance(user_id, str) else user_id
+        created_at = datetime.utcnow()
+        cls.collection.insert_many(
+            [dict(result, campaign_id=campaign_id, user_id=user_id_obj, created_at=created_at) for result in results],
+            ordered=False
+        )
+
+    @classmethod
+    def iter_by_campaign(cls, user_id, campaign_id, batch_size=1000):
+        """Yield a campaign's results in send order from a cursor"""
+        user_id_obj = ObjectId(user_id) if isinstance(user_id, str) else user_id
+        cursor = cls.collection.find(
+            {'campaign_id': campaign_id, 'user_id': user_id_obj},
+            {'_id': 0, 'campaign_id': 0, 'user_id': 0, 'created_at': 0}
+        ).sort('_id', 1).batch_size(batch_size)
+        for doc in cursor:
+            yield doc
+
+    @classmethod
+    def recorded_statuses(cls, campaign_id, emails):
+        """Status by address for those of emails that already have a result in a campaign"""
+        cursor = cls.collection.find(
+            {'campaign_id': campaign_id, 'email': {'$in': list(emails)}},
+            {'_id': 0, 'email': 1, 'status': 1}
+        )
+        return {doc['email']: doc['status'] for doc in cursor}
+
+
+class ShardedCampaign:
+    """Message of a campaign whose recipients are split into claimable shards"""
+    collection = db['sharded_campaigns']
+
+    def __init__(self, user_id, subject, body, total, attachments=None, batch_recipients=False,
+                 priority='bulk', status='running', _id=None, result=None):
+        self._id = _id
+        self.user_id = ObjectId(user_id) if isinstance(user_id, str) else user_id
+        self.subject = subject
+        self.body = body
+        self.total = total
+        self.attachments = attachments or []
+        self.batch_recipients = batch_recipients
+        self.priority = priority
+        self.status = status
+        self.result = result
+
+    @property
+    def campaign_id(self):
+        return str(self._id)
+
+    @classmethod
+    def from_document(cls, doc):
+        return cls(
+            _id=doc['_id'],
+            user_id=doc['user_id'],
+            subject=doc['subject'],
+            body=doc['body'],
+            total=doc['total'],
+            attachments=[
+                {
+                    'filename': attachment['filename'],
+                    'content': bytes(attachment['content']),
+                    'content_type': attachment['content_type']
+                }
+                for attachment in doc.get('attachments', [])
+            ],
+            batch_recipients=doc.get('batch_recipients', False),
+            priority=doc.get('priority', 'bulk'),
+            status=doc.get('status', 'running'),
+            result=doc.get('result')
+        )
+
+    def save(self):
+        try:
+            self._id = self.collection.insert_one({
+                'user_id': self.user_id,
+                'subject': self.subject,
+                'body': self.body,
+                'total': self.total,
+                'attachments': [
+                    {
+                        'filename': attachment['filename'],
+                        'content': Binary(attachment['content']),
+                        'content_type': attachment['content_type']
+                    }
+                    for attachment in self.attachments
+                ],
+                'batch_recipients': self.batch_recipients,
+                'priority': self.priority,
+                'status': self.status,
+                'created_at': datetime.utcnow()
+            }).inserted_id
+            return self
+        except Exception as e:
+            logger.error(f"Error saving sharded campaign: {e}")
+            raise
+
+    @classmethod
+    def get(cls, campaign_id):
+        doc = cls.collection.find_one({'_id': ObjectId(campaign_id)})
+        return cls.from_document(doc) if doc else None
+
+    @classmethod
+    def mark_finished(cls, campaign_id, result):
+        """Record the final result; True only for the one caller that finished it"""
+        outcome = cls.collection.update_one(
+            {'_id': ObjectId(campaign_id), 'status': 'running'},
+            {'$set': {'status': 'completed', 'result': result, 'finished_at': datetime.utcnow()}}
+        )
+        return outcome.modified_count == 1
+
+
+class CampaignShard:
+    """A slice of a sharded campaign's recipients, leased to one sender process at a time.
+
+    A shard is pending until a process claims it with an atomic
+    find_one_and_update that sets a lease owner and expiry. The owner renews
+    the lease with heartbeats while sending; a lease left to expire, e.g.
+    because its node died, makes the shard claimable again.
+    """
+    collection = db['campaign_shards']
+
+    @classmethod
+    def insert_many(cls, campaign_id, user_id, shards):
+        user_id_obj = ObjectId(user_id) if isinstance(user_id, str) else user_id
+        created_at = datetime.utcnow()
+        cls.collection.insert_many([
+            {
+                'campaign_id': campaign_id,
+                'user_id': user_id_obj,
+                'index': index,
+                'emails': emails,
+                'status': 'pending',
+                'lease_owner': None,
+                'lease_expires': None,
+                'attempts': 0,
+                'created_at': created_at
+            }
+            for index, emails in enumerate(shards)
+        ], ordered=False)
+
+    @classmethod
+    def claim(cls, owner, lease_seconds, max_attempts):
+        """Lease the oldest pending or expired shard to owner; None when there is none"""
+        now = datetime.utcnow()
+        return cls.collection.find_one_and_update(
+            {
+                '$or': [
+                    {'status': 'pending'},
+                    {'status': 'leased', 'lease_expires': {'$lt': now}}
+                ],
+                'attempts': {'$lt': max_attempts}
+            },
+            {
+                '$set': {
+                    'status': 'leased',
+                    'lease_owner': owner,
+                    'lease_expires': now + timedelta(seconds=lease_seconds),
+                    'claimed_at': now
+                },
+                '$inc': {'attempts': 1}
+            },
+            sort=[('created_at', 1), ('index', 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    @classmethod
+    def heartbeat(cls, shard_id, owner, lease_seconds):
+        """Extend a lease; False when owner no longer holds it"""
+        result = cls.collection.update_one(
+            {'_id': shard_id, 'status': 'leased', 'lease_owner': owner},
+            {'$set': {'lease_expires': datetime.utcnow() + timedelta(seconds=lease_seconds)}}
+        )
+        return result.modified_count == 1
+
+    @classmethod
+    def complete(cls, shard_id, owner, success, failed, status='done', error=None):
+        """Mark a leased shard finished; False when owner lost the lease meanwhile"""
+        result = cls.collection.update_one(
+            {'_id': shard_id, 'status': 'leased', 'lease_owner': owner},
+            {'$set': {
+                'status': status,
+                'success': success,
+                'failed': failed,
+                'error': error,
+                'lease_owner': None,
+                'lease_expires': None,
+                'finished_at': datetime.utcnow()
+            }}
+        )
+        return result.modified_count == 1
+
+    @classmethod
+    def release(cls, shard_id, owner):
+        """Hand a leased shard back untouched, e.g. when the tenant is over its quota"""
+        cls.collection.update_one(
+            {'_id': shard_id, 'status': 'leased', 'lease_owner': owner},
+            {
+                '$set': {'status': 'pending', 'lease_owner': None, 'lease_expires': None},
+                '$inc': {'attempts': -1}
+            }
+        )
+
+    @classmethod
+    def fail_exhausted(cls, max_attempts):
+        """Fail expired shards that used up their attempts; return their campaign ids"""
+        now = datetime.utcnow()
+        query = {'status': 'leased', 'lease_expires': {'$lt': now}, 'attempts': {'$gte': max_attempts}}
+        campaign_ids = cls.collection.distinct('campaign_id', query)
+        if campaign_ids:
+            cls.collection.update_many(query, {'$set': {
+                'status': 'failed',
+                'error': f"Gave up after {max_attempts} attempts",
+                'lease_owner': None,
+                'finished_at': now
+            }})
+        return campaign_ids
+
+    @classmethod
+    def progress(cls, campaign_id):
+        """Shard counts by status, and recipient outcomes of the finished shards"""
+        progress = {'shards': {'pending': 0, 'leased': 0, 'done': 0, 'failed': 0}, 'success': 0, 'failed': 0}
+        for doc in cls.collection.aggregate([
+            {'$match': {'campaign_id': campaign_id}},
+            {'$group': {
+                '_id': '$status',
+                'shards': {'$sum': 1},
+                'success': {'$sum': {'$ifNull': ['$success', 0]}},
+                'failed': {'$sum': {'$ifNull': ['$failed', 0]}}
+            }}
+        ]):
+            progress['shards'][doc['_id']] = doc['shards']
+            progress['success'] += doc['success']
+            progress['failed'] += doc['failed']
+        return progress
+
+
+class SendRequest:
+    """A submitted /send-emails request, remembered so a retry doesn't send it twice"""
+    collection = db['send_requests']
+
+    @classmethod
+    def reserve(cls, request_id, user_id, fingerprint, campaign_id, ttl_seconds):
+        """Record a request as running; raises DuplicateKeyError if it was already submitted"""
+        user_id_obj = ObjectId(user_id) if isinstance(user_id, str) else user_id
+        now = datetime.utcnow()
+        cls.collection.insert_one({
+            '_id': request_id,
+            'user_id': user_id_obj,
+            'fingerprint': fingerprint,
+            'campaign_id': campaign_id,
+            'status': 'running',
+            'created_at': now,
+            'reserved_at': now,
+            'expires_at': now + timedelta(seconds=ttl_seconds)
+        })
+
+    @classmethod
+    def heartbeat(cls, request_id, campaign_id, ttl_seconds):
+        """Renew a running reservation; False when a retry took it over meanwhile"""
+        now = datetime.utcnow()
+        result = cls.collection.update_one(
+            {'_id': request_id, 'status': 'running', 'campaign_id': campaign_id},
+            {'$set': {'reserved_at': now, 'expires_at': now + timedelta(seconds=ttl_seconds)}}
+        )
+        return result.modified_count == 1
+
+    @classmethod
+    def take_over(cls, request_id, fingerprint, campaign_id, lease_seconds):
+        """Reserve a request whose 'running' reservation wasn't renewed within the
+        lease, left by a worker that died mid-request; False if it is still live"""
+        now = datetime.utcnow()
+        result = cls.collection.update_one(
+            {
+                '_id': request_id,
+                'fingerprint': fingerprint,
+                'status': 'running',
+                # Records reserved before leases existed count from their creation
+                '$or': [
+                    {'reserved_at': {'$lt': now - timedelta(seconds=lease_seconds)}},
+                    {'reserved_at': {'$exists': False}, 'created_at': {'$lt': now - timedelta(seconds=lease_seconds)}}
+                ]
+            },
+            {'$set': {'campaign_id': campaign_id, 'reserved_at': now}}
+        )
+        return result.modified_count == 1
+
+    @classmethod
+    def complete(cls, request_id, campaign_id, response, status_code):
+        cls.collection.update_one(
+            {'_id': request_id},
+            {'$set': {
+                'status': 'completed',
+                'campaign_id': campaign_id,
+                'response': response,
+                'status_code': status_code,
+                'finished_at': datetime.utcnow()
+            }}
+        )
+
+    @classmethod
+    def release(cls, request_id):
+        """Forget a request that failed, so that retrying it sends it"""
+        cls.collection.delete_one({'_id': request_id})
+
+    @classmethod
+    def get(cls, request_id):
+        return cls.collection.find_one({'_id': request_id})
@@ -0,0 +1,123 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+
+from dns import resolver as dns_resolver
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on how long an MX answer is reused, whatever its DNS TTL
+MX_CACHE_TTL = int(os.getenv('MX_CACHE_TTL', 3600))
+# How long "no such domain" and "no MX records" answers are reused
+MX_NEGATIVE_TTL = int(os.getenv('MX_NEGATIVE_TTL', 300))
+MX_CACHE_SIZE = int(os.getenv('MX_CACHE_SIZE', 100000))
+# Static MX hosts per domain that take precedence over DNS, most preferred
+# first, e.g. '{"example.com": ["mx1.internal:2525", "mx2.internal"]}'
+MX_ROUTES = json.loads(os.getenv('MX_ROUTES', '{}'))
+
+
+class MXCache:
+    """MX lookups shared by address verification and direct delivery.
+
+    Answers are kept for their DNS TTL, capped at MX_CACHE_TTL, and domains
+    that don't exist or have no MX records for MX_NEGATIVE_TTL. Lookup
+    failures such as timeouts are never cached. The resolver only needs a
+    dnspython-style resolve(domain, 'MX'), so tests can pass a fake one.
+    """
+
+    def __init__(self, resolver=None, routes=None, ttl=MX_CACHE_TTL, negative_ttl=MX_NEGATIVE_TTL,
+                 max_size=MX_CACHE_SIZE):
+        self.resolver = resolver or dns_resolver
+        self.routes = MX_ROUTES if routes is None else routes
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, domain):
+        """A domain's MX records as (preference, host), most preferred first.
+
+        Returns [] when the domain has no MX records and raises
+        resolver.NXDOMAIN when it doesn't exist.
+        """
+        domain = domain.lower().rstrip('.')
+        if domain in self.routes:
+            return [(index * 10, host) for index, host in enumerate(self.routes[domain])]
+
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(domain)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(domain)
+                records = entry[1]
+            else:
+                entry = None
+        if entry is None:
+            records = self._resolve(domain, now)
+
+        if records is None:
+            raise dns_resolver.NXDOMAIN()
+        return records
+
+    def _resolve(self, domain, now):
+        try:
+            answer = self.resolver.resolve(domain, 'MX')
+            records = sorted(
+                (int(record.preference), str(record.exchange).rstrip('.').lower())
+                for record in answer
+            )
+            rrset = getattr(answer, 'rrset', None)
+            ttl = min(self.ttl, rrset.ttl) if rrset is not None else self.ttl
+        except dns_resolver.NXDOMAIN:
+            records, ttl = None, self.negative_ttl
+        except dns_resolver.NoAnswer:
+            records, ttl = [], self.negative_ttl
+
+        with self._lock:
+            self._entries[domain] = (now + ttl, records)
+            self._entries.move_to_end(domain)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return records
+
+    def delivery_hosts(self, domain):
+        """Hosts to hand a domain's mail to, in the order to try them.
+
+        Hosts of equal preference are shuffled to spread load. A domain
+        without MX records is its own mail host (RFC 5321 5.1); a null MX
+        (RFC 7505) means it accepts no mail and gives [].
+        """
+        records = self.lookup(domain)
+        if not records:
+            return [domain]
+        if is_null_mx(records):
+            return []
+        shuffled = sorted(records, key=lambda record: (record[0], random.random()))
+        return [host for _, host in shuffled]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def is_null_mx(records):
+    """True for a null MX (RFC 7505, "0 ."), which declares that a domain accepts no mail"""
+    return any(host == '' for _, host in records)
+
+
+_mx_cache = None
+_mx_cache_lock = threading.Lock()
+
+
+def get_mx_cache():
+    """Return the process-wide MX cache"""
+    global _mx_cache
+    with _mx_cache_lock:
+        if _mx_cache is None:
+            _mx_cache = MXCache()
+        return _mx_cache
@@ -0,0 +1,488 @@
+import fcntl
+import heapq
+import json
+import logging
+import os
+import smtplib
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+from datetime import datetime
+
+from campaign_stats import get_stats
+from data_dir import data_path
+from domain_scheduler import get_domain
+from relay_pool import RelayPool, is_relay_failure
+from result_sink import ResultSink
+
+logger = logging.getLogger(__name__)
+
+# Spool root; each worker process locks its own numbered slot below it
+OUTBOX_DIR = os.getenv('OUTBOX_DIR', data_path('outbox'))
+OUTBOX_MAX_SLOTS = int(os.getenv('OUTBOX_MAX_SLOTS', 64))
+# Start a new segment file once the current one is this large
+OUTBOX_SEGMENT_SIZE = int(os.getenv('OUTBOX_SEGMENT_SIZE', 64 * 1024 * 1024))
+# Messages written between fsyncs
+OUTBOX_FSYNC_BATCH = int(os.getenv('OUTBOX_FSYNC_BATCH', 500))
+# Delivery threads per process
+OUTBOX_WORKERS = int(os.getenv('OUTBOX_WORKERS', 2))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 5))
+OUTBOX_RETRY_DELAY = float(os.getenv('OUTBOX_RETRY_DELAY', 60))
+# How long a user's SMTP settings are reused by the delivery workers
+SETTINGS_CACHE_TTL = 60
+
+# magic, crc32 of meta + data, meta length, data length
+RECORD_HEADER = struct.Struct('>4sIII')
+RECORD_MAGIC = b'OBX1'
+ACK_ENTRY = struct.Struct('>Q')
+
+
+def fsync_dir(path):
+    """Make a file creation or removal in a directory durable"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Segment:
+    """One append-only spool file and its sidecar file of acknowledged offsets"""
+
+    def __init__(self, directory, seq):
+        self.seq = seq
+        self.path = os.path.join(directory, f"{seq:010d}.seg")
+        self.ack_path = os.path.join(directory, f"{seq:010d}.ack")
+        self.records = 0
+        self.acked = set()
+        self.sealed = False
+        self._fd = None
+        self._ack_file = None
+
+    def read(self, offset):
+        """Return the (meta, data) record stored at offset"""
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_RDONLY)
+        header = os.pread(self._fd, RECORD_HEADER.size, offset)
+        _, _, meta_len, data_len = RECORD_HEADER.unpack(header)
+        payload = os.pread(self._fd, meta_len + data_len, offset + RECORD_HEADER.size)
+        return json.loads(payload[:meta_len]), payload[meta_len:]
+
+    def scan(self):
+        """Yield the offset of every intact record; stops at a torn tail"""
+        with open(self.path, 'rb') as f:
+            offset = 0
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    return
+                magic, crc, meta_len, data_len = RECORD_HEADER.unpack(header)
+                payload = f.read(meta_len + data_len)
+                if magic != RECORD_MAGIC or len(payload) < meta_len + data_len or zlib.crc32(payload) != crc:
+                    logger.warning(f"Outbox segment {self.path} is truncated at offset {offset}")
+                    return
+                yield offset
+                offset += RECORD_HEADER.size + meta_len + data_len
+
+    def load_acks(self):
+        if not os.path.exists(self.ack_path):
+            return
+        with open(self.ack_path, 'rb') as f:
+            data = f.read()
+        usable = len(data) - len(data) % ACK_ENTRY.size
+        self.acked.update(offset for (offset,) in ACK_ENTRY.iter_unpack(data[:usable]))
+
+    def ack(self, offset):
+        # Acks are not fsynced: losing one only means the message is sent again
+        if self._ack_file is None:
+            self._ack_file = open(self.ack_path, 'ab', buffering=0)
+        self._ack_file.write(ACK_ENTRY.pack(offset))
+        self.acked.add(offset)
+
+    @property
+    def complete(self):
+        return self.sealed and len(self.acked) >= self.records
+
+    def remove(self):
+        if self._ack_file is not None:
+            self._ack_file.close()
+        if self._fd is not None:
+            os.close(self._fd)
+        for path in (self.path, self.ack_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class Outbox:
+    """Durable on-disk spool of fully rendered messages.
+
+    Messages are appended to segment files with a CRC per record and made
+    durable with one fsync per batch, then handed out to delivery workers.
+    Delivered offsets are appended to a sidecar ack file; a segment is
+    removed once it is sealed and every record in it is acknowledged. On
+    start-up unacknowledged records are queued again, so spooled mail
+    survives restarts with at-least-once delivery.
+    """
+
+    def __init__(self, directory, segment_size=OUTBOX_SEGMENT_SIZE, fsync_batch=OUTBOX_FSYNC_BATCH):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync_batch = fsync_batch
+        self._segments = {}
+        self._pending = deque()
+        self._delayed = []
+        self._lock = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._active = None
+        self._file = None
+        os.makedirs(directory, exist_ok=True)
+        self._recover()
+        self._open_segment(max(self._segments, default=0) + 1)
+
+    def _recover(self):
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith('.seg'):
+                continue
+            segment = Segment(self.directory, int(name[:-4]))
+            segment.sealed = True
+            segment.load_acks()
+            for offset in segment.scan():
+                segment.records += 1
+                if offset not in segment.acked:
+                    self._pending.append((segment.seq, offset, 0))
+            if segment.complete:
+                segment.remove()
+            else:
+                self._segments[segment.seq] = segment
+        if self._pending:
+            logger.info(f"Recovered {len(self._pending)} undelivered messages from {self.directory}")
+
+    def _open_segment(self, seq):
+        segment = Segment(self.directory, seq)
+        self._file = open(segment.path, 'ab')
+        fsync_dir(self.directory)
+        self._active = segment
+        with self._lock:
+            self._segments[seq] = segment
+
+    def _seal_active(self):
+        """Close the full segment and start the next one; call with the write lock held"""
+        self._file.close()
+        with self._lock:
+            segment = self._active
+            segment.sealed = True
+            if segment.complete:
+                del self._segments[segment.seq]
+                segment.remove()
+        self._open_segment(segment.seq + 1)
+
+    def append(self, entries, attempts=0, delay=0.0):
+        """Durably spool (meta, data) entries and queue them for delivery.
+
+        Returns the number of messages spooled. Entries become visible to
+        delivery workers only after the fsync of their batch, and delay
+        seconds later when they carry on an earlier message's attempts.
+        """
+        count = 0
+        batch = []
+        with self._write_lock:
+            for meta, data in entries:
+                if self._file.tell() >= self.segment_size:
+                    self._commit(batch, attempts, delay)
+                    batch = []
+                    self._seal_active()
+                payload = json.dumps(meta).encode('utf-8')
+                offset = self._file.tell()
+                self._file.write(RECORD_HEADER.pack(RECORD_MAGIC, zlib.crc32(payload + data), len(payload), len(data)))
+                self._file.write(payload)
+                self._file.write(data)
+                batch.append((self._active.seq, offset))
+                count += 1
+                if len(batch) >= self.fsync_batch:
+                    self._commit(batch, attempts, delay)
+                    batch = []
+            self._commit(batch, attempts, delay)
+        return count
+
+    def _commit(self, batch, attempts=0, delay=0.0):
+        if not batch:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        with self._lock:
+            self._active.records += len(batch)
+            if delay:
+                due = time.monotonic() + delay
+                for seq, offset in batch:
+                    heapq.heappush(self._delayed, (due, seq, offset, attempts))
+            else:
+                self._pending.extend((seq, offset, attempts) for seq, offset in batch)
+            self._lock.notify_all()
+
+    def take(self, timeout=None):
+        """Block until a message is due and return (seq, offset, attempts), or None on timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while True:
+                now = time.monotonic()
+                if self._delayed and self._delayed[0][0] <= now:
+                    _, seq, offset, attempts = heapq.heappop(self._delayed)
+                    return seq, offset, attempts
+                if self._pending:
+                    return self._pending.popleft()
+                waits = [self._delayed[0][0] - now] if self._delayed else []
+                if deadline is not None:
+                    if now >= deadline:
+                        return None
+                    waits.append(deadline - now)
+                self._lock.wait(min(waits) if waits else None)
+
+    def read(self, seq, offset):
+        with self._lock:
+            segment = self._segments[seq]
+        return segment.read(offset)
+
+    def retry(self, seq, offset, attempts, delay):
+        """Hand a message back to be delivered again after delay seconds"""
+        with self._lock:
+            heapq.heappush(self._delayed, (time.monotonic() + delay, seq, offset, attempts))
+            self._lock.notify()
+
+    def ack(self, seq, offset):
+        """Mark a message as done, delivered or permanently failed"""
+        with self._lock:
+            segment = self._segments[seq]
+            segment.ack(offset)
+            if segment.complete:
+                del self._segments[seq]
+                segment.remove()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending': len(self._pending),
+                'retrying': len(self._delayed),
+                'segments': len(self._segments)
+            }
+
+
+class OutboxDelivery:
+    """Delivery workers streaming spooled messages to the users' relays.
+
+    Each worker keeps its own relay connections open across messages; relay
+    choice, breakers and hourly caps come from the shared RelayPool health.
+    Messages a relay refuses temporarily are retried with backoff, as are
+    recipients refused with a 4xx reply inside an accepted transaction, and
+    permanent failures are acknowledged and logged.
+    """
+
+    def __init__(self, outbox, workers=OUTBOX_WORKERS):
+        self.outbox = outbox
+        self.workers = workers
+        self._threads = []
+        self._senders = {}
+        self._campaigns = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, name=f"outbox-worker-{len(self._threads)}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _sender(self, user_id, transport_name=None):
+        """EmailSender and RelayPool for a user and transport, cached for a short while"""
+        from email_utils import EmailSender  # Import here to avoid circular imports
+        from models import SmtpSettings
+        from transports import get_transport
+
+        now = time.monotonic()
+        key = (user_id, transport_name)
+        with self._lock:
+            cached = self._senders.get(key)
+            if cached and cached[0] > now:
+                return cached[1], cached[2]
+        settings = SmtpSettings.get_by_user_id(user_id)
+        if not settings:
+            return None, None
+        sender = EmailSender(settings, user_id, transport=get_transport(transport_name) if transport_name else None)
+        pool = RelayPool(sender.get_relays())
+        with self._lock:
+            self._senders[key] = (now + SETTINGS_CACHE_TTL, sender, pool)
+        return sender, pool
+
+    def _work(self):
+        connections = {}
+        while True:
+            seq, offset, attempts = self.outbox.take()
+            meta = None
+            try:
+                meta, data = self.outbox.read(seq, offset)
+                self._deliver(connections, seq, offset, attempts, meta, data)
+            except Exception as e:
+                logger.error(f"Error delivering spooled message {seq}:{offset}: {e}")
+                if attempts + 1 < OUTBOX_MAX_ATTEMPTS:
+                    self.outbox.retry(seq, offset, attempts + 1, OUTBOX_RETRY_DELAY)
+                elif meta is None:
+                    # Unreadable, so there is no campaign to count it against
+                    self.outbox.ack(seq, offset)
+                else:
+                    try:
+                        self._finish(seq, offset, meta, {email: None for email in meta['recipients']}, str(e))
+                    except Exception as finish_err:
+                        logger.error(f"Error failing spooled message {seq}:{offset}: {finish_err}")
+
+    def _deliver(self, connections, seq, offset, attempts, meta, data):
+        sender, pool = self._sender(meta['user_id'], meta.get('transport'))
+        if sender is None:
+            self._finish(seq, offset, meta, {email: None for email in meta['recipients']},
+                         'SMTP settings not configured')
+            return
+
+        relay = pool.choose()
+        if relay is None:
+            self.outbox.retry(seq, offset, attempts, max(1.0, pool.retry_in()))
+            return
+
+        try:
+            server = connections.get(relay.key)
+            if server is None:
+                server = connections[relay.key] = sender.connect_smtp(relay)
+            refused = server.sendmail(meta['sender'], meta['recipients'], data)
+        except smtplib.SMTPRecipientsRefused as e:
+            # Every recipient was refused; each is settled by its own reply below
+            pool.record_success(relay, 0)
+            refused = e.recipients
+        except Exception as e:
+            if is_relay_failure(e):
+                pool.record_failure(relay, e)
+                self._drop(connections, relay)
+            else:
+                pool.record_success(relay, 0)
+            code = getattr(e, 'smtp_code', None)
+            permanent = code is not None and code >= 500
+            if (permanent and not is_relay_failure(e)) or attempts + 1 >= OUTBOX_MAX_ATTEMPTS:
+                self._finish(seq, offset, meta, {email: code for email in meta['recipients']}, str(e))
+            else:
+                self.outbox.retry(seq, offset, attempts + 1, OUTBOX_RETRY_DELAY * 2 ** attempts)
+            return
+        else:
+            pool.record_success(relay, len(meta['recipients']) - len(refused))
+
+        deferred = []
+        if attempts + 1 < OUTBOX_MAX_ATTEMPTS:
+            # Recipients refused for now (4xx) are spooled again on their own with
+            # backoff; only 5xx refusals fail them
+            deferred = [email for email, (code, _) in refused.items() if 400 <= code < 500]
+        if deferred:
+            self.outbox.append([(dict(meta, recipients=deferred), data)], attempts=attempts + 1,
+                               delay=OUTBOX_RETRY_DELAY * 2 ** attempts)
+            refused = {email: reply for email, reply in refused.items() if email not in deferred}
+        error = '; '.join(f"{email}: {code}" for email, (code, _) in refused.items()) or None
+        self._finish(seq, offset, meta, {email: code for email, (code, _) in refused.items()}, error,
+                     recipients=[email for email in meta['recipients'] if email not in deferred])
+
+    def _drop(self, connections, relay):
+        server = connections.pop(relay.key, None)
+        if server is not None:
+            try:
+                server.quit()
+            except Exception:
+                server.close()
+
+    def _finish(self, seq, offset, meta, failed, error, recipients=None):
+        """Acknowledge a message and count its outcome against the campaign.
+
+        failed maps each refused recipient to its SMTP code. recipients are
+        those settled by this message, all of them unless some were spooled
+        again for a retry.
+        """
+        from app import save_log  # Import here to avoid circular imports
+
+        self.outbox.ack(seq, offset)
+        if recipients is None:
+            recipients = meta['recipients']
+        user_id = meta['user_id']
+        with self._lock:
+            results = self._campaigns.get(meta['campaign_id'])
+            if results is None:
+                results = self._campaigns[meta['campaign_id']] = ResultSink(meta['campaign_id'], user_id)
+
+        stats = get_stats()
+        timestamp = datetime.utcnow().isoformat()
+        for email in recipients:
+            if email in failed:
+                stats.record(meta['campaign_id'], get_domain(email), 'failed', failed[email])
+                results.record(email, 'failed', error=error, smtp_code=failed[email], timestamp=timestamp)
+            else:
+                stats.record(meta['campaign_id'], get_domain(email), 'success', 250)
+                results.record(email, 'success', timestamp=timestamp)
+        if failed:
+            save_log(user_id, 'outbox', f"Failed to deliver spooled email to {', '.join(failed)}", 'error',
+                     details={'campaign_id': meta['campaign_id'], 'error': error})
+
+        # Progress is counted in Mongo, as a restart recovers spooled mail but not in-memory sinks
+        progress = stats.record_delivered(meta['campaign_id'], len(recipients) - len(failed), len(failed))
+        if progress is None:
+            return
+        delivered = progress.get('delivered', {})
+        done = delivered.get('success', 0) + delivered.get('failed', 0)
+        total = progress.get('total', meta['total'])
+        # Only the message that takes the count to the total finishes the campaign
+        if not done - len(recipients) < total <= done:
+            return
+        with self._lock:
+            self._campaigns.pop(meta['campaign_id'], None)
+        results.flush()
+        stats.finish_campaign(meta['campaign_id'], 'completed')
+        save_log(user_id, 'outbox',
+                 f"Spooled campaign {meta['campaign_id']} delivered: "
+                 f"{delivered.get('success', 0)} successful, {delivered.get('failed', 0)} failed",
+                 details={
+                     'success': delivered.get('success', 0),
+                     'failed': delivered.get('failed', 0),
+                     'error_classes': results.error_samples()
+                 })
+
+
+def acquire_slot(root=OUTBOX_DIR, max_slots=OUTBOX_MAX_SLOTS):
+    """Lock a spool directory for this process.
+
+    Every gunicorn worker gets its own numbered slot, so segments are only
+    ever written and delivered by one process. A restarted worker takes
+    over a free slot and recovers the mail left in it.
+    """
+    os.makedirs(root, exist_ok=True)
+    for slot in range(max_slots):
+        directory = os.path.join(root, str(slot))
+        os.makedirs(directory, exist_ok=True)
+        lock_file = open(os.path.join(directory, 'lock'), 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            continue
+        return directory, lock_file
+    raise RuntimeError(f"All {max_slots} outbox slots under {root} are in use")
+
+
+_outbox = None
+_delivery = None
+_slot_lock = None
+_outbox_lock = threading.Lock()
+
+
+def get_outbox():
+    """Return this process's Outbox, recovering its slot and starting delivery on first use"""
+    global _outbox, _delivery, _slot_lock
+    with _outbox_lock:
+        if _outbox is None:
+            directory, _slot_lock = acquire_slot()
+            _outbox = Outbox(directory)
+            _delivery = OutboxDelivery(_outbox)
+        _delivery.start()
+        return _outbox
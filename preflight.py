@@ -0,0 +1,166 @@
+import logging
+import os
+import smtplib
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from dns import resolver
+
+from domain_scheduler import get_domain, get_learned_rate
+from email_utils import group_by_domain
+from mx_cache import get_mx_cache
+from throttle import AdaptiveThrottle
+
+logger = logging.getLogger(__name__)
+
+# Concurrent DNS lookups while warming the MX cache
+PREFLIGHT_DNS_WORKERS = int(os.getenv('PREFLIGHT_DNS_WORKERS', 16))
+# Round trips timed after the handshake to measure a relay's latency
+PREFLIGHT_PINGS = 3
+# Undeliverable domains listed in a report; the counts cover all of them
+MAX_REPORTED_DOMAINS = 100
+
+
+def check_relay(sender, relay):
+    """Connect to a relay once, as a send would, and time the handshake and a round trip"""
+    start = time.monotonic()
+    try:
+        server = sender.connect_smtp(relay)
+    except Exception as e:
+        return {'relay': relay.name, 'ok': False, 'error': str(e),
+                'handshake_ms': round((time.monotonic() - start) * 1000, 1)}
+    handshake = time.monotonic() - start
+
+    try:
+        rtt = 0.0
+        if isinstance(server, smtplib.SMTP):
+            # The median NOOP approximates one SMTP command round trip
+            samples = []
+            for _ in range(PREFLIGHT_PINGS):
+                ping_start = time.monotonic()
+                server.noop()
+                samples.append(time.monotonic() - ping_start)
+            rtt = sorted(samples)[len(samples) // 2]
+        pipelining = bool(server.has_extn('pipelining'))
+    except Exception as e:
+        return {'relay': relay.name, 'ok': False, 'error': str(e),
+                'handshake_ms': round(handshake * 1000, 1)}
+    finally:
+        try:
+            server.quit()
+        except Exception:
+            server.close()
+
+    # MAIL/RCPT, DATA and the end of data; each is its own round trip without pipelining
+    round_trips = 3 if pipelining else 4
+    return {
+        'relay': relay.name,
+        'ok': True,
+        'handshake_ms': round(handshake * 1000, 1),
+        'rtt_ms': round(rtt * 1000, 1),
+        'pipelining': pipelining,
+        'message_latency': rtt * round_trips
+    }
+
+
+def warm_mx(domains, workers=PREFLIGHT_DNS_WORKERS):
+    """Resolve every domain into the MX cache and report which can't take mail"""
+    cache = get_mx_cache()
+
+    def resolve(domain):
+        try:
+            return domain, 'ok' if cache.delivery_hosts(domain) else 'null_mx'
+        except resolver.NXDOMAIN:
+            return domain, 'nxdomain'
+        except Exception as e:
+            logger.warning(f"MX lookup for {domain} failed: {e}")
+            return domain, 'error'
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(domains)))) as pool:
+        outcomes = dict(pool.map(resolve, domains)) if domains else {}
+
+    undeliverable = sorted(domain for domain, outcome in outcomes.items() if outcome in ('nxdomain', 'null_mx'))
+    return {
+        'domains': len(domains),
+        'counts': dict(Counter(outcomes.values())),
+        'undeliverable': undeliverable[:MAX_REPORTED_DOMAINS],
+        'failed_lookups': sorted(domain for domain, outcome in outcomes.items()
+                                 if outcome == 'error')[:MAX_REPORTED_DOMAINS]
+    }
+
+
+def estimate_duration(sender, emails, batch_recipients, message_latency):
+    """Seconds a send of emails should take, and what limits it.
+
+    A send runs one message (or batched transaction) at a time, each taking
+    the relay's latency plus the throttle's pause, so the estimate is the
+    slowest of that sequence, the busiest domain's rate cap and the relays'
+    hourly caps. The throttle starts at the configured delay and speeds up
+    towards min_delay, which gives the optimistic figure.
+    """
+    paced = sender.transport.paced
+    throttle = AdaptiveThrottle.from_settings(sender.settings)
+    steps = len(group_by_domain(emails)) if batch_recipients else len(emails)
+    fastest = AdaptiveThrottle(initial_delay=throttle.min_delay, min_delay=throttle.min_delay,
+                               max_delay=throttle.max_delay)
+
+    bounds = {
+        'sequential': steps * (message_latency + (throttle.delay if paced else 0.0)),
+        'domain_rate': 0.0,
+        'hourly_cap': 0.0
+    }
+    best = steps * (message_latency + (fastest.delay if paced else 0.0))
+
+    if paced and not batch_recipients:
+        # Each domain gets one message per 60/rate seconds
+        for domain, count in Counter(get_domain(email) for email in emails).items():
+            rate = get_learned_rate(domain)
+            if rate > 0:
+                bounds['domain_rate'] = max(bounds['domain_rate'], (count - 1) * 60.0 / rate)
+
+    caps = [relay.hourly_cap for relay in sender.get_relays()]
+    if caps and all(caps):
+        # Whatever doesn't fit in the first hour's allowance waits for later hours
+        bounds['hourly_cap'] = max(0.0, len(emails) - sum(caps)) / sum(caps) * 3600
+
+    bottleneck = max(bounds, key=bounds.get)
+    return {
+        'seconds': round(bounds[bottleneck], 1),
+        'best_case_seconds': round(max(best, bounds['domain_rate'], bounds['hourly_cap']), 1),
+        'bottleneck': bottleneck,
+        'messages': steps,
+        'per_message_seconds': round(message_latency + (throttle.delay if paced else 0.0), 3),
+        'send_rate_per_minute': throttle.rate_per_minute if paced else None
+    }
+
+
+def run_preflight(sender, emails, subject, body_text, attachments=None, batch_recipients=False):
+    """Check the relays, warm the MX and message caches and estimate a send's duration"""
+    relays = [check_relay(sender, relay) for relay in sender.get_relays()]
+    reachable = [relay for relay in relays if relay['ok']]
+
+    domains = sorted({get_domain(email) for email in emails})
+    mx = warm_mx(domains)
+
+    start = time.monotonic()
+    template = sender.get_template(subject, body_text, attachments)
+    message = {
+        'encode_ms': round((time.monotonic() - start) * 1000, 1),
+        'body_bytes': len(template.body),
+        'attachments': len(attachments or []),
+        'dkim_signed': template.signer is not None
+    }
+
+    # Sends go through the primary relay while it is healthy
+    latency = reachable[0]['message_latency'] if reachable else 0.0
+    for relay in reachable:
+        relay['message_latency_ms'] = round(relay.pop('message_latency') * 1000, 1)
+
+    return {
+        'ok': bool(reachable),
+        'relays': relays,
+        'mx': mx,
+        'message': message,
+        'estimate': estimate_duration(sender, emails, batch_recipients, latency)
+    }
@@ -0,0 +1,199 @@
+import fcntl
+import hashlib
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+from data_dir import data_path, ensure_parent
+
+logger = logging.getLogger(__name__)
+
+# Memory-mapped bucket table shared by every worker process on the host
+RATE_LIMIT_FILE = os.getenv('RATE_LIMIT_FILE', data_path('rate_limits.bin'))
+RATE_LIMIT_SLOTS = int(os.getenv('RATE_LIMIT_SLOTS', 65536))
+# Set to 0 to turn rate limiting off
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', '1') != '0'
+# Requests per minute and burst allowed to one user across all endpoints
+RATE_LIMIT_PER_MINUTE = float(os.getenv('RATE_LIMIT_PER_MINUTE', 300))
+RATE_LIMIT_BURST = float(os.getenv('RATE_LIMIT_BURST', 60))
+# Per-endpoint limits by Flask endpoint name, merged over ENDPOINT_LIMITS,
+# e.g. '{"get_logs": {"per_minute": 30, "burst": 10}}'
+RATE_LIMITS = json.loads(os.getenv('RATE_LIMITS', '{}'))
+
+ENDPOINT_LIMITS = {
+    # Full-file and full-array reads the extension polls
+    'get_logs': {'per_minute': 60, 'burst': 10},
+    'get_email_list': {'per_minute': 60, 'burst': 10},
+    # Hashes the whole saved list on every call
+    'sync_email_list': {'per_minute': 30, 'burst': 10},
+    'get_send_emails_progress': {'per_minute': 120, 'burst': 20},
+    'export_campaign_results': {'per_minute': 10, 'burst': 3},
+    'send_emails': {'per_minute': 10, 'burst': 5},
+    # Opens relay connections and resolves every recipient domain
+    'campaign_preflight': {'per_minute': 10, 'burst': 5},
+    # Keyed by client address, as there is no user yet
+    'login': {'per_minute': 20, 'burst': 10},
+    'register': {'per_minute': 10, 'burst': 5},
+}
+
+# tag, tokens, updated_at
+SLOT = struct.Struct('<Qdd')
+# Each key may live in either slot of its pair, so two hot keys rarely evict each other
+WAYS = 2
+
+
+class RateLimited(Exception):
+    """Raised when a bucket is empty; retry_after is in seconds"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Rate limit exceeded, retry in {math.ceil(retry_after)}s")
+        self.retry_after = retry_after
+
+
+def limit_for(endpoint):
+    """(tokens per second, burst) for an endpoint, or None if it has no own bucket"""
+    limit = {**ENDPOINT_LIMITS, **RATE_LIMITS}.get(endpoint)
+    if not limit:
+        return None
+    return limit['per_minute'] / 60.0, float(limit['burst'])
+
+
+class TokenBuckets:
+    """Token buckets in a memory-mapped file shared by every worker on the host.
+
+    Keys hash into a fixed table of slot pairs. Each pair is guarded by an
+    fcntl byte-range lock for other processes plus a thread lock, since
+    fcntl locks don't exclude threads of the same process. A key that finds
+    both slots of its pair taken by other keys evicts the stalest one and
+    starts over with a full bucket, so collisions only ever err towards
+    letting a request through.
+    """
+
+    def __init__(self, path=RATE_LIMIT_FILE, slots=RATE_LIMIT_SLOTS):
+        self.pairs = max(1, slots // WAYS)
+        size = self.pairs * WAYS * SLOT.size
+        self.fd = os.open(ensure_parent(path), os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self.fd).st_size < size:
+            os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+        self._lock = threading.Lock()
+
+    def _locate(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        tag = int.from_bytes(digest[:8], 'little') or 1
+        pair = int.from_bytes(digest[8:], 'little') % self.pairs
+        return tag, pair * WAYS * SLOT.size
+
+    def _read(self, offset, tag, rate, burst, now):
+        """Pick the key's slot in a pair and return it with its refilled token count"""
+        slots = [(offset + way * SLOT.size,) + SLOT.unpack_from(self.map, offset + way * SLOT.size)
+                 for way in range(WAYS)]
+        for position, slot_tag, tokens, updated in slots:
+            if slot_tag == tag:
+                elapsed = max(0.0, now - updated)
+                return position, min(burst, tokens + elapsed * rate)
+        # Not present: take the slot idle the longest
+        position = min(slots, key=lambda slot: slot[3])[0]
+        return position, burst
+
+    def take(self, key, rate, burst, now=None):
+        """Take one token from key's bucket; raise RateLimited if there is none"""
+        now = time.time() if now is None else now
+        tag, offset = self._locate(key)
+        with self._lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, WAYS * SLOT.size, offset)
+            try:
+                position, tokens = self._read(offset, tag, rate, burst, now)
+                if tokens < 1.0:
+                    raise RateLimited((1.0 - tokens) / rate if rate > 0 else 60.0)
+                SLOT.pack_into(self.map, position, tag, tokens - 1.0, now)
+                return tokens - 1.0
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, WAYS * SLOT.size, offset)
+
+    def available(self, key, rate, burst, now=None):
+        """Tokens in key's bucket right now, without taking any"""
+        now = time.time() if now is None else now
+        tag, offset = self._locate(key)
+        with self._lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_SH, WAYS * SLOT.size, offset)
+            try:
+                return self._read(offset, tag, rate, burst, now)[1]
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, WAYS * SLOT.size, offset)
+
+    def spend(self, key, rate, burst, count, now=None):
+        """Take count tokens whether or not they are there, for usage counted after the fact"""
+        now = time.time() if now is None else now
+        tag, offset = self._locate(key)
+        with self._lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, WAYS * SLOT.size, offset)
+            try:
+                position, tokens = self._read(offset, tag, rate, burst, now)
+                SLOT.pack_into(self.map, position, tag, tokens - count, now)
+                return tokens - count
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, WAYS * SLOT.size, offset)
+
+    def refund(self, key, rate, burst, now=None):
+        """Give back a token taken by a request that was refused by another bucket"""
+        now = time.time() if now is None else now
+        tag, offset = self._locate(key)
+        with self._lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, WAYS * SLOT.size, offset)
+            try:
+                position, tokens = self._read(offset, tag, rate, burst, now)
+                SLOT.pack_into(self.map, position, tag, min(burst, tokens + 1.0), now)
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, WAYS * SLOT.size, offset)
+
+
+class RateLimiter:
+    """Applies the per-endpoint and per-user buckets to one request"""
+
+    def __init__(self, buckets=None):
+        self.buckets = buckets or get_token_buckets()
+        self.user_limit = (RATE_LIMIT_PER_MINUTE / 60.0, RATE_LIMIT_BURST)
+
+    def check(self, identity, endpoint):
+        """Charge a request by identity to endpoint; raise RateLimited when over a limit"""
+        now = time.time()
+        endpoint_limit = limit_for(endpoint)
+        endpoint_key = f"{identity}:{endpoint}"
+        if endpoint_limit:
+            self.buckets.take(endpoint_key, *endpoint_limit, now=now)
+        try:
+            self.buckets.take(identity, *self.user_limit, now=now)
+        except RateLimited:
+            if endpoint_limit:
+                self.buckets.refund(endpoint_key, *endpoint_limit, now=now)
+            raise
+
+
+_buckets = None
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_token_buckets():
+    """Return this process's view of the shared bucket file, opened after the fork"""
+    global _buckets
+    with _limiter_lock:
+        if _buckets is None:
+            _buckets = TokenBuckets()
+        return _buckets
+
+
+def get_rate_limiter():
+    """Return this process's limiter; the bucket file is opened after the fork"""
+    global _limiter
+    buckets = get_token_buckets()
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = RateLimiter(buckets)
+        return _limiter
@@ -0,0 +1,263 @@
+import logging
+import os
+import smtplib
+import threading
+import time
+
+from rate_limit import get_token_buckets
+
+logger = logging.getLogger(__name__)
+
+# Consecutive failures that open a relay's circuit breaker
+RELAY_FAILURE_THRESHOLD = int(os.getenv('RELAY_FAILURE_THRESHOLD', 3))
+# First open period in seconds; doubles on every consecutive trip up to the max
+RELAY_COOLDOWN = float(os.getenv('RELAY_COOLDOWN', 30))
+RELAY_MAX_COOLDOWN = float(os.getenv('RELAY_MAX_COOLDOWN', 600))
+# Give up on a campaign when no relay has delivered for this long
+RELAY_OUTAGE_TIMEOUT = float(os.getenv('RELAY_OUTAGE_TIMEOUT', 600))
+
+# Relay-level (not recipient-level) rate limiting and availability replies
+RELAY_BACKOFF_CODES = {421, 451, 454}
+CONNECTION_ERRORS = (
+    smtplib.SMTPServerDisconnected,
+    smtplib.SMTPConnectError,
+    smtplib.SMTPHeloError,
+    smtplib.SMTPAuthenticationError
+)
+
+
+class RelayUnavailable(Exception):
+    """Raised when no relay of a user can take mail"""
+
+
+def is_relay_failure(exc):
+    """True when an error says the relay, not the recipient, is unhealthy"""
+    if isinstance(exc, CONNECTION_ERRORS):
+        return True
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        return False
+    # SMTPException derives from OSError; only socket-level errors count here
+    if isinstance(exc, OSError) and not isinstance(exc, smtplib.SMTPException):
+        return True
+    return isinstance(exc, smtplib.SMTPResponseException) and exc.smtp_code in RELAY_BACKOFF_CODES
+
+
+class Relay:
+    """Connection details, weight and hourly cap of one SMTP relay"""
+
+    def __init__(self, smtp_server, smtp_port, username, password, weight=1, hourly_cap=0, transport='smtp'):
+        self.smtp_server = smtp_server
+        self.smtp_port = int(smtp_port)
+        self.username = username
+        self.password = password
+        self.weight = max(1, int(weight or 1))
+        self.hourly_cap = int(hourly_cap or 0)
+        self.transport = transport
+
+    @property
+    def key(self):
+        return (self.transport, self.smtp_server, self.smtp_port, self.username)
+
+    @property
+    def name(self):
+        return f"{self.smtp_server}:{self.smtp_port}"
+
+    @classmethod
+    def from_settings(cls, settings):
+        """The primary relay stored directly on SmtpSettings"""
+        return cls(
+            settings.smtp_server,
+            settings.smtp_port,
+            settings.username,
+            settings.password,
+            weight=getattr(settings, 'weight', 1),
+            hourly_cap=getattr(settings, 'hourly_cap', 0)
+        )
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            data['smtp_server'],
+            data['smtp_port'],
+            data['username'],
+            data['password'],
+            weight=data.get('weight', 1),
+            hourly_cap=data.get('hourly_cap', 0)
+        )
+
+
+class CircuitBreaker:
+    """Closed -> open after repeated failures -> half-open trial after a cooldown"""
+
+    def __init__(self, threshold=RELAY_FAILURE_THRESHOLD, cooldown=RELAY_COOLDOWN, max_cooldown=RELAY_MAX_COOLDOWN):
+        self.threshold = threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.failures = 0
+        self.trips = 0
+        self.open_until = 0.0
+        self.trial_in_flight = False
+
+    @property
+    def state(self):
+        if self.open_until == 0.0:
+            return 'closed'
+        return 'half_open' if time.monotonic() >= self.open_until else 'open'
+
+    def allow(self):
+        """Whether a send may be attempted now; half-open lets one trial through"""
+        state = self.state
+        if state == 'closed':
+            return True
+        if state == 'half_open' and not self.trial_in_flight:
+            return True
+        return False
+
+    def begin(self):
+        if self.state == 'half_open':
+            self.trial_in_flight = True
+
+    def retry_in(self):
+        return max(0.0, self.open_until - time.monotonic())
+
+    def record_success(self):
+        self.failures = 0
+        self.trips = 0
+        self.open_until = 0.0
+        self.trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == 'half_open' or self.failures >= self.threshold:
+            cooldown = min(self.max_cooldown, self.base_cooldown * (2 ** self.trips))
+            self.trips += 1
+            self.failures = 0
+            self.open_until = time.monotonic() + cooldown
+        self.trial_in_flight = False
+
+
+class RelayHealth:
+    """Circuit breaker of one relay, shared process-wide"""
+
+    def __init__(self):
+        self.breaker = CircuitBreaker()
+
+
+def _hour_key(relay, now):
+    return 'relay-hour:' + ':'.join(str(part) for part in relay.key) + f":{int(now // 3600)}"
+
+
+def sent_this_hour(relay, now):
+    """Messages the relay took this clock hour, from every worker process on the host"""
+    if not relay.hourly_cap:
+        return 0
+    left = get_token_buckets().available(_hour_key(relay, now), 0.0, relay.hourly_cap, now)
+    return max(0, int(relay.hourly_cap - left))
+
+
+def hour_frees_in(now):
+    return 3600 - now % 3600
+
+
+_health = {}
+_health_lock = threading.RLock()
+
+
+def get_health(relay):
+    with _health_lock:
+        if relay.key not in _health:
+            _health[relay.key] = RelayHealth()
+        return _health[relay.key]
+
+
+class RelayPool:
+    """Spread a user's sends over their relays.
+
+    Relays are picked by smooth weighted round-robin among those whose
+    circuit breaker is closed (or half-open for a trial) and that are under
+    their hourly cap. Breakers are tracked per relay for the whole process,
+    so one campaign's failures steer every other campaign away from that
+    relay. Hourly caps hold for the whole host: each clock hour's sends are
+    counted in a bucket of the token-bucket file every worker process maps.
+    """
+
+    def __init__(self, relays):
+        self.relays = relays
+        self._current = {relay.key: 0 for relay in relays}
+        self._lock = threading.Lock()
+
+    def _available(self, relay, now):
+        health = get_health(relay)
+        if not health.breaker.allow():
+            return False
+        return not relay.hourly_cap or sent_this_hour(relay, now) < relay.hourly_cap
+
+    def choose(self, exclude=()):
+        """Return the next relay to use, or None if none is available"""
+        now = time.time()
+        with _health_lock, self._lock:
+            candidates = [
+                relay for relay in self.relays
+                if relay.key not in exclude and self._available(relay, now)
+            ]
+            if not candidates:
+                return None
+
+            total = sum(relay.weight for relay in candidates)
+            for relay in candidates:
+                self._current[relay.key] += relay.weight
+            chosen = max(candidates, key=lambda relay: self._current[relay.key])
+            self._current[chosen.key] -= total
+            get_health(chosen).breaker.begin()
+            return chosen
+
+    def retry_in(self):
+        """Seconds until some relay may become available again"""
+        now = time.time()
+        waits = []
+        with _health_lock:
+            for relay in self.relays:
+                health = _health.get(relay.key) or RelayHealth()
+                wait = health.breaker.retry_in()
+                if relay.hourly_cap and sent_this_hour(relay, now) >= relay.hourly_cap:
+                    wait = max(wait, hour_frees_in(now))
+                waits.append(wait)
+        return min(waits) if waits else 0.0
+
+    def release(self, relay):
+        """Hand back a chosen relay that ended up not being used"""
+        with _health_lock:
+            get_health(relay).breaker.trial_in_flight = False
+
+    def all_tripped(self):
+        """True when every relay's breaker is open or half-open"""
+        with _health_lock:
+            return all(get_health(relay).breaker.state != 'closed' for relay in self.relays)
+
+    def record_success(self, relay, count=1):
+        """The relay took the transaction; count messages against its hourly cap"""
+        with _health_lock:
+            get_health(relay).breaker.record_success()
+        if count and relay.hourly_cap:
+            now = time.time()
+            get_token_buckets().spend(_hour_key(relay, now), 0.0, relay.hourly_cap, count, now)
+
+    def record_failure(self, relay, error):
+        with _health_lock:
+            breaker = get_health(relay).breaker
+            breaker.record_failure()
+            state = breaker.state
+        logger.warning(f"Relay {relay.name} failed ({error}); breaker {state}")
+
+    def states(self):
+        """Breaker state and hourly usage per relay, for logging"""
+        now = time.time()
+        with _health_lock:
+            return {
+                relay.name: {
+                    'state': get_health(relay).breaker.state,
+                    'sent_this_hour': sent_this_hour(relay, now),
+                    'hourly_cap': relay.hourly_cap
+                }
+                for relay in self.relays
+            }
@@ -0,0 +1,100 @@
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Example recipients kept per error class, and error classes tracked per campaign
+ERROR_SAMPLES_PER_CLASS = int(os.getenv('ERROR_SAMPLES_PER_CLASS', 5))
+MAX_ERROR_CLASSES = int(os.getenv('MAX_ERROR_CLASSES', 20))
+# Per-recipient results buffered before they are written to Mongo
+RESULT_SPILL_BATCH = int(os.getenv('RESULT_SPILL_BATCH', 1000))
+
+
+def error_class(error, smtp_code=None):
+    """Group errors by SMTP code, or by exception type when there is none"""
+    if smtp_code is not None:
+        return str(smtp_code)
+    if isinstance(error, BaseException):
+        return type(error).__name__
+    return 'error'
+
+
+class ResultSink:
+    """Constant-size result aggregation for one campaign.
+
+    Keeps running counters and a few sample failures per error class in
+    memory; every per-recipient status is spilled to the campaign_results
+    collection in batches instead of being held until the send ends.
+    """
+
+    def __init__(self, campaign_id, user_id, spill_batch=RESULT_SPILL_BATCH):
+        self.campaign_id = campaign_id
+        self.user_id = user_id
+        self.spill_batch = spill_batch
+        self.success_count = 0
+        self.failed_count = 0
+        self.error_classes = {}
+        self.spill_errors = 0
+        self._buffer = []
+        self._lock = threading.Lock()
+
+    @property
+    def processed(self):
+        return self.success_count + self.failed_count
+
+    def record(self, email, status, error=None, smtp_code=None, timestamp=None, time_taken=None):
+        """Count one recipient's outcome and queue its detail for storage"""
+        with self._lock:
+            if status == 'success':
+                self.success_count += 1
+            else:
+                self.failed_count += 1
+                self._sample(email, error, smtp_code)
+            self._buffer.append({
+                'email': email,
+                'status': status,
+                'error': str(error) if error is not None else None,
+                'smtp_code': smtp_code,
+                'timestamp': timestamp,
+                'time_taken': time_taken
+            })
+            spill = len(self._buffer) >= self.spill_batch
+        if spill:
+            self.flush()
+
+    def _sample(self, email, error, smtp_code):
+        key = error_class(error, smtp_code)
+        if key not in self.error_classes and len(self.error_classes) >= MAX_ERROR_CLASSES:
+            key = 'other'
+        entry = self.error_classes.setdefault(key, {'count': 0, 'samples': []})
+        entry['count'] += 1
+        if len(entry['samples']) < ERROR_SAMPLES_PER_CLASS:
+            entry['samples'].append({'email': email, 'error': str(error)})
+
+    def flush(self):
+        """Write buffered per-recipient results; on failure they are dropped and counted"""
+        from models import CampaignResult  # Imported lazily so sending works without Mongo
+
+        with self._lock:
+            buffer, self._buffer = self._buffer, []
+        if not buffer:
+            return
+        try:
+            CampaignResult.insert_many(self.campaign_id, self.user_id, buffer)
+        except Exception as e:
+            self.spill_errors += len(buffer)
+            logger.error(f"Error storing results for campaign {self.campaign_id}: {e}")
+
+    def error_samples(self):
+        """Failures grouped by error class, most frequent first"""
+        with self._lock:
+            return dict(sorted(self.error_classes.items(), key=lambda item: -item[1]['count']))
+
+    def sample_messages(self):
+        """A bounded list of 'Failed to send to ...' lines for API responses"""
+        return [
+            f"Failed to send to {sample['email']}: {sample['error']}"
+            for entry in self.error_samples().values()
+            for sample in entry['samples']
+        ]
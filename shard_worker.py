@@ -0,0 +1,264 @@
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from email_utils import EmailSender, BulkSend
+from fair_scheduler import get_scheduler, TenantQuotaExceeded
+from campaign_stats import get_stats
+from models import ShardedCampaign, CampaignShard, CampaignResult, SmtpSettings
+from tracing import trace_span
+
+logger = logging.getLogger(__name__)
+
+# Recipients per shard; shards are the unit sender processes claim
+SHARD_SIZE = int(os.getenv('SHARD_SIZE', 1000))
+# Shards this process sends at once
+SHARD_WORKERS = int(os.getenv('SHARD_WORKERS', 2))
+# A lease not renewed for this long lets another process reclaim the shard
+SHARD_LEASE_SECONDS = int(os.getenv('SHARD_LEASE_SECONDS', 60))
+# How often idle workers look for claimable shards
+SHARD_POLL_INTERVAL = float(os.getenv('SHARD_POLL_INTERVAL', 2))
+# Claims of a shard, reclaims after a lost lease included, before it is failed
+SHARD_MAX_ATTEMPTS = int(os.getenv('SHARD_MAX_ATTEMPTS', 5))
+# Results a shard send buffers before storing them; what a reclaim finds stored isn't resent
+SHARD_RESULT_BATCH = int(os.getenv('SHARD_RESULT_BATCH', 20))
+# Pause before claiming again after the tenant was over its quota
+QUOTA_RETRY_DELAY = 5
+
+
+def create_sharded_campaign(user_id, email_list, subject, body, attachments=None, batch_recipients=False,
+                            shard_size=SHARD_SIZE, priority='bulk'):
+    """Store a campaign as shards any sender process on any node can claim"""
+    campaign = ShardedCampaign(
+        user_id=user_id,
+        subject=subject,
+        body=body,
+        total=len(email_list),
+        attachments=attachments,
+        batch_recipients=batch_recipients,
+        priority=priority
+    ).save()
+    shards = [email_list[start:start + shard_size] for start in range(0, len(email_list), shard_size)]
+    get_stats().start_campaign(campaign.campaign_id, user_id, len(email_list), subject)
+    if shards:
+        CampaignShard.insert_many(campaign.campaign_id, user_id, shards)
+    worker = get_shard_worker()
+    worker.start()
+    worker.wake()
+    return {'campaign_id': campaign.campaign_id, 'shards': len(shards), 'total': len(email_list)}
+
+
+class _Heartbeat:
+    """Renews a shard's lease in the background; stops the send if the lease is lost"""
+
+    def __init__(self, shard_id, owner, lease_seconds):
+        self.shard_id = shard_id
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self.bulk_send = None
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"shard-heartbeat-{shard_id}", daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.lease_seconds / 3):
+            try:
+                held = CampaignShard.heartbeat(self.shard_id, self.owner, self.lease_seconds)
+            except Exception as e:
+                # Keep trying until the lease would have run out anyway
+                logger.error(f"Error renewing lease of shard {self.shard_id}: {e}")
+                continue
+            if not held:
+                logger.warning(f"Lost lease of shard {self.shard_id}, stopping its send")
+                self.lost = True
+                if self.bulk_send is not None:
+                    self.bulk_send.stop()
+                return
+            if self.bulk_send is not None:
+                # Store what was sent so far, however slowly, for a reclaim to skip
+                self.bulk_send.results.flush()
+
+
+class ShardWorker:
+    """Claims campaign shards from Mongo and sends them through the fair scheduler.
+
+    Every sender process runs one, so a campaign's shards spread over all
+    processes on all nodes. Shards are leased rather than taken: a process
+    that dies stops renewing, its leases expire and other processes reclaim
+    the shards, skipping recipients that already have a stored result.
+    """
+
+    def __init__(self, workers=SHARD_WORKERS, lease_seconds=SHARD_LEASE_SECONDS,
+                 poll_interval=SHARD_POLL_INTERVAL, max_attempts=SHARD_MAX_ATTEMPTS):
+        self.workers = workers
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.owner = None
+        self._threads = []
+        self._campaigns = OrderedDict()
+        self._lock = threading.Condition()
+
+    def start(self):
+        # Started lazily so threads are created, and named, in each forked gunicorn worker
+        with self._lock:
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            if self.owner is None or not self._threads:
+                self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._run, name=f"shard-worker-{len(self._threads)}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def wake(self):
+        """Look for shards now rather than at the next poll"""
+        with self._lock:
+            self._lock.notify_all()
+
+    def _run(self):
+        while True:
+            try:
+                shard = CampaignShard.claim(self.owner, self.lease_seconds, self.max_attempts)
+                if shard is None:
+                    self._fail_exhausted()
+            except Exception as e:
+                logger.error(f"Error claiming campaign shard: {e}")
+                shard = None
+
+            if shard is None:
+                with self._lock:
+                    self._lock.wait(self.poll_interval)
+                continue
+            try:
+                with trace_span('shard.send', {
+                    'campaign.id': shard['campaign_id'],
+                    'shard.index': shard.get('index'),
+                    'shard.attempt': shard['attempts']
+                }):
+                    self._process(shard)
+            except Exception as e:
+                logger.error(f"Error sending shard {shard['_id']}: {e}")
+
+    def _campaign(self, campaign_id):
+        """The campaign's message, cached since all its shards share it"""
+        with self._lock:
+            campaign = self._campaigns.get(campaign_id)
+            if campaign is not None:
+                self._campaigns.move_to_end(campaign_id)
+                return campaign
+        campaign = ShardedCampaign.get(campaign_id)
+        with self._lock:
+            self._campaigns[campaign_id] = campaign
+            while len(self._campaigns) > 32:
+                self._campaigns.popitem(last=False)
+        return campaign
+
+    def _process(self, shard):
+        campaign_id = shard['campaign_id']
+        user_id = str(shard['user_id'])
+        campaign = self._campaign(campaign_id)
+        settings = SmtpSettings.get_by_user_id(user_id)
+        if campaign is None or not settings:
+            error = 'Campaign not found' if campaign is None else 'SMTP settings not configured'
+            CampaignShard.complete(shard['_id'], self.owner, 0, len(shard['emails']), status='failed', error=error)
+            self._maybe_finish(campaign_id, user_id)
+            return
+
+        emails = shard['emails']
+        recorded = {}
+        if shard['attempts'] > 1:
+            # Reclaimed after a lost lease: resume instead of resending
+            recorded = CampaignResult.recorded_statuses(campaign_id, emails)
+            emails = [email for email in emails if email not in recorded]
+
+        with _Heartbeat(shard['_id'], self.owner, self.lease_seconds) as heartbeat:
+            bulk_send = BulkSend(
+                EmailSender(settings, user_id),
+                email_list=emails,
+                subject=campaign.subject,
+                body_text=campaign.body,
+                attachments=campaign.attachments,
+                batch_recipients=campaign.batch_recipients,
+                campaign_id=campaign_id,
+                owns_campaign=False,
+                result_batch=SHARD_RESULT_BATCH
+            )
+            heartbeat.bulk_send = bulk_send
+            try:
+                job = get_scheduler().submit(user_id, bulk_send, lane=campaign.priority)
+            except TenantQuotaExceeded:
+                CampaignShard.release(shard['_id'], self.owner)
+                time.sleep(QUOTA_RETRY_DELAY)
+                return
+            try:
+                result = job.wait()
+            except Exception as e:
+                # Leave the lease to expire so the shard is retried, here or elsewhere
+                logger.error(f"Send of shard {shard['_id']} aborted: {e}")
+                return
+
+        if heartbeat.lost:
+            return
+        # Sends of earlier attempts count towards the shard too
+        recorded_success = sum(1 for status in recorded.values() if status == 'success')
+        success = result['success_count'] + recorded_success
+        failed = result['failed_count'] + len(recorded) - recorded_success
+        if not CampaignShard.complete(shard['_id'], self.owner, success, failed):
+            logger.warning(f"Shard {shard['_id']} was reclaimed before it finished")
+            return
+        self._maybe_finish(campaign_id, user_id)
+
+    def _fail_exhausted(self):
+        for campaign_id in CampaignShard.fail_exhausted(self.max_attempts):
+            campaign = self._campaign(campaign_id)
+            if campaign is not None:
+                self._maybe_finish(campaign_id, str(campaign.user_id))
+
+    def _maybe_finish(self, campaign_id, user_id):
+        """Complete the campaign once none of its shards is pending or leased"""
+        from app import save_log  # Import here to avoid circular imports
+
+        progress = CampaignShard.progress(campaign_id)
+        if progress['shards']['pending'] or progress['shards']['leased']:
+            return
+        if not ShardedCampaign.mark_finished(campaign_id, progress):
+            return
+        get_stats().finish_campaign(campaign_id, 'completed')
+        save_log(user_id, 'sharded_campaign',
+                 f"Campaign {campaign_id} completed: {progress['success']} sent, {progress['failed']} failed",
+                 details=progress)
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def get_shard_worker():
+    """Return this process's ShardWorker"""
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            _worker = ShardWorker()
+        return _worker
+
+
+if __name__ == '__main__':
+    # A sender-only node: python shard_worker.py. The worker comes from the
+    # importable module, the same instance app code imported later would see
+    from shard_worker import get_shard_worker as get_node_worker
+
+    get_node_worker().start()
+    while True:
+        time.sleep(3600)
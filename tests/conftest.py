@@ -0,0 +1,32 @@
+"""Shared setup: an in-memory Mongo and a scratch working directory.
+
+The environment is set before any app module is imported, since settings are
+read at import time. Tests run from a scratch directory so that user logs,
+written under a relative logs/, stay out of the checkout. mongomock has no collMod, so the server-side schema
+validators are skipped as in benchmarks/loadtest_app.py.
+"""
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+os.environ.setdefault('MONGODB_URI', 'mongodb://localhost:27017/mailer_test')
+os.environ.setdefault('JWT_SECRET_KEY', 'test-secret-key-long-enough-for-hs256')
+os.environ.setdefault('SECRET_KEY', 'test-secret-key-long-enough-for-hs256')
+os.chdir(tempfile.mkdtemp(prefix='mailer-test-'))
+
+import mongomock  # noqa: E402
+import pymongo  # noqa: E402
+
+pymongo.MongoClient = mongomock.MongoClient
+_command = mongomock.database.Database.command
+
+
+def _command_without_collmod(self, command, *args, **kwargs):
+    if isinstance(command, dict) and 'collMod' in command:
+        return {'ok': 1.0}
+    return _command(self, command, *args, **kwargs)
+
+
+mongomock.database.Database.command = _command_without_collmod
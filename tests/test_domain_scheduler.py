@@ -0,0 +1,71 @@
+import time
+
+import pytest
+from bson import ObjectId
+
+import domain_scheduler
+from domain_scheduler import DomainBudget
+from email_utils import BulkSend, EmailSender
+
+
+class Settings:
+    smtp_server = 'smtp.example.com'
+    smtp_port = 587
+    username = 'me@example.com'
+    password = 'password'
+    sender_name = 'Me'
+    delay = 0
+    dkim_private_key = None
+
+
+class FakeServer:
+    def __init__(self):
+        self.transactions = []
+
+    def sendmail(self, sender, recipients, data):
+        self.transactions.append(list(recipients))
+        return {}
+
+    def has_extn(self, name):
+        return False
+
+    def quit(self):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def capped_domain(monkeypatch):
+    monkeypatch.setattr(domain_scheduler, 'DOMAIN_LIMITS', {'capped.com': {'rate': 5}})
+
+
+def test_budget_grants_no_more_than_a_minute_of_the_rate():
+    budget = DomainBudget()
+
+    assert budget.take('capped.com', 10) == 5
+    assert budget.take('capped.com', 10) == 0
+    assert budget.time_until_ready('capped.com') > 0
+    budget.refund('capped.com', 2)
+    assert budget.take('capped.com', 10) == 2
+
+
+def test_unpaced_budget_grants_everything():
+    assert DomainBudget(rate_limited=False).take('capped.com', 100) == 100
+
+
+def test_batched_send_splits_and_defers_batches_over_a_domain_cap(monkeypatch):
+    server = FakeServer()
+    sender = EmailSender(Settings(), str(ObjectId()))
+    monkeypatch.setattr(sender, 'connect_smtp', lambda relay=None: server)
+    recipients = [f'user{n}@capped.com' for n in range(12)] + ['a@other.com', 'b@other.com']
+    bulk_send = BulkSend(sender, recipients, 'Hi', 'Hello', batch_recipients=True, max_recipients=10)
+    bulk_send.open()
+    try:
+        for _ in range(4):
+            bulk_send.step()
+    finally:
+        bulk_send.close()
+
+    # capped.com gets five recipients now; the rest waits for its budget while other.com goes out
+    assert server.transactions == [recipients[:5], ['a@other.com', 'b@other.com']]
+    assert sorted(len(batch) for _, batch in bulk_send.batches) == [2, 5]
+    assert bulk_send.next_send_at - time.monotonic() > 5
@@ -0,0 +1,82 @@
+import threading
+import time
+
+import pytest
+from bson import ObjectId
+from flask import Flask, g, jsonify
+from flask_jwt_extended import JWTManager, create_access_token, jwt_required
+
+import idempotency
+from idempotency import idempotent_send
+from models import SendRequest
+
+
+@pytest.fixture
+def slow_send(monkeypatch):
+    """A send view whose first call runs until released, well past the lease"""
+    monkeypatch.setattr(idempotency, 'IDEMPOTENCY_HEARTBEAT', 0.05)
+    monkeypatch.setattr(idempotency, 'IDEMPOTENCY_LEASE', 0.2)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    app = Flask(__name__)
+    app.config['JWT_SECRET_KEY'] = 'test-secret-key-long-enough-for-hs256'
+    JWTManager(app)
+
+    @app.route('/send-emails', methods=['POST'])
+    @jwt_required()
+    @idempotent_send
+    def send_emails():
+        calls.append(g.campaign_id)
+        started.set()
+        if len(calls) == 1:
+            release.wait(5)
+        return jsonify({'status': 'success', 'details': {'campaign_id': g.campaign_id}})
+
+    with app.app_context():
+        token = create_access_token(identity=str(ObjectId()))
+    headers = {'Authorization': f'Bearer {token}', 'Idempotency-Key': f'slow-{ObjectId()}'}
+    return app, headers, started, release, calls
+
+
+def test_retry_of_a_send_running_past_the_lease_is_not_taken_over(slow_send):
+    app, headers, started, release, calls = slow_send
+    body = {'emails': ['a@example.com'], 'subject': 'Hi', 'body': 'Hello'}
+    first = {}
+    thread = threading.Thread(
+        target=lambda: first.update(response=app.test_client().post('/send-emails', json=body, headers=headers)))
+    thread.start()
+    try:
+        assert started.wait(5)
+        # Several leases go by while the first send keeps heartbeating
+        time.sleep(0.6)
+        retry = app.test_client().post('/send-emails', json=body, headers=headers)
+    finally:
+        release.set()
+        thread.join()
+
+    assert retry.status_code == 202
+    assert retry.headers['Idempotent-Replayed'] == 'true'
+    assert retry.get_json()['details']['state'] == 'running'
+    assert len(calls) == 1
+    assert first['response'].status_code == 200
+
+
+def test_retry_takes_over_a_send_that_stopped_heartbeating(slow_send, monkeypatch):
+    app, headers, started, release, calls = slow_send
+    # The first worker died: its reservation is never renewed
+    monkeypatch.setattr(SendRequest, 'heartbeat', classmethod(lambda cls, *args: True))
+    body = {'emails': ['a@example.com'], 'subject': 'Hi', 'body': 'Hello'}
+    thread = threading.Thread(target=lambda: app.test_client().post('/send-emails', json=body, headers=headers))
+    thread.start()
+    try:
+        assert started.wait(5)
+        time.sleep(0.3)
+        retry = app.test_client().post('/send-emails', json=body, headers=headers)
+    finally:
+        release.set()
+        thread.join()
+
+    assert len(calls) == 2
+    assert retry.headers.get('Idempotent-Replayed') is None
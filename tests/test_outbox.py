@@ -0,0 +1,89 @@
+import smtplib
+
+import pytest
+
+import outbox
+from outbox import Outbox, OutboxDelivery
+from relay_pool import Relay, RelayPool
+
+
+class FakeServer:
+    def __init__(self, refused):
+        self.refused = refused
+        self.sent = []
+
+    def sendmail(self, sender, recipients, data):
+        self.sent.append(list(recipients))
+        refused = {email: reply for email, reply in self.refused.items() if email in recipients}
+        if len(refused) == len(recipients):
+            raise smtplib.SMTPRecipientsRefused(refused)
+        return refused
+
+
+class FakeSender:
+    def __init__(self, server):
+        self.server = server
+
+    def connect_smtp(self, relay):
+        return self.server
+
+
+def deliver_next(delivery, spool, connections):
+    seq, offset, attempts = spool.take(timeout=0)
+    meta, data = spool.read(seq, offset)
+    delivery._deliver(connections, seq, offset, attempts, meta, data)
+
+
+@pytest.fixture
+def delivery(tmp_path, monkeypatch):
+    def make(refused):
+        spool = Outbox(str(tmp_path / 'outbox'))
+        delivery = OutboxDelivery(spool, workers=0)
+        server = FakeServer(refused)
+        pool = RelayPool([Relay('relay.example.com', 25, 'user', 'password')])
+        monkeypatch.setattr(delivery, '_sender', lambda user_id, transport_name=None: (FakeSender(server), pool))
+        spool.append([({'user_id': 'u1', 'campaign_id': 'c1', 'sender': 'me@example.com',
+                        'recipients': ['a@x.com', 'b@x.com', 'c@x.com'], 'total': 3}, b'Subject: hi\r\n\r\nhi')])
+        return delivery, spool, server
+    return make
+
+
+def test_temporarily_refused_recipient_is_retried_alone(delivery, monkeypatch):
+    monkeypatch.setattr(outbox, 'OUTBOX_RETRY_DELAY', 0)
+    delivery, spool, server = delivery({'b@x.com': (451, b'4.7.1 Try again later')})
+    finished = []
+    finish = delivery._finish
+
+    def record_finish(*args, **kwargs):
+        finished.append(kwargs['recipients'])
+        finish(*args, **kwargs)
+
+    monkeypatch.setattr(delivery, '_finish', record_finish)
+
+    deliver_next(delivery, spool, {})
+
+    assert finished == [['a@x.com', 'c@x.com']]
+    seq, offset, attempts = spool.take(timeout=0)
+    meta, _ = spool.read(seq, offset)
+    assert meta['recipients'] == ['b@x.com']
+    assert attempts == 1
+    assert spool.take(timeout=0) is None
+
+
+def test_temporary_retry_is_delayed_with_backoff(delivery):
+    delivery, spool, server = delivery({'b@x.com': (452, b'4.2.2 Mailbox full')})
+
+    deliver_next(delivery, spool, {})
+
+    assert spool.stats()['retrying'] == 1
+    assert spool.take(timeout=0) is None
+
+
+def test_permanently_refused_recipient_is_not_retried(delivery):
+    delivery, spool, server = delivery({'b@x.com': (550, b'5.1.1 No such user')})
+
+    deliver_next(delivery, spool, {})
+
+    assert spool.stats()['retrying'] == 0
+    assert spool.take(timeout=0) is None
+    assert server.sent == [['a@x.com', 'b@x.com', 'c@x.com']]
@@ -0,0 +1,84 @@
+import socket
+import smtplib
+import threading
+
+# Reply codes and errors that mean the relay wants us to slow down
+BACKOFF_CODES = {421, 450, 451, 452}
+BACKOFF_ERRORS = (socket.timeout, TimeoutError, smtplib.SMTPServerDisconnected)
+# Ceiling on the rate when no minimum delay is configured (messages per second)
+MAX_RATE = 50.0
+# Latency jitter below this many seconds never counts as a spike
+MIN_LATENCY_SPIKE = 0.5
+
+
+class AdaptiveThrottle:
+    """AIMD controller for the pause between sends.
+
+    The send rate grows additively while the relay keeps answering 250 within
+    its usual latency and is cut multiplicatively on throttling replies,
+    timeouts or latency spikes. The resulting delay always stays between
+    min_delay and max_delay seconds.
+    """
+
+    def __init__(self, initial_delay=5, min_delay=0, max_delay=30,
+                 increase_step=0.05, decrease_factor=0.5,
+                 latency_factor=3.0, latency_smoothing=0.2):
+        self.min_delay = max(0.0, float(min_delay))
+        self.max_delay = max(self.min_delay, float(max_delay or 0)) or 1.0 / MAX_RATE
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.latency_factor = latency_factor
+        self.latency_smoothing = latency_smoothing
+        self.baseline_latency = None
+        self._lock = threading.Lock()
+        self._rate = self._clamp(self._to_rate(initial_delay))
+
+    @classmethod
+    def from_settings(cls, settings):
+        """Build a controller from a user's SmtpSettings"""
+        return cls(
+            initial_delay=settings.delay,
+            min_delay=getattr(settings, 'min_delay', 0),
+            max_delay=getattr(settings, 'max_delay', 30)
+        )
+
+    @staticmethod
+    def _to_rate(delay):
+        return 1.0 / delay if delay and delay > 0 else MAX_RATE
+
+    def _clamp(self, rate):
+        min_rate = 1.0 / self.max_delay
+        max_rate = min(self._to_rate(self.min_delay), MAX_RATE)
+        return min(max(rate, min_rate), max_rate)
+
+    @property
+    def delay(self):
+        """Seconds to wait before the next send"""
+        with self._lock:
+            return 1.0 / self._rate
+
+    @property
+    def rate_per_minute(self):
+        """Current send rate, in messages per minute"""
+        return round(60.0 / self.delay, 2)
+
+    def record(self, smtp_code=None, latency=None, error=None):
+        """Feed back the outcome of one send and return the new delay"""
+        with self._lock:
+            spiked = False
+            if latency is not None:
+                if self.baseline_latency is None:
+                    self.baseline_latency = latency
+                spiked = latency > max(
+                    self.baseline_latency * self.latency_factor,
+                    self.baseline_latency + MIN_LATENCY_SPIKE
+                )
+                if not spiked:
+                    self.baseline_latency += self.latency_smoothing * (latency - self.baseline_latency)
+
+            if smtp_code in BACKOFF_CODES or isinstance(error, BACKOFF_ERRORS) or spiked:
+                self._rate = self._clamp(self._rate * self.decrease_factor)
+            elif smtp_code is not None and smtp_code < 400:
+                self._rate = self._clamp(self._rate + self.increase_step)
+
+        return self.delay
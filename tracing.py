@@ -0,0 +1,451 @@
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+
+from flask import g, request
+from pymongo import monitoring
+
+from data_dir import data_path, ensure_parent
+
+logger = logging.getLogger(__name__)
+
+# Fraction of traces recorded, decided where a trace starts; 0 turns tracing off
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', 0))
+# Where finished spans go: 'file' (JSON lines) or 'otlp' (OTLP/HTTP JSON to a collector)
+TRACE_EXPORTER = os.getenv('TRACE_EXPORTER', 'file')
+TRACE_FILE = os.getenv('TRACE_FILE', data_path('traces.jsonl'))
+TRACE_OTLP_ENDPOINT = os.getenv('TRACE_OTLP_ENDPOINT', 'http://localhost:4318/v1/traces')
+TRACE_SERVICE_NAME = os.getenv('TRACE_SERVICE_NAME', 'email-sender-backend')
+# Spans kept per trace, so one sampled 100k-recipient campaign stays readable
+TRACE_MAX_SPANS = int(os.getenv('TRACE_MAX_SPANS', 20000))
+# Finished spans waiting for export; beyond this they are dropped, never blocking a send
+TRACE_QUEUE_SIZE = int(os.getenv('TRACE_QUEUE_SIZE', 50000))
+TRACE_BATCH_SIZE = 512
+TRACE_FLUSH_INTERVAL = 2.0
+
+# OTLP span kinds
+KIND_INTERNAL = 1
+KIND_SERVER = 2
+KIND_CLIENT = 3
+STATUS_ERROR = 2
+
+_current = contextvars.ContextVar('trace_span', default=None)
+
+
+class SpanContext:
+    """Identifies a span within its trace; unsampled contexts only stop children from sampling"""
+    __slots__ = ('trace_id', 'span_id', 'sampled', 'trace', 'span')
+
+    def __init__(self, trace_id, span_id, sampled, trace=None):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.sampled = sampled
+        # Per-trace state shared by every span of the trace in this process
+        self.trace = trace if trace is not None else {'spans': 0}
+        # The local span this context belongs to; None for a remote parent
+        self.span = None
+
+
+class Span:
+    __slots__ = ('name', 'context', 'parent_id', 'kind', 'start_ns', 'end_ns', 'attributes', 'error')
+
+    def __init__(self, name, context, parent_id, kind=KIND_INTERNAL, attributes=None, start_ns=None):
+        self.name = name
+        self.context = context
+        self.parent_id = parent_id
+        self.kind = kind
+        self.start_ns = start_ns or time.time_ns()
+        self.end_ns = None
+        self.attributes = dict(attributes or {})
+        self.error = None
+        context.span = self
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def record_error(self, error):
+        self.error = f"{type(error).__name__}: {error}"
+
+    def to_otlp(self):
+        span = {
+            'traceId': self.context.trace_id,
+            'spanId': self.context.span_id,
+            'name': self.name,
+            'kind': self.kind,
+            'startTimeUnixNano': str(self.start_ns),
+            'endTimeUnixNano': str(self.end_ns),
+            'attributes': [otlp_attribute(key, value) for key, value in self.attributes.items()
+                           if value is not None]
+        }
+        if self.parent_id:
+            span['parentSpanId'] = self.parent_id
+        if self.error:
+            span['status'] = {'code': STATUS_ERROR, 'message': self.error}
+        return span
+
+
+class _NoopSpan:
+    """Stands in for a span that isn't recorded"""
+    __slots__ = ()
+
+    def set_attribute(self, key, value):
+        pass
+
+    def record_error(self, error):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+def otlp_attribute(key, value):
+    if isinstance(value, bool):
+        typed = {'boolValue': value}
+    elif isinstance(value, int):
+        typed = {'intValue': str(value)}
+    elif isinstance(value, float):
+        typed = {'doubleValue': value}
+    else:
+        typed = {'stringValue': str(value)}
+    return {'key': key, 'value': typed}
+
+
+def _new_id(bits):
+    return f"{random.getrandbits(bits):0{bits // 4}x}"
+
+
+class FileExporter:
+    """Appends spans to a JSON-lines file, one OTLP span object per line"""
+
+    def __init__(self, path=TRACE_FILE):
+        self.path = path
+
+    def export(self, spans):
+        lines = ''.join(
+            json.dumps(dict(span.to_otlp(), service=TRACE_SERVICE_NAME)) + '\n' for span in spans
+        )
+        # One append per batch keeps lines from different workers whole
+        with open(ensure_parent(self.path), 'a') as f:
+            f.write(lines)
+
+
+class OTLPExporter:
+    """Posts spans to a collector's OTLP/HTTP JSON endpoint"""
+
+    def __init__(self, endpoint=TRACE_OTLP_ENDPOINT, timeout=5):
+        self.endpoint = endpoint
+        self.timeout = timeout
+
+    def export(self, spans):
+        payload = {'resourceSpans': [{
+            'resource': {'attributes': [otlp_attribute('service.name', TRACE_SERVICE_NAME)]},
+            'scopeSpans': [{'scope': {'name': 'email-sender'}, 'spans': [span.to_otlp() for span in spans]}]
+        }]}
+        req = urllib.request.Request(
+            self.endpoint,
+            data=json.dumps(payload).encode('utf-8'),
+            headers={'Content-Type': 'application/json'},
+            method='POST'
+        )
+        with urllib.request.urlopen(req, timeout=self.timeout) as response:
+            response.read()
+
+
+EXPORTERS = {
+    'file': FileExporter,
+    'otlp': OTLPExporter,
+}
+
+
+class Tracer:
+    """Records sampled spans and exports them in batches from a background thread.
+
+    The current span lives in a context variable. Work handed to another
+    thread, like a BulkSend stepped by the fair scheduler, carries its
+    context along and re-attaches it there, so a campaign's spans form
+    one trace from the request down to every SMTP transaction.
+    """
+
+    def __init__(self, sample_rate=TRACE_SAMPLE_RATE, exporter=None, max_spans=TRACE_MAX_SPANS,
+                 queue_size=TRACE_QUEUE_SIZE):
+        self.sample_rate = sample_rate
+        self.exporter = exporter
+        self.max_spans = max_spans
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.sample_rate > 0
+
+    def start_span(self, name, parent=None, kind=KIND_INTERNAL, attributes=None, start_ns=None):
+        """Begin a span under parent, or start a trace when there is none.
+
+        A new trace is sampled at sample_rate; an unsampled root span is
+        still returned so its children know not to sample. Under an
+        unsampled parent, or once the trace used up its span budget, there
+        is no span and None is returned.
+        """
+        if parent is None:
+            sampled = random.random() < self.sample_rate
+            return Span(name, SpanContext(_new_id(128), _new_id(64), sampled), None, kind, attributes, start_ns)
+        if not parent.sampled:
+            return None
+        parent.trace['spans'] += 1
+        if parent.trace['spans'] > self.max_spans:
+            return None
+        context = SpanContext(parent.trace_id, _new_id(64), True, parent.trace)
+        return Span(name, context, parent.span_id, kind, attributes, start_ns)
+
+    def end_span(self, span, end_ns=None):
+        span.end_ns = end_ns or time.time_ns()
+        if not span.context.sampled:
+            return
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+            return
+        self._ensure_exporting()
+
+    def _ensure_exporting(self):
+        # Started lazily so the thread is created in each forked gunicorn worker
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._export_loop, name='trace-exporter', daemon=True)
+                self._thread.start()
+
+    def _export_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + TRACE_FLUSH_INTERVAL
+            while len(batch) < TRACE_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                self.exporter.export(batch)
+            except Exception as e:
+                logger.error(f"Error exporting {len(batch)} trace spans: {e}")
+
+    def flush(self, timeout=5.0):
+        """Wait for queued spans to be handed to the exporter"""
+        deadline = time.monotonic() + timeout
+        while not self._queue.empty() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+
+_tracer = None
+_tracer_lock = threading.Lock()
+
+
+def get_tracer():
+    """Return the process-wide tracer"""
+    global _tracer
+    if _tracer is not None:
+        # Checked before locking, as every span asks
+        return _tracer
+    with _tracer_lock:
+        if _tracer is None:
+            exporter = EXPORTERS.get(TRACE_EXPORTER, FileExporter)()
+            _tracer = Tracer(exporter=exporter)
+        return _tracer
+
+
+@contextmanager
+def trace_span(name, attributes=None, kind=KIND_INTERNAL):
+    """Time the enclosed block as a child of the current span.
+
+    Yields the span, or a no-op stand-in when it isn't recorded, so callers
+    can add attributes either way. Exceptions are recorded and re-raised.
+    """
+    tracer = get_tracer()
+    if not tracer.enabled:
+        yield NOOP_SPAN
+        return
+    current = tracer.start_span(name, _current.get(), kind, attributes)
+    if current is None:
+        yield NOOP_SPAN
+        return
+    token = _current.set(current.context)
+    try:
+        yield current
+    except BaseException as e:
+        current.record_error(e)
+        raise
+    finally:
+        _current.reset(token)
+        tracer.end_span(current)
+
+
+def start_span(name, attributes=None, parent=None):
+    """Begin a span that ends elsewhere, such as one covering a whole campaign; see end_span"""
+    tracer = get_tracer()
+    if not tracer.enabled:
+        return None
+    return tracer.start_span(name, parent if parent is not None else _current.get(), KIND_INTERNAL, attributes)
+
+
+def end_span(span, error=None, attributes=None):
+    """End a span begun with start_span; span may be None"""
+    if span is None:
+        return
+    if attributes:
+        span.attributes.update(attributes)
+    if error is not None:
+        span.record_error(error)
+    get_tracer().end_span(span)
+
+
+def current_trace_context():
+    """The active span's context, to hand to work that continues on another thread"""
+    return _current.get()
+
+
+@contextmanager
+def attached_trace(context):
+    """Make context the current span while the enclosed block runs"""
+    if context is None:
+        yield
+        return
+    token = _current.set(context)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def record_span(name, start_ns, end_ns, context=None, attributes=None):
+    """Record a span for a stretch of time that has already passed, e.g. time spent queued"""
+    tracer = get_tracer()
+    parent = context if context is not None else _current.get()
+    if not tracer.enabled or parent is None:
+        return
+    finished = tracer.start_span(name, parent, KIND_INTERNAL, attributes, start_ns)
+    if finished is not None:
+        tracer.end_span(finished, end_ns)
+
+
+def set_span_attributes(attributes):
+    """Add attributes to the active span, if it is recorded"""
+    context = _current.get()
+    if context is None or not context.sampled:
+        return
+    if context.span is not None:
+        context.span.attributes.update(attributes)
+
+
+def parse_traceparent(header):
+    """A remote parent from a W3C traceparent header, or None"""
+    try:
+        version, trace_id, span_id, flags = header.strip().split('-')
+        int(trace_id, 16), int(span_id, 16)
+        if len(trace_id) != 32 or len(span_id) != 16 or version == 'ff':
+            return None
+        return SpanContext(trace_id, span_id, bool(int(flags, 16) & 1))
+    except (AttributeError, ValueError):
+        return None
+
+
+def init_tracing(app):
+    """Open a server span per request; the route's spans nest under it"""
+    tracer = get_tracer()
+    if not tracer.enabled:
+        return app
+
+    @app.before_request
+    def start_request_span():
+        parent = parse_traceparent(request.headers.get('traceparent', ''))
+        route = request.url_rule.rule if request.url_rule else request.path
+        current = tracer.start_span(f"{request.method} {route}", parent, KIND_SERVER, {
+            'http.method': request.method,
+            'http.route': route
+        })
+        if current is None:
+            # The caller chose not to sample; keep this request's spans out too
+            g.trace_token = _current.set(parent)
+            return
+        g.trace_span = current
+        g.trace_token = _current.set(current.context)
+
+    @app.after_request
+    def tag_request_span(response):
+        current = g.get('trace_span')
+        if current is not None:
+            current.set_attribute('http.status_code', response.status_code)
+            if current.context.sampled:
+                response.headers['traceparent'] = f"00-{current.context.trace_id}-{current.context.span_id}-01"
+        return response
+
+    @app.teardown_request
+    def end_request_span(error=None):
+        token = g.pop('trace_token', None)
+        if token is not None:
+            try:
+                _current.reset(token)
+            except ValueError:
+                # Streamed responses end in a different context than they started in
+                pass
+        current = g.pop('trace_span', None)
+        if current is None:
+            return
+        if error is not None:
+            current.record_error(error)
+        tracer.end_span(current)
+
+    return app
+
+
+class MongoCommandTracer(monitoring.CommandListener):
+    """Times every Mongo command issued inside a sampled trace as a client span"""
+
+    def __init__(self):
+        self._spans = {}
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        parent = _current.get()
+        if parent is None or not parent.sampled:
+            return
+        current = get_tracer().start_span(f"mongo.{event.command_name}", parent, KIND_CLIENT, {
+            'db.system': 'mongodb',
+            'db.name': event.database_name,
+            'db.operation': event.command_name,
+            'db.mongodb.collection': event.command.get(event.command_name) if isinstance(
+                event.command.get(event.command_name), str) else None
+        })
+        if current is not None:
+            with self._lock:
+                self._spans[(event.connection_id, event.request_id)] = current
+
+    def _finish(self, event, error=None):
+        with self._lock:
+            current = self._spans.pop((event.connection_id, event.request_id), None)
+        if current is None:
+            return
+        if error is not None:
+            current.error = error
+        get_tracer().end_span(current)
+
+    def succeeded(self, event):
+        self._finish(event)
+
+    def failed(self, event):
+        self._finish(event, str(event.failure))
+
+
+def mongo_event_listeners():
+    """Command listeners to pass to MongoClient; none unless tracing is on"""
+    return [MongoCommandTracer()] if get_tracer().enabled else []
@@ -0,0 +1,359 @@
+import logging
+import os
+import smtplib
+import socket
+import ssl
+import subprocess
+import threading
+import time
+from collections import OrderedDict
+
+from dns import resolver
+
+from data_dir import data_path
+from mx_cache import get_mx_cache
+
+logger = logging.getLogger(__name__)
+
+# Transport used when a user's settings don't name one: smtp, lmtp, sendmail, maildir, null or mx
+MAIL_TRANSPORT = os.getenv('MAIL_TRANSPORT', 'smtp')
+# Seconds before a silent relay counts as failed
+SMTP_TIMEOUT = int(os.getenv('SMTP_TIMEOUT', 60))
+SENDMAIL_PATH = os.getenv('SENDMAIL_PATH', '/usr/sbin/sendmail')
+MAILDIR_PATH = os.getenv('MAILDIR_PATH', data_path('maildir'))
+# Direct-to-MX delivery: destination port, name given in EHLO, and open
+# sessions kept per send before the least recently used is closed
+MX_PORT = int(os.getenv('MX_PORT', 25))
+MX_HELO_NAME = os.getenv('MX_HELO_NAME') or socket.getfqdn()
+MX_MAX_CONNECTIONS = int(os.getenv('MX_MAX_CONNECTIONS', 20))
+# Use STARTTLS when a destination offers it; set to 0 for plaintext only
+MX_STARTTLS = os.getenv('MX_STARTTLS', '1') != '0'
+
+# sendmail(8) exit status for temporary failures (sysexits.h EX_TEMPFAIL)
+EX_TEMPFAIL = 75
+
+
+class Transport:
+    """Hands rendered messages to something that delivers or stores them.
+
+    connect(relay) returns a connection offering the subset of smtplib.SMTP
+    the send engine uses: sendmail(), has_extn(), quit() and close().
+    Transports that don't talk to a real relay are unpaced, so dry runs skip
+    the throttle and per-domain rate limits and run at full speed.
+    """
+    name = None
+    paced = True
+
+    def connect(self, relay):
+        raise NotImplementedError
+
+
+class SMTPTransport(Transport):
+    """STARTTLS + AUTH submission to the user's relay"""
+    name = 'smtp'
+
+    def connect(self, relay):
+        server = smtplib.SMTP(relay.smtp_server, relay.smtp_port, timeout=SMTP_TIMEOUT)
+        server.starttls()
+        server.login(relay.username, relay.password)
+        return server
+
+
+class LMTPTransport(Transport):
+    """Local LMTP handoff, to a unix socket path or host:port, without TLS or auth"""
+    name = 'lmtp'
+
+    def __init__(self, address=None):
+        self.address = address or os.getenv('LMTP_ADDRESS')
+
+    def connect(self, relay):
+        if self.address and self.address.startswith('/'):
+            return smtplib.LMTP(self.address)
+        host, port = (self.address or f"{relay.smtp_server}:{relay.smtp_port}").rsplit(':', 1)
+        server = smtplib.LMTP(host, int(port))
+        server.sock.settimeout(SMTP_TIMEOUT)
+        return server
+
+
+class _LocalConnection:
+    """Base for connections without a session: nothing to negotiate or close"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def has_extn(self, name):
+        return False
+
+    def send_message(self, msg):
+        return self.sendmail(msg['From'], [msg['To']], msg.as_bytes())
+
+    def quit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SendmailConnection(_LocalConnection):
+    def __init__(self, path):
+        self.path = path
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        result = subprocess.run(
+            [self.path, '-i', '-f', from_addr, '--'] + list(to_addrs),
+            input=msg, capture_output=True, timeout=SMTP_TIMEOUT
+        )
+        if result.returncode != 0:
+            # Map the exit status onto an SMTP reply so callers retry or fail as usual
+            code = 451 if result.returncode == EX_TEMPFAIL else 554
+            raise smtplib.SMTPResponseException(code, result.stderr.strip() or b'sendmail failed')
+        return {}
+
+
+class SendmailTransport(Transport):
+    """Pipe each message to the local sendmail binary"""
+    name = 'sendmail'
+
+    def __init__(self, path=SENDMAIL_PATH):
+        self.path = path
+
+    def connect(self, relay):
+        return SendmailConnection(self.path)
+
+
+class MaildirConnection(_LocalConnection):
+    def __init__(self, transport):
+        self.transport = transport
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        self.transport.deliver(from_addr, to_addrs, msg)
+        return {}
+
+
+class MaildirTransport(Transport):
+    """Write every message into a maildir instead of sending it.
+
+    Files are written to tmp/ and renamed into new/, so a reader never sees
+    a partial message. The envelope is kept in X-Envelope-* headers.
+    """
+    name = 'maildir'
+    paced = False
+
+    def __init__(self, path=MAILDIR_PATH):
+        self.path = path
+        self._counter = 0
+        self._lock = threading.Lock()
+        for sub in ('tmp', 'new', 'cur'):
+            os.makedirs(os.path.join(path, sub), exist_ok=True)
+
+    def connect(self, relay):
+        return MaildirConnection(self)
+
+    def deliver(self, from_addr, to_addrs, msg):
+        with self._lock:
+            self._counter += 1
+            counter = self._counter
+        name = f"{time.time():.6f}.{os.getpid()}_{counter}.{socket.gethostname()}"
+        envelope = f"X-Envelope-From: {from_addr}\r\nX-Envelope-To: {', '.join(to_addrs)}\r\n".encode('utf-8')
+        tmp_path = os.path.join(self.path, 'tmp', name)
+        with open(tmp_path, 'wb') as f:
+            f.write(envelope)
+            f.write(msg if isinstance(msg, bytes) else msg.encode('utf-8'))
+        os.rename(tmp_path, os.path.join(self.path, 'new', name))
+
+
+class NullConnection(_LocalConnection):
+    def __init__(self, transport):
+        self.transport = transport
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        self.transport.count(len(to_addrs), len(msg))
+        return {}
+
+
+class NullTransport(Transport):
+    """Accept and discard every message, only counting messages and bytes"""
+    name = 'null'
+    paced = False
+
+    def __init__(self):
+        self.messages = 0
+        self.recipients = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    def connect(self, relay):
+        return NullConnection(self)
+
+    def count(self, recipients, size):
+        with self._lock:
+            self.messages += 1
+            self.recipients += recipients
+            self.bytes += size
+
+    def stats(self):
+        with self._lock:
+            return {'messages': self.messages, 'recipients': self.recipients, 'bytes': self.bytes}
+
+
+class MXConnection(_LocalConnection):
+    """Delivers each recipient straight to its domain's MX hosts.
+
+    One SMTP session is kept open per destination host, so domains sharing
+    MX hosts share it too. Hosts are tried in preference order: one that
+    can't be reached, or that answers the transaction with a 4xx, passes
+    the recipients to the next. Destination failures come back as
+    per-recipient refusals rather than errors of this connection, so a
+    single unreachable domain never trips the sender's relay breaker.
+    """
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.sessions = OrderedDict()
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        by_domain = {}
+        for rcpt in to_addrs:
+            by_domain.setdefault(rcpt.rsplit('@', 1)[-1].lower(), []).append(rcpt)
+        refused = {}
+        for domain, recipients in by_domain.items():
+            refused.update(self._deliver(domain, from_addr, recipients, msg))
+        if len(refused) == len(to_addrs):
+            raise smtplib.SMTPRecipientsRefused(refused)
+        return refused
+
+    def _deliver(self, domain, from_addr, recipients, msg):
+        from email_utils import send_transaction  # Import here to avoid circular imports
+
+        try:
+            hosts = self.transport.mx.delivery_hosts(domain)
+        except resolver.NXDOMAIN:
+            return self._refuse(recipients, 550, f"Domain {domain} does not exist")
+        except Exception as e:
+            return self._refuse(recipients, 451, f"MX lookup for {domain} failed: {e}")
+        if not hosts:
+            return self._refuse(recipients, 556, f"Domain {domain} does not accept mail")
+
+        failure = (451, f"No MX host of {domain} could be reached")
+        for host in hosts:
+            for attempt in range(2):
+                try:
+                    server, reused = self._session(host)
+                except (OSError, smtplib.SMTPException) as e:
+                    failure = (451, f"{host}: {e}")
+                    break
+                try:
+                    return send_transaction(server, from_addr, recipients, msg)
+                except smtplib.SMTPResponseException as e:
+                    self._drop(host)
+                    reply = e.smtp_error.decode(errors='replace') if isinstance(e.smtp_error, bytes) else e.smtp_error
+                    failure = (e.smtp_code, f"{host}: {reply}")
+                    if e.smtp_code >= 500:
+                        return self._refuse(recipients, *failure)
+                    break
+                except (OSError, smtplib.SMTPException) as e:
+                    self._drop(host)
+                    failure = (451, f"{host}: {e}")
+                    # A kept session may have been closed by the host while idle
+                    if not reused:
+                        break
+        return self._refuse(recipients, *failure)
+
+    @staticmethod
+    def _refuse(recipients, code, message):
+        return {rcpt: (code, message.encode('utf-8')) for rcpt in recipients}
+
+    def _session(self, host):
+        """Return (session, reused) for a destination host, connecting if needed"""
+        server = self.sessions.get(host)
+        if server is not None:
+            self.sessions.move_to_end(host)
+            return server, True
+
+        server = self.transport.open_session(host)
+        self.sessions[host] = server
+        while len(self.sessions) > MX_MAX_CONNECTIONS:
+            self._drop(next(iter(self.sessions)))
+        return server, False
+
+    def _drop(self, host):
+        server = self.sessions.pop(host, None)
+        if server is not None:
+            try:
+                server.quit()
+            except Exception:
+                server.close()
+
+    def quit(self):
+        for host in list(self.sessions):
+            self._drop(host)
+
+    def close(self):
+        self.quit()
+
+
+class MXTransport(Transport):
+    """Deliver straight to recipients' MX hosts, without a relay.
+
+    MX answers come from the process-wide MX cache; MX_ROUTES pins domains
+    to fixed hosts, e.g. local SMTP servers in tests.
+    """
+    name = 'mx'
+
+    def __init__(self, mx_cache=None, port=MX_PORT, helo_name=MX_HELO_NAME, starttls=MX_STARTTLS):
+        self.mx = mx_cache or get_mx_cache()
+        self.port = port
+        self.helo_name = helo_name
+        self.starttls = starttls
+
+    def connect(self, relay):
+        return MXConnection(self)
+
+    def open_session(self, host):
+        """Connect and EHLO to a destination host, given as name or name:port"""
+        name, _, port = host.rpartition(':')
+        if not port.isdigit():
+            name, port = host, self.port
+        server = smtplib.SMTP(name, int(port), local_hostname=self.helo_name, timeout=SMTP_TIMEOUT)
+        server.ehlo()
+        if self.starttls and server.has_extn('starttls'):
+            # Opportunistic TLS: MTAs don't verify each other's certificates
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            try:
+                server.starttls(context=context)
+                server.ehlo()
+            except (ssl.SSLError, smtplib.SMTPException) as e:
+                logger.warning(f"STARTTLS with {host} failed, delivering without TLS: {e}")
+                server.close()
+                server = smtplib.SMTP(name, int(port), local_hostname=self.helo_name, timeout=SMTP_TIMEOUT)
+                server.ehlo()
+        return server
+
+
+TRANSPORTS = {
+    'smtp': SMTPTransport,
+    'lmtp': LMTPTransport,
+    'sendmail': SendmailTransport,
+    'maildir': MaildirTransport,
+    'null': NullTransport,
+    'mx': MXTransport
+}
+
+_transports = {}
+_transports_lock = threading.Lock()
+
+
+def get_transport(name=None):
+    """Return this process's shared transport of the given kind"""
+    name = name or MAIL_TRANSPORT
+    if name not in TRANSPORTS:
+        raise ValueError(f"Unknown mail transport {name!r}; use one of {', '.join(TRANSPORTS)}")
+    with _transports_lock:
+        if name not in _transports:
+            _transports[name] = TRANSPORTS[name]()
+        return _transports[name]
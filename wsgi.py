@@ -0,0 +1,9 @@
+"""WSGI entry point: gunicorn wsgi:app
+
+Starts the serving process's background workers (campaign timer, outbox
+delivery, shard worker, log maintenance) once the app is loaded in each
+gunicorn worker.
+"""
+from app import app, start_background_workers
+
+start_background_workers()